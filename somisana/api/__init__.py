@@ -1,25 +1,61 @@
-from fastapi import FastAPI, Request, Response
+import asyncio
+from contextlib import asynccontextmanager, suppress
+
+from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 
 from somisana.api.lib import local_resource_folder_path
+from somisana.api.lib.auth import Authorize
+from somisana.api.lib.cache import listen_for_catalog_changes
+from somisana.api.lib.compression import CompressionMiddleware
+from somisana.api.lib.derivatives import derivative_pipeline
+from somisana.api.lib.file_index import index_dataset_folders
+from somisana.api.lib.file_removal import file_remover
+from somisana.api.lib.files import ResourceFileServer
+from somisana.api.lib.metrics import MetricsMiddleware, metrics_endpoint
+from somisana.api.lib.resource_sweep import sweep_resource_folder
 from somisana.api.routers import dataset
+from somisana.api.routers import instrumentation
 from somisana.api.routers import product
 from somisana.api.routers import resource
-from somisana.db import Session
+from somisana.const import SOMISANAScope
 from somisana.version import VERSION
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    listening = asyncio.Event()
+    catalog_listener = asyncio.create_task(listen_for_catalog_changes(listening))
+    with suppress(asyncio.TimeoutError):
+        await asyncio.wait_for(listening.wait(), timeout=10)
+
+    file_indexer = asyncio.create_task(index_dataset_folders())
+    resource_sweeper = asyncio.create_task(sweep_resource_folder())
+
+    yield
+
+    for task in catalog_listener, file_indexer, resource_sweeper:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+
+    await derivative_pipeline.shutdown()
+    await file_remover.drain()
+
+
 app = FastAPI(
     title="SOMISANA API",
     description="SOMISANA | SOMISANA Api",
     version=VERSION,
     docs_url='/swagger',
     redoc_url='/docs',
+    lifespan=lifespan,
 )
 
 app.include_router(product.router, prefix='/product', tags=['Product'])
 app.include_router(resource.router, prefix='/resource', tags=['Resource'])
 app.include_router(dataset.router, prefix='/dataset', tags=['Dataset'])
+app.include_router(instrumentation.router, prefix='/instrumentation', tags=['Instrumentation'])
 
 app.add_middleware(
     CORSMiddleware,
@@ -28,18 +64,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app.mount("/local_resources", StaticFiles(directory=local_resource_folder_path), name="Local Resources")
+# responses served from the response cache arrive already compressed
+app.add_middleware(CompressionMiddleware)
 
+# outermost, so that it also times the other middleware
+app.add_middleware(MetricsMiddleware)
+
+# exposes connection pool state and per-route traffic, like /instrumentation
+app.add_api_route(
+    '/metrics',
+    metrics_endpoint,
+    include_in_schema=False,
+    dependencies=[Depends(Authorize(SOMISANAScope.PRODUCT_ADMIN))],
+)
 
-@app.middleware('http')
-async def db_middleware(request: Request, call_next):
-    try:
-        response: Response = await call_next(request)
-        if 200 <= response.status_code < 400:
-            Session.commit()
-        else:
-            Session.rollback()
-    finally:
-        Session.remove()
+app.mount("/local_resources", ResourceFileServer(local_resource_folder_path), name="Local Resources")
 
-    return response
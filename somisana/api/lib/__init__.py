@@ -1,63 +1,153 @@
+import hashlib
 import os
+import tempfile
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Iterable
 
-from fastapi import UploadFile
+from fastapi import HTTPException, UploadFile
+from sqlalchemy import Row
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from starlette.status import HTTP_413_REQUEST_ENTITY_TOO_LARGE
 
 from somisana.api.lib.auth import Authorize
 from somisana.api.lib.auth import Authorize
+from somisana.api.lib.derivatives import schedule_derivatives
+from somisana.api.lib.file_removal import schedule_file_removal
+from somisana.api.lib.files import remove_precompressed_variants
 from somisana.api.models import ResourceModel
 from somisana.const import EntityType, ResourceReferenceType
 from somisana.db.models import Resource
 
 local_resource_folder_path = f'{Path(__file__).resolve().parent.parent.parent}/resources'
 
+# number of bytes read from an upload at a time
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# maximum size in bytes of an uploaded resource file
+UPLOAD_MAX_SIZE = int(os.getenv('SOMISANA_UPLOAD_MAX_SIZE', 1024 ** 3))
 
-def update_file_resource(file: UploadFile, resource: Resource, entity_type: EntityType, entity_id: int) -> bool:
-    new_file_path = save_local_resource_file(entity_type, entity_id, file)
+
+@dataclass
+class LocalResourceFile:
+    """A file stored under the local resource folder."""
+    path: str
+    checksum: str
+    size: int
+
+
+async def update_file_resource(
+        session: AsyncSession,
+        file: UploadFile,
+        resource: Resource,
+        entity_type: EntityType,
+        entity_id: int
+) -> bool:
+    new_file = await save_local_resource_file(entity_type, entity_id, file)
     old_file_path = resource.reference
     was_file = (resource.reference_type == ResourceReferenceType.PATH)
 
-    resource.reference = new_file_path
+    resource.reference = new_file.path
     resource.reference_type = ResourceReferenceType.PATH
-    resource.save()
+    resource.checksum = new_file.checksum
+    resource.size = new_file.size
+    await resource.save(session)
+    schedule_derivatives(session, local_resource_folder_path, resource)
 
-    if was_file:
-        delete_local_resource_file(old_file_path)
+    if was_file and old_file_path != new_file.path:
+        schedule_file_removal(session, local_resource_folder_path, [old_file_path])
 
     return True
 
 
-def save_file_resource(file: UploadFile, resource_model: ResourceModel, entity_type: EntityType, entity_id: int) -> int:
-    file_path = save_local_resource_file(entity_type.value, entity_id, file)
+async def save_file_resource(
+        session: AsyncSession,
+        file: UploadFile,
+        resource_model: ResourceModel,
+        entity_type: EntityType,
+        entity_id: int
+) -> int:
+    local_file = await save_local_resource_file(entity_type.value, entity_id, file)
 
     resource = Resource(
         title=resource_model.title,
         resource_type=resource_model.resource_type,
-        reference=file_path,
-        reference_type=ResourceReferenceType.PATH
+        reference=local_file.path,
+        reference_type=ResourceReferenceType.PATH,
+        checksum=local_file.checksum,
+        size=local_file.size,
     )
 
-    resource.save()
+    await resource.save(session)
+    schedule_derivatives(session, local_resource_folder_path, resource)
 
     return resource.id
 
 
-def save_local_resource_file(entity_type: EntityType, entity_id: int, local_file: UploadFile) -> str:
+async def save_local_resource_file(
+        entity_type: EntityType,
+        entity_id: int,
+        local_file: UploadFile
+) -> LocalResourceFile:
+    if local_file.size is not None and local_file.size > UPLOAD_MAX_SIZE:
+        raise HTTPException(HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
     local_resource_leaf_dir = f'{entity_type}/{entity_id}'
     local_resource_full_dir = f"{local_resource_folder_path}/{local_resource_leaf_dir}"
 
     if not os.path.exists(local_resource_full_dir):
         os.makedirs(local_resource_full_dir)
 
-    file_path = f"{local_resource_full_dir}/{local_file.filename}"
-
-    with open(file_path, "wb") as f:
-        f.write(local_file.file.read())
+    checksum, size = await run_in_threadpool(
+        _write_local_resource_file, local_file, f"{local_resource_full_dir}/{local_file.filename}"
+    )
 
-    return f'{local_resource_leaf_dir}/{local_file.filename}'
+    return LocalResourceFile(
+        path=f'{local_resource_leaf_dir}/{local_file.filename}',
+        checksum=checksum,
+        size=size,
+    )
 
 
-def delete_local_resource_file(resource_path):
-    resource_full_path = f'{local_resource_folder_path}/{resource_path}'
-    if os.path.exists(resource_full_path):
-        os.remove(resource_full_path)
+def _write_local_resource_file(local_file: UploadFile, file_path: str) -> tuple[str, int]:
+    """Stream an upload to a temporary file next to file_path in fixed-size
+    chunks, then move it into place. Return the SHA-256 hex digest and size
+    of the file."""
+    sha256 = hashlib.sha256()
+    size = 0
+
+    local_file.file.seek(0)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix='.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while chunk := local_file.file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > UPLOAD_MAX_SIZE:
+                    raise HTTPException(HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+                sha256.update(chunk)
+                f.write(chunk)
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    # variants of a previous file at the same path; new ones are written in the background
+    remove_precompressed_variants(file_path)
+
+    return sha256.hexdigest(), size
+
+
+def schedule_resource_file_removal(session: AsyncSession, resources: Iterable[Row]) -> None:
+    """Remove the local files of deleted resources, given as rows of
+    reference and reference type, once the session commits."""
+    schedule_file_removal(session, local_resource_folder_path, [
+        resource.reference
+        for resource in resources
+        if resource.reference_type == ResourceReferenceType.PATH
+    ])
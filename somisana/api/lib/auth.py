@@ -1,20 +1,52 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
 from dataclasses import dataclass
 
+import httpx
+from authlib.common.encoding import json_loads, urlsafe_b64decode
+from authlib.jose import JoseError, JsonWebKey, JsonWebToken, KeySet
 from fastapi import HTTPException
-from typing import Optional
+from typing import Awaitable, Callable, Optional
 from fastapi.openapi.models import OAuth2, OAuthFlowClientCredentials, OAuthFlows
 from fastapi.security.base import SecurityBase
 from fastapi.security.utils import get_authorization_scheme_param
+from starlette.concurrency import run_in_threadpool
 from starlette.requests import Request
-from starlette.status import HTTP_401_UNAUTHORIZED, HTTP_403_FORBIDDEN
+from starlette.status import HTTP_401_UNAUTHORIZED, HTTP_403_FORBIDDEN, HTTP_503_SERVICE_UNAVAILABLE
 
 from odp.config import config
+from somisana.api.lib.metrics import auth_timer
 from somisana.const import SOMISANAScope
 from odp.lib.hydra import HydraAdminAPI, OAuth2TokenIntrospection
 
+logger = logging.getLogger(__name__)
+
 hydra_admin_api = HydraAdminAPI(config.HYDRA.ADMIN.URL)
 hydra_public_url = config.HYDRA.PUBLIC.URL
 
+# 'introspect' to authorize every token via Hydra, or 'jwt' to verify JWT
+# access tokens locally against Hydra's JSON Web Key Set
+AUTH_MODE = os.getenv('SOMISANA_AUTH_MODE', 'introspect')
+# number of seconds after which the JSON Web Key Set is refreshed in the background
+AUTH_JWKS_REFRESH_INTERVAL = int(os.getenv('SOMISANA_AUTH_JWKS_REFRESH_INTERVAL', 300))
+# minimum number of seconds between JSON Web Key Set fetches
+AUTH_JWKS_MIN_REFRESH_INTERVAL = int(os.getenv('SOMISANA_AUTH_JWKS_MIN_REFRESH_INTERVAL', 30))
+# expected issuer of JWT access tokens
+AUTH_JWT_ISSUER = os.getenv('SOMISANA_AUTH_JWT_ISSUER', hydra_public_url)
+# number of seconds of clock skew tolerated when validating JWT expiry
+AUTH_JWT_LEEWAY = int(os.getenv('SOMISANA_AUTH_JWT_LEEWAY', 30))
+
+# maximum number of seconds an active introspection result is reused for
+AUTH_CACHE_TTL = int(os.getenv('SOMISANA_AUTH_CACHE_TTL', 60))
+# number of seconds an inactive introspection result is reused for
+AUTH_CACHE_NEGATIVE_TTL = int(os.getenv('SOMISANA_AUTH_CACHE_NEGATIVE_TTL', 10))
+# maximum number of cached introspection results
+AUTH_CACHE_SIZE = int(os.getenv('SOMISANA_AUTH_CACHE_SIZE', 1024))
+
 
 @dataclass
 class Authorized:
@@ -27,7 +59,222 @@ class Authorized:
     user_id: Optional[str]
 
 
-def _authorize_request(request: Request, required_scope: SOMISANAScope):
+class IntrospectionCache:
+    """A bounded cache of token introspection results, keyed by a hash of
+    the access token and the requested scope.
+
+    Active results expire at the token's ``exp`` or after ``ttl`` seconds,
+    whichever comes first; inactive results expire after ``negative_ttl``
+    seconds. The least recently used entry is evicted once ``max_size`` is
+    exceeded.
+    """
+
+    def __init__(
+            self,
+            max_size: int,
+            ttl: float,
+            negative_ttl: float,
+            clock: Callable[[], float] = time.time,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple[str, str], tuple[float, OAuth2TokenIntrospection]] = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _key(access_token: str, scope: SOMISANAScope) -> tuple[str, str]:
+        return hashlib.sha256(access_token.encode()).hexdigest(), scope.value
+
+    def get(self, access_token: str, scope: SOMISANAScope) -> Optional[OAuth2TokenIntrospection]:
+        key = self._key(access_token, scope)
+        if entry := self._entries.get(key):
+            expires_at, token = entry
+            if expires_at > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return token
+
+            del self._entries[key]
+
+        self.misses += 1
+        return None
+
+    def put(self, access_token: str, scope: SOMISANAScope, token: OAuth2TokenIntrospection) -> None:
+        now = self.clock()
+        if token.active:
+            expires_at = now + self.ttl
+            if token_exp := getattr(token, 'exp', None):
+                expires_at = min(expires_at, token_exp)
+        else:
+            expires_at = now + self.negative_ttl
+
+        if expires_at <= now:
+            return
+
+        key = self._key(access_token, scope)
+        self._entries[key] = (expires_at, token)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+introspection_cache = IntrospectionCache(
+    max_size=AUTH_CACHE_SIZE,
+    ttl=AUTH_CACHE_TTL,
+    negative_ttl=AUTH_CACHE_NEGATIVE_TTL,
+)
+
+
+class JWKSUnavailableError(Exception):
+    """Raised when the JSON Web Key Set cannot be fetched."""
+
+
+class JWKSCache:
+    """The keys of a JSON Web Key Set document.
+
+    The key set is fetched on first use, and refreshed in the background
+    once it is older than ``refresh_interval`` seconds. A key ID that is
+    not in the cached set triggers an immediate refetch, to pick up rotated
+    signing keys; fetches, including failed ones, are never made more often
+    than every ``min_refresh_interval`` seconds.
+    """
+
+    def __init__(
+            self,
+            fetch: Callable[[], Awaitable[dict]],
+            refresh_interval: float,
+            min_refresh_interval: float,
+            clock: Callable[[], float] = time.monotonic,
+    ):
+        self.fetch = fetch
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.clock = clock
+        self._key_set: Optional[KeySet] = None
+        self._fetched_at: Optional[float] = None
+        self._attempted_at: Optional[float] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def _may_refresh(self) -> bool:
+        return self._attempted_at is None or self.clock() - self._attempted_at >= self.min_refresh_interval
+
+    async def refresh(self) -> None:
+        self._attempted_at = self.clock()
+        try:
+            self._key_set = JsonWebKey.import_key_set(await self.fetch())
+        except (httpx.HTTPError, JoseError, ValueError) as e:
+            raise JWKSUnavailableError(f'Failed to fetch JSON Web Key Set: {e}') from e
+        self._fetched_at = self.clock()
+
+    def _refresh_in_background(self) -> None:
+        if self._refresh_task and not self._refresh_task.done():
+            return
+
+        def log_failure(task: asyncio.Task):
+            if not task.cancelled() and (exc := task.exception()):
+                logger.warning('%s', exc)
+
+        self._refresh_task = asyncio.create_task(self.refresh())
+        self._refresh_task.add_done_callback(log_failure)
+
+    async def get_key(self, kid: Optional[str]):
+        """Return the key with the given ID, raising ValueError if there
+        is no such key, or JWKSUnavailableError if the key set cannot be
+        fetched."""
+        if self._key_set is None:
+            if not self._may_refresh():
+                raise JWKSUnavailableError('JSON Web Key Set not yet fetched')
+            await self.refresh()
+        elif self.clock() - self._fetched_at >= self.refresh_interval and self._may_refresh():
+            self._refresh_in_background()
+
+        try:
+            return self._key_set.find_by_kid(kid)
+        except ValueError:
+            if not self._may_refresh():
+                raise
+
+        await self.refresh()
+        return self._key_set.find_by_kid(kid)
+
+
+async def _fetch_hydra_jwks() -> dict:
+    async with httpx.AsyncClient() as client:
+        response = await client.get(f'{hydra_public_url}/.well-known/jwks.json', timeout=10)
+        response.raise_for_status()
+        return response.json()
+
+
+jwks_cache = JWKSCache(
+    fetch=_fetch_hydra_jwks,
+    refresh_interval=AUTH_JWKS_REFRESH_INTERVAL,
+    min_refresh_interval=AUTH_JWKS_MIN_REFRESH_INTERVAL,
+) if AUTH_MODE == 'jwt' else None
+
+jwt = JsonWebToken(['RS256', 'ES256', 'PS256'])
+
+
+def _is_jwt(access_token: str) -> bool:
+    return access_token.count('.') == 2
+
+
+async def _verify_jwt(access_token: str, required_scope: SOMISANAScope) -> Optional[dict]:
+    """Verify a JWT access token against the cached key set, returning its
+    claims if it is valid and grants the required scope. Raises a 503
+    error if the key set is unavailable."""
+    try:
+        header = json_loads(urlsafe_b64decode(access_token.split('.')[0].encode()))
+        if not isinstance(header, dict):
+            return None
+        key = await jwks_cache.get_key(header.get('kid'))
+        claims = jwt.decode(access_token, key, claims_options={
+            'exp': {'essential': True},
+            'sub': {'essential': True},
+            'client_id': {'essential': True},
+        })
+        claims.validate(leeway=AUTH_JWT_LEEWAY)
+    except JWKSUnavailableError as e:
+        logger.warning('%s', e)
+        raise HTTPException(HTTP_503_SERVICE_UNAVAILABLE, 'Token verification is temporarily unavailable')
+    except (JoseError, ValueError):
+        return None
+
+    if claims.get('iss', '').rstrip('/') != AUTH_JWT_ISSUER.rstrip('/'):
+        return None
+
+    # Hydra issues scp as a list; other issuers use a space-separated string
+    scopes = claims.get('scp', [])
+    if isinstance(scopes, str):
+        scopes = scopes.split()
+    if required_scope.value not in scopes:
+        return None
+
+    return claims
+
+
+async def _introspect_token(access_token: str, required_scope: SOMISANAScope) -> OAuth2TokenIntrospection:
+    if (token := introspection_cache.get(access_token, required_scope)) is None:
+        # the Hydra client is synchronous; keep it off the event loop
+        token = await run_in_threadpool(
+            hydra_admin_api.introspect_token, access_token, [required_scope.value],
+        )
+        introspection_cache.put(access_token, required_scope, token)
+
+    return token
+
+
+async def _authorize_request(request: Request, required_scope: SOMISANAScope):
     auth_header = request.headers.get('Authorization')
     scheme, access_token = get_authorization_scheme_param(auth_header)
     if not auth_header or scheme.lower() != 'bearer':
@@ -36,9 +283,16 @@ def _authorize_request(request: Request, required_scope: SOMISANAScope):
             headers={'WWW-Authenticate': 'Bearer'},
         )
 
-    token: OAuth2TokenIntrospection = hydra_admin_api.introspect_token(
-        access_token, [required_scope.value],
-    )
+    if jwks_cache and _is_jwt(access_token):
+        if not (claims := await _verify_jwt(access_token, required_scope)):
+            raise HTTPException(HTTP_403_FORBIDDEN)
+
+        return Authorized(
+            client_id=claims['client_id'],
+            user_id=None if claims['sub'] == claims['client_id'] else claims['sub']
+        )
+
+    token = await _introspect_token(access_token, required_scope)
 
     if not token.active:
         raise HTTPException(HTTP_403_FORBIDDEN)
@@ -72,5 +326,6 @@ class Authorize(BaseAuthorize):
         return f'{self.__class__.__name__}(scope={self.scope.value!r})'
 
     async def __call__(self, request: Request) -> Authorized:
-        return _authorize_request(request, self.scope)
+        with auth_timer():
+            return await _authorize_request(request, self.scope)
 
@@ -0,0 +1,270 @@
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Optional
+from urllib.parse import urlencode
+
+import asyncpg
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.status import HTTP_304_NOT_MODIFIED
+from starlette.types import Receive, Scope, Send
+
+from somisana.api.lib.compression import COMPRESSION_MIN_SIZE, compress_off_loop, negotiate_encoding, weak_etag
+from somisana.api.lib.serialization import fast_json
+from somisana.config import somisana_config
+from somisana.db import ApiSession
+
+logger = logging.getLogger(__name__)
+
+# maximum number of cached responses
+RESPONSE_CACHE_SIZE = int(os.getenv('SOMISANA_RESPONSE_CACHE_SIZE', 256))
+# maximum number of bytes held by cached responses, counting compressed variants
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('SOMISANA_RESPONSE_CACHE_MAX_BYTES', 64 * 1024 ** 2))
+
+# Postgres notification channel on which catalog changes are announced
+CATALOG_CHANNEL = 'somisana_catalog'
+
+
+@dataclass
+class CachedResponse:
+    body: bytes
+    etag: str
+    headers: dict[str, str] = field(default_factory=dict)
+    # the body compressed with each content coding requested so far
+    encoded_bodies: dict[str, bytes] = field(default_factory=dict)
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(body) for body in self.encoded_bodies.values())
+
+
+class ResponseCache:
+    """Pre-serialized JSON response bodies keyed by route and parameters,
+    together with their compressed variants.
+
+    Entries are only valid for the catalog generation in which they were
+    stored; bumping the generation discards every entry. The least recently
+    used entries are evicted once there are more than ``max_size`` of them,
+    or they hold more than ``max_bytes`` in all.
+    """
+
+    def __init__(self, max_size: int, max_bytes: int):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._entries: OrderedDict[str, CachedResponse] = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def bump(self) -> None:
+        self.generation += 1
+        self._entries.clear()
+        self.nbytes = 0
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        if entry := self._entries.get(key):
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, entry: CachedResponse, generation: int) -> None:
+        # the response was built from data read before a catalog change
+        if generation != self.generation or entry.size > self.max_bytes:
+            return
+
+        if replaced := self._entries.pop(key, None):
+            self.nbytes -= replaced.size
+        self._entries[key] = entry
+        self.nbytes += entry.size
+        self._evict()
+
+    def add_encoded_body(self, key: str, entry: CachedResponse, encoding: str, body: bytes) -> None:
+        """Keep a compressed variant of an entry's body, counting it towards
+        the size of the cache if the entry is still cached."""
+        if encoding in entry.encoded_bodies:
+            return
+
+        entry.encoded_bodies[encoding] = body
+        if self._entries.get(key) is entry:
+            self.nbytes += len(body)
+            self._evict()
+
+    def _evict(self) -> None:
+        while len(self._entries) > self.max_size or self.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= evicted.size
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+response_cache = ResponseCache(max_size=RESPONSE_CACHE_SIZE, max_bytes=RESPONSE_CACHE_MAX_BYTES)
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+
+    if if_none_match.strip() == '*':
+        return True
+
+    # If-None-Match uses the weak comparison function
+    return any(
+        tag.strip().removeprefix('W/') == etag
+        for tag in if_none_match.split(',')
+    )
+
+
+class _EncodedCachedResponse(Response):
+    """A cached response sent compressed. The body is compressed when the
+    response is sent, off the event loop if it is large, unless a variant
+    compressed with the same content coding is already cached."""
+
+    def __init__(self, key: str, entry: CachedResponse, encoding: str, headers: dict[str, str]):
+        super().__init__(entry.encoded_bodies.get(encoding), media_type='application/json', headers=headers)
+        self.key = key
+        self.entry = entry
+        self.encoding = encoding
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if (body := self.entry.encoded_bodies.get(self.encoding)) is None:
+            body = await compress_off_loop(self.entry.body, self.encoding)
+            response_cache.add_encoded_body(self.key, self.entry, self.encoding, body)
+
+        self.body = body
+        self.headers['Content-Length'] = str(len(body))
+        await super().__call__(scope, receive, send)
+
+
+def _response(request: Request, key: str, entry: CachedResponse) -> Response:
+    headers = {
+        **entry.headers,
+        'ETag': entry.etag,
+        'Cache-Control': 'private, no-cache',
+    }
+    encoding = None
+    if len(entry.body) >= COMPRESSION_MIN_SIZE:
+        headers['Vary'] = 'Accept-Encoding'
+        if encoding := negotiate_encoding(request.headers.get('Accept-Encoding')):
+            headers['Content-Encoding'] = encoding
+            headers['ETag'] = weak_etag(entry.etag)
+
+    if _etag_matches(request.headers.get('If-None-Match'), entry.etag):
+        return Response(status_code=HTTP_304_NOT_MODIFIED, headers=headers)
+
+    if encoding:
+        return _EncodedCachedResponse(key, entry, encoding, headers)
+
+    return Response(entry.body, media_type='application/json', headers=headers)
+
+
+class CacheLookup:
+    """The result of looking up a request in the response cache. If
+    ``response`` is set, the route should return it as is; otherwise the
+    route builds its content and returns ``store(content)``."""
+
+    def __init__(self, request: Request):
+        self.request = request
+        self.key = f'{request.url.path}?{urlencode(sorted(request.query_params.multi_items()))}'
+        self.generation = response_cache.generation
+        self.response: Optional[Response] = None
+
+        if entry := response_cache.get(self.key):
+            self.response = _response(request, self.key, entry)
+
+    def store(self, content: Any, headers: Optional[dict[str, str]] = None) -> Response:
+        body = fast_json(content)
+        entry = CachedResponse(
+            body=body,
+            etag=f'"{hashlib.sha256(body).hexdigest()[:32]}"',
+            headers=headers or {},
+        )
+        response_cache.put(self.key, entry, self.generation)
+
+        return _response(self.request, self.key, entry)
+
+
+async def response_cache_lookup(request: Request) -> CacheLookup:
+    """FastAPI dependency that looks up the request in the response cache."""
+    return CacheLookup(request)
+
+
+@event.listens_for(ApiSession, 'after_flush')
+def _detect_flushed_changes(session, flush_context):
+    if session.new or session.dirty or session.deleted:
+        session.info['catalog_changed'] = True
+
+
+@event.listens_for(ApiSession, 'do_orm_execute')
+def _detect_bulk_changes(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info['catalog_changed'] = True
+
+
+@event.listens_for(ApiSession, 'before_commit')
+def _notify_catalog_change(session):
+    # changes still pending are flushed by the commit, after this event
+    if session.new or session.dirty or session.deleted:
+        session.info['catalog_changed'] = True
+
+    # delivered to listening processes only once the transaction commits
+    if session.info.get('catalog_changed'):
+        session.execute(text(f'NOTIFY {CATALOG_CHANNEL}'))
+
+
+@event.listens_for(ApiSession, 'after_commit')
+def _bump_catalog_generation(session):
+    if session.info.pop('catalog_changed', False):
+        response_cache.bump()
+
+
+@event.listens_for(ApiSession, 'after_rollback')
+def _discard_catalog_change(session):
+    session.info.pop('catalog_changed', None)
+
+
+async def listen_for_catalog_changes(listening: asyncio.Event):
+    """Bump the catalog generation whenever any process commits a catalog
+    change. Runs until cancelled, reconnecting if the connection is lost.
+
+    ``listening`` is set once the first connection is established.
+    """
+    dsn = make_url(somisana_config.SOMISANA.DB.URL).set(drivername='postgresql').render_as_string(hide_password=False)
+    while True:
+        try:
+            connection = await asyncpg.connect(dsn)
+            try:
+                closed = asyncio.Event()
+                connection.add_termination_listener(lambda _: closed.set())
+                await connection.add_listener(CATALOG_CHANNEL, lambda *_: response_cache.bump())
+
+                # changes may have been missed while reconnecting
+                if listening.is_set():
+                    response_cache.bump()
+                listening.set()
+
+                await closed.wait()
+            finally:
+                await connection.close()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning('Lost catalog change notifications: %s', e)
+
+        await asyncio.sleep(5)
@@ -0,0 +1,189 @@
+import gzip
+import os
+import zlib
+from typing import Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.status import HTTP_200_OK
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# responses smaller than this (in bytes) are sent uncompressed
+COMPRESSION_MIN_SIZE = int(os.getenv('SOMISANA_COMPRESSION_MIN_SIZE', 1024))
+# gzip compression level (1-9) for responses compressed on the fly
+COMPRESSION_GZIP_LEVEL = int(os.getenv('SOMISANA_COMPRESSION_GZIP_LEVEL', 6))
+# brotli quality (0-11) for responses compressed on the fly
+COMPRESSION_BROTLI_QUALITY = int(os.getenv('SOMISANA_COMPRESSION_BROTLI_QUALITY', 5))
+
+# bodies and chunks at least this large (in bytes) are compressed in a
+# worker thread, so as not to hold up the event loop
+COMPRESSION_THREAD_MIN_SIZE = 64 * 1024
+
+COMPRESSIBLE_MEDIA_TYPES = {
+    'application/json',
+    'application/geo+json',
+    'application/javascript',
+    'application/xml',
+    'image/svg+xml',
+}
+
+# content codings that may be applied on the fly, in order of preference
+COMPRESSION_ENCODINGS = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def is_compressible_media_type(media_type: str) -> bool:
+    return media_type.startswith('text/') or media_type in COMPRESSIBLE_MEDIA_TYPES
+
+
+def accepted_encodings(accept_encoding: Optional[str]) -> set[str]:
+    """Return the content codings listed in an Accept-Encoding header,
+    excluding those given a quality of zero."""
+    encodings = set()
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.partition(';')
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        encodings.add(coding.strip().lower())
+
+    return encodings
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Return the preferred content coding accepted by the client, or None
+    if the response should be sent uncompressed."""
+    accepted = accepted_encodings(accept_encoding)
+    return next((encoding for encoding in COMPRESSION_ENCODINGS if encoding in accepted), None)
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(data, quality=COMPRESSION_BROTLI_QUALITY)
+
+    return gzip.compress(data, compresslevel=COMPRESSION_GZIP_LEVEL, mtime=0)
+
+
+async def compress_off_loop(data: bytes, encoding: str) -> bytes:
+    """Compress data, in a worker thread if it is large."""
+    if len(data) >= COMPRESSION_THREAD_MIN_SIZE:
+        return await run_in_threadpool(compress, data, encoding)
+
+    return compress(data, encoding)
+
+
+def weak_etag(etag: str) -> str:
+    """A compressed response is not byte-for-byte the representation that
+    its strong ETag identifies, but it is semantically equivalent."""
+    return etag if etag.startswith('W/') else f'W/{etag}'
+
+
+class _StreamCompressor:
+    def __init__(self, encoding: str):
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+            self.compress = self._compressor.process
+            self.finish = self._compressor.finish
+        else:
+            self._compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+            self.compress = self._compressor.compress
+            self.finish = self._compressor.flush
+
+    def _compress_chunk(self, chunk: bytes, last: bool) -> bytes:
+        body = self.compress(chunk)
+        if last:
+            body += self.finish()
+        return body
+
+    async def compress_chunk(self, chunk: bytes, last: bool) -> bytes:
+        """Compress the next chunk of a stream, finishing the stream if it is
+        the last one. Large chunks are compressed in a worker thread."""
+        if len(chunk) >= COMPRESSION_THREAD_MIN_SIZE:
+            return await run_in_threadpool(self._compress_chunk, chunk, last)
+
+        return self._compress_chunk(chunk, last)
+
+
+class CompressionMiddleware:
+    """Compresses text and JSON responses with the content coding preferred
+    by the client, unless they are smaller than ``minimum_size`` or already
+    encoded, as are responses served from the response cache and
+    precompressed resource files. Streamed responses are compressed chunk
+    by chunk."""
+
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or not (
+                encoding := negotiate_encoding(Headers(scope=scope).get('accept-encoding'))
+        ):
+            return await self.app(scope, receive, send)
+
+        start_message: Optional[Message] = None
+        compressor: Optional[_StreamCompressor] = None
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start_message, compressor
+
+            if message['type'] == 'http.response.start':
+                # held back until the first chunk of the body shows its size
+                start_message = message
+                return
+
+            if compressor is not None and message['type'] == 'http.response.body':
+                more_body = message.get('more_body', False)
+                body = await compressor.compress_chunk(message.get('body', b''), last=not more_body)
+                if body or not more_body:
+                    await send({**message, 'body': body})
+                return
+
+            if start_message is None or message['type'] != 'http.response.body':
+                if start_message is not None:
+                    await send(start_message)
+                    start_message = None
+                return await send(message)
+
+            headers = MutableHeaders(raw=start_message['headers'])
+            body = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            size = len(body) if not more_body else int(headers.get('content-length', self.minimum_size))
+
+            if (
+                    start_message['status'] != HTTP_200_OK
+                    or 'content-encoding' in headers
+                    or 'content-range' in headers
+                    or not is_compressible_media_type(headers.get('content-type', '').partition(';')[0].strip())
+                    or size < self.minimum_size
+            ):
+                await send(start_message)
+                start_message = None
+                return await send(message)
+
+            headers['Content-Encoding'] = encoding
+            headers.add_vary_header('Accept-Encoding')
+            if etag := headers.get('etag'):
+                headers['ETag'] = weak_etag(etag)
+
+            if more_body:
+                compressor = _StreamCompressor(encoding)
+                del headers['content-length']
+                body = await compressor.compress_chunk(body, last=False)
+            else:
+                body = await compress_off_loop(body, encoding)
+                headers['Content-Length'] = str(len(body))
+
+            await send(start_message)
+            start_message = None
+            await send({**message, 'body': body})
+
+        await self.app(scope, receive, send_compressed)
@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import os
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+from PIL import Image, ImageOps
+from sqlalchemy import delete, event, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from somisana.api.lib.files import is_precompressible, write_precompressed_variants
+from somisana.const import ResourceType
+from somisana.db import ApiSession, AsyncSessionLocal
+from somisana.db.models import Resource, ResourceRendition
+
+logger = logging.getLogger(__name__)
+
+# number of processes generating derivatives; 0 disables the pipeline
+DERIVATIVE_WORKERS = int(os.getenv('SOMISANA_DERIVATIVE_WORKERS', 2))
+# minimum width in pixels of the thumbnail rendition returned in catalog entries
+CATALOG_THUMBNAIL_WIDTH = int(os.getenv('SOMISANA_CATALOG_THUMBNAIL_WIDTH', 320))
+
+# widths in pixels of the renditions generated for each image, which are
+# never wider than the original
+RENDITION_WIDTHS = (320, 640, 1280)
+# media type -> (Pillow format, file extension)
+RENDITION_FORMATS = {
+    'image/webp': ('WEBP', 'webp'),
+    'image/jpeg': ('JPEG', 'jpg'),
+}
+RENDITION_QUALITY = 80
+
+DERIVATIVE_RESOURCE_TYPES = {ResourceType.COVER_IMAGE, ResourceType.THUMBNAIL, ResourceType.COVER_CLIP}
+
+
+@dataclass
+class DerivativeJob:
+    resource_id: int
+    directory: str
+    reference: str
+    resource_type: ResourceType
+    # whether to write precompressed variants of a text file
+    precompress: bool = False
+
+
+@dataclass
+class Rendition:
+    reference: str
+    media_type: str
+    width: int
+    height: int
+    size: int
+
+
+def rendition_folder(reference: str) -> str:
+    """Return the folder, relative to the local resource folder, holding the
+    derivatives of the resource file at ``reference``."""
+    return f'{reference}.renditions'
+
+
+def render_derivatives(directory: str, reference: str, resource_type: ResourceType) -> list[Rendition]:
+    """Generate the renditions of an image, or of a poster frame taken from
+    a clip. Runs in a worker process."""
+    source_path = f'{directory}/{reference}'
+    folder = rendition_folder(reference)
+    shutil.rmtree(f'{directory}/{folder}', ignore_errors=True)
+    os.makedirs(f'{directory}/{folder}')
+
+    renditions = []
+    if resource_type == ResourceType.COVER_CLIP:
+        poster_reference = f'{folder}/poster.jpg'
+        if not _extract_poster_frame(source_path, f'{directory}/{poster_reference}'):
+            return []
+
+        with Image.open(f'{directory}/{poster_reference}') as poster:
+            renditions += [Rendition(
+                reference=poster_reference,
+                media_type='image/jpeg',
+                width=poster.width,
+                height=poster.height,
+                size=os.path.getsize(f'{directory}/{poster_reference}'),
+            )]
+        source_path = f'{directory}/{poster_reference}'
+
+    with Image.open(source_path) as original:
+        image = ImageOps.exif_transpose(original)
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+
+        for width in RENDITION_WIDTHS:
+            if width >= image.width:
+                break
+
+            height = max(1, round(image.height * width / image.width))
+            resized = image.resize((width, height), Image.Resampling.LANCZOS)
+
+            for media_type, (image_format, extension) in RENDITION_FORMATS.items():
+                mode = 'RGBA' if has_alpha and image_format != 'JPEG' else 'RGB'
+                rendition_reference = f'{folder}/{width}.{extension}'
+                resized.convert(mode).save(f'{directory}/{rendition_reference}', image_format,
+                                           quality=RENDITION_QUALITY)
+                renditions += [Rendition(
+                    reference=rendition_reference,
+                    media_type=media_type,
+                    width=width,
+                    height=height,
+                    size=os.path.getsize(f'{directory}/{rendition_reference}'),
+                )]
+
+    return renditions
+
+
+def generate_derivatives(job: DerivativeJob) -> Optional[list[Rendition]]:
+    """Write the precompressed variants and renditions of a resource file,
+    returning the renditions, or None if the resource has none. Runs in a
+    worker process."""
+    if job.precompress:
+        write_precompressed_variants(f'{job.directory}/{job.reference}')
+
+    if job.resource_type not in DERIVATIVE_RESOURCE_TYPES:
+        return None
+
+    return render_derivatives(job.directory, job.reference, job.resource_type)
+
+
+def _extract_poster_frame(clip_path: str, poster_path: str) -> bool:
+    if not (ffmpeg := shutil.which('ffmpeg')):
+        logger.warning('ffmpeg is not available; no poster frame extracted from %s', clip_path)
+        return False
+
+    # the thumbnail filter picks a representative frame from the start of the clip
+    result = subprocess.run(
+        [ffmpeg, '-loglevel', 'error', '-y', '-i', clip_path, '-vf', 'thumbnail', '-frames:v', '1', poster_path],
+        capture_output=True,
+        timeout=120,
+    )
+    if result.returncode != 0 or not os.path.exists(poster_path):
+        logger.warning('Failed to extract a poster frame from %s: %s', clip_path, result.stderr.decode().strip())
+        return False
+
+    return True
+
+
+class DerivativePipeline:
+    """Generates derivatives of uploaded resource files in a process pool,
+    and records them against their resources."""
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def submit(self, job: DerivativeJob) -> None:
+        if not self.max_workers:
+            return
+
+        task = asyncio.get_running_loop().create_task(self._run(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def drain(self) -> None:
+        """Wait for all submitted jobs to complete."""
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def shutdown(self) -> None:
+        await self.drain()
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+
+    async def _run(self, job: DerivativeJob) -> None:
+        if not self._executor:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+
+        try:
+            renditions = await asyncio.get_running_loop().run_in_executor(
+                self._executor, generate_derivatives, job
+            )
+            if renditions is not None:
+                async with AsyncSessionLocal() as session:
+                    await self._record(session, job, renditions)
+        except Exception:
+            logger.exception('Failed to generate derivatives of resource %d', job.resource_id)
+
+    @staticmethod
+    async def _record(session: AsyncSession, job: DerivativeJob, renditions: list[Rendition]) -> None:
+        current_reference = (await session.execute(
+            select(Resource.reference).where(Resource.id == job.resource_id).with_for_update()
+        )).scalar_one_or_none()
+
+        # the resource was deleted, or given another file, in the meantime
+        if current_reference != job.reference:
+            await session.rollback()
+            shutil.rmtree(f'{job.directory}/{rendition_folder(job.reference)}', ignore_errors=True)
+            return
+
+        await session.execute(delete(ResourceRendition).where(ResourceRendition.resource_id == job.resource_id))
+        session.add_all(
+            ResourceRendition(resource_id=job.resource_id, **vars(rendition))
+            for rendition in renditions
+        )
+        try:
+            await session.commit()
+        except IntegrityError:
+            await session.rollback()
+            shutil.rmtree(f'{job.directory}/{rendition_folder(job.reference)}', ignore_errors=True)
+
+
+derivative_pipeline = DerivativePipeline(max_workers=DERIVATIVE_WORKERS)
+
+
+def schedule_derivatives(session: AsyncSession, directory: str, resource: Resource) -> None:
+    """Generate derivatives of a resource file once the session commits:
+    renditions if the resource is of a type that has them, and
+    precompressed variants if it is a text file."""
+    resource_type = ResourceType(resource.resource_type)
+    precompress = is_precompressible(resource.reference)
+    if resource_type not in DERIVATIVE_RESOURCE_TYPES and not precompress:
+        return
+
+    session.info.setdefault('derivative_jobs', []).append(DerivativeJob(
+        resource_id=resource.id,
+        directory=directory,
+        reference=resource.reference,
+        resource_type=resource_type,
+        precompress=precompress,
+    ))
+
+
+@event.listens_for(ApiSession, 'after_commit')
+def _submit_derivative_jobs(session):
+    for job in session.info.pop('derivative_jobs', []):
+        derivative_pipeline.submit(job)
+
+
+@event.listens_for(ApiSession, 'after_rollback')
+def _discard_derivative_jobs(session):
+    session.info.pop('derivative_jobs', None)
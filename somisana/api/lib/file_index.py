@@ -0,0 +1,308 @@
+import asyncio
+import hashlib
+import logging
+import os
+import stat
+import time
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator, Optional
+
+from sqlalchemy import delete, func, select, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from somisana.api.lib.cache import CATALOG_CHANNEL, response_cache
+from somisana.db import AsyncSessionLocal, async_engine
+from somisana.db.models import Dataset, DatasetDirectory, DatasetFile
+
+logger = logging.getLogger(__name__)
+
+# directory under which all dataset folders must lie; relative dataset folder
+# paths are resolved against it. Dataset folders are not indexed if it is unset.
+DATASET_FOLDER_ROOT = os.getenv('SOMISANA_DATASET_FOLDER_ROOT')
+# seconds between scans of all dataset folders; 0 disables periodic scans
+FILE_INDEX_INTERVAL = int(os.getenv('SOMISANA_FILE_INDEX_INTERVAL', 300))
+# whether to record the SHA-256 checksum of each new or changed file; this
+# reads every byte of those files while the scan holds its transaction
+FILE_INDEX_CHECKSUMS = os.getenv('SOMISANA_FILE_INDEX_CHECKSUMS', 'false').lower() == 'true'
+
+# number of rows written per insert statement
+FILE_INDEX_BATCH_SIZE = 1000
+
+# entries modified this recently may still change within the same
+# timestamp tick, so their directory is listed again on the next scan
+RACY_INTERVAL_NS = 2_000_000_000
+
+
+@dataclass
+class ListedDirectory:
+    mtime_ns: Optional[int]
+    # file name -> (size, mtime_ns)
+    files: dict[str, tuple[int, int]]
+
+
+@dataclass
+class FolderScan:
+    """Directories under a dataset folder that have changed since they were
+    last listed, and indexed directories that no longer exist."""
+    listed: dict[str, ListedDirectory] = field(default_factory=dict)
+    removed: set[str] = field(default_factory=set)
+    unchanged: int = 0
+
+
+@dataclass
+class ScanResult:
+    directories_listed: int = 0
+    directories_unchanged: int = 0
+    files_added: int = 0
+    files_updated: int = 0
+    files_removed: int = 0
+
+
+def dataset_folder(folder_path: str) -> Optional[str]:
+    """Return the full path of a dataset folder, or None if no dataset
+    folder root is configured or the folder lies outside it."""
+    if not DATASET_FOLDER_ROOT:
+        return None
+
+    root = os.path.realpath(DATASET_FOLDER_ROOT)
+    path = os.path.realpath(os.path.join(root, folder_path))
+    if os.path.commonpath([path, root]) != root:
+        return None
+
+    return path
+
+
+def _join(directory: str, name: str) -> str:
+    return f'{directory}/{name}' if directory else name
+
+
+def _batches(items: Iterable) -> Iterator[list]:
+    items = list(items)
+    for i in range(0, len(items), FILE_INDEX_BATCH_SIZE):
+        yield items[i:i + FILE_INDEX_BATCH_SIZE]
+
+
+def _parent(path: str) -> Optional[str]:
+    return path.rpartition('/')[0] if path else None
+
+
+def scan_folder(root: str, indexed: dict[str, Optional[int]], full: bool = False) -> FolderScan:
+    """Walk the directory tree under ``root``, listing only directories whose
+    modification time differs from the indexed one, or all directories if
+    ``full`` is set. Unchanged directories are descended into using their
+    indexed subdirectories, at the cost of a single stat each.
+
+    A directory's modification time changes when entries are added, removed
+    or renamed, but not when a file is rewritten in place; a full scan picks
+    up such changes.
+    """
+    children: dict[str, list[str]] = {}
+    for path in indexed:
+        if (parent := _parent(path)) is not None:
+            children.setdefault(parent, []).append(path)
+
+    result = FolderScan()
+    visited = set()
+    now_ns = time.time_ns()
+    pending = ['']
+    while pending:
+        directory = pending.pop()
+        try:
+            dir_stat = os.stat(os.path.join(root, directory))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        if not stat.S_ISDIR(dir_stat.st_mode):
+            continue
+
+        visited.add(directory)
+        if not full and indexed.get(directory, -1) == dir_stat.st_mtime_ns:
+            result.unchanged += 1
+            pending += children.get(directory, [])
+            continue
+
+        files = {}
+        racy = now_ns - dir_stat.st_mtime_ns < RACY_INTERVAL_NS
+        with os.scandir(os.path.join(root, directory)) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(_join(directory, entry.name))
+                    elif entry.is_file():
+                        entry_stat = entry.stat()
+                        files[entry.name] = (entry_stat.st_size, entry_stat.st_mtime_ns)
+                        racy = racy or now_ns - entry_stat.st_mtime_ns < RACY_INTERVAL_NS
+                except FileNotFoundError:
+                    continue
+
+        result.listed[directory] = ListedDirectory(mtime_ns=None if racy else dir_stat.st_mtime_ns, files=files)
+
+    result.removed = set(indexed) - visited
+    return result
+
+
+def _file_checksum(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def _checksums(root: str, paths: list[str]) -> dict[str, Optional[str]]:
+    checksums = {}
+    for path in paths:
+        try:
+            checksums[path] = _file_checksum(os.path.join(root, path))
+        except FileNotFoundError:
+            checksums[path] = None
+
+    return checksums
+
+
+async def scan_dataset_files(session: AsyncSession, dataset: Dataset, full: bool = False) -> Optional[ScanResult]:
+    """Bring the file index of a dataset up to date with its folder. Returns
+    None if the folder does not exist, lies outside the dataset folder root,
+    or is being scanned by another process, in which case the index is left
+    as is."""
+    if not dataset.folder_path or not (root := dataset_folder(dataset.folder_path)) or not os.path.isdir(root):
+        return None
+
+    # held until the session's transaction ends
+    if not (await session.execute(select(func.pg_try_advisory_xact_lock(
+            func.hashtext(DatasetFile.__tablename__), dataset.id
+    )))).scalar():
+        return None
+
+    indexed = dict((await session.execute(
+        select(DatasetDirectory.path, DatasetDirectory.mtime_ns).where(DatasetDirectory.dataset_id == dataset.id)
+    )).all())
+    scan = await run_in_threadpool(scan_folder, root, indexed, full)
+    result = ScanResult(directories_listed=len(scan.listed), directories_unchanged=scan.unchanged)
+
+    for directories in _batches(scan.removed):
+        result.files_removed += (await session.execute(delete(DatasetFile).where(
+            DatasetFile.dataset_id == dataset.id,
+            DatasetFile.directory.in_(directories),
+        ))).rowcount
+        await session.execute(delete(DatasetDirectory).where(
+            DatasetDirectory.dataset_id == dataset.id,
+            DatasetDirectory.path.in_(directories),
+        ))
+
+    indexed_files = {}
+    for directories in _batches(path for path in scan.listed if path in indexed):
+        rows = await session.execute(
+            select(DatasetFile.path, DatasetFile.size, DatasetFile.mtime_ns).where(
+                DatasetFile.dataset_id == dataset.id,
+                DatasetFile.directory.in_(directories),
+            )
+        )
+        indexed_files.update((row.path, (row.size, row.mtime_ns)) for row in rows)
+
+    listed_files = {
+        _join(directory, name): (directory, size, mtime_ns)
+        for directory, listing in scan.listed.items()
+        for name, (size, mtime_ns) in listing.files.items()
+    }
+
+    changed = [
+        path for path, (_, size, mtime_ns) in listed_files.items()
+        if indexed_files.get(path) != (size, mtime_ns)
+    ]
+    checksums = await run_in_threadpool(_checksums, root, changed) if FILE_INDEX_CHECKSUMS else {}
+    result.files_added = sum(path not in indexed_files for path in changed)
+    result.files_updated = len(changed) - result.files_added
+
+    file_rows = [
+        dict(
+            dataset_id=dataset.id,
+            path=path,
+            directory=listed_files[path][0],
+            size=listed_files[path][1],
+            mtime_ns=listed_files[path][2],
+            checksum=checksums.get(path),
+        )
+        for path in changed
+    ]
+    for rows in _batches(file_rows):
+        stmt = insert(DatasetFile).values(rows)
+        await session.execute(stmt.on_conflict_do_update(
+            index_elements=[DatasetFile.dataset_id, DatasetFile.path],
+            set_=dict(size=stmt.excluded.size, mtime_ns=stmt.excluded.mtime_ns, checksum=stmt.excluded.checksum),
+        ))
+
+    removed_files = [path for path in indexed_files if path not in listed_files]
+    result.files_removed += len(removed_files)
+    for paths in _batches(removed_files):
+        await session.execute(delete(DatasetFile).where(
+            DatasetFile.dataset_id == dataset.id,
+            DatasetFile.path.in_(paths),
+        ))
+
+    # directories listed again with the same modification time are left as
+    # is, so that an idle scan writes nothing
+    directory_rows = [
+        dict(dataset_id=dataset.id, path=directory, mtime_ns=listing.mtime_ns)
+        for directory, listing in scan.listed.items()
+        if directory not in indexed or indexed[directory] != listing.mtime_ns
+    ]
+    for rows in _batches(directory_rows):
+        stmt = insert(DatasetDirectory).values(rows)
+        await session.execute(stmt.on_conflict_do_update(
+            index_elements=[DatasetDirectory.dataset_id, DatasetDirectory.path],
+            set_=dict(mtime_ns=stmt.excluded.mtime_ns),
+        ))
+
+    return result
+
+
+async def clear_dataset_files(session: AsyncSession, dataset_id: int) -> None:
+    await session.execute(delete(DatasetFile).where(DatasetFile.dataset_id == dataset_id))
+    await session.execute(delete(DatasetDirectory).where(DatasetDirectory.dataset_id == dataset_id))
+
+
+async def index_dataset_folder(dataset_id: int) -> Optional[ScanResult]:
+    """Scan the folder of a dataset in a transaction of its own."""
+    # not an API session: directory bookkeeping does not appear in cached
+    # responses, so only changes to the indexed files invalidate them
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        if not (dataset := await session.get(Dataset, dataset_id)):
+            return None
+
+        result = await scan_dataset_files(session, dataset)
+        files_changed = result and (result.files_added or result.files_updated or result.files_removed)
+        if files_changed:
+            # delivered to listening processes only once the transaction commits
+            await session.execute(text(f'NOTIFY {CATALOG_CHANNEL}'))
+        await session.commit()
+
+    if files_changed:
+        response_cache.bump()
+
+    return result
+
+
+async def index_dataset_folders() -> None:
+    """Periodically scan the folders of all datasets. Runs until cancelled."""
+    if not DATASET_FOLDER_ROOT:
+        logger.info('SOMISANA_DATASET_FOLDER_ROOT is not set; dataset folders are not indexed')
+        return
+
+    while FILE_INDEX_INTERVAL:
+        await asyncio.sleep(FILE_INDEX_INTERVAL)
+
+        async with AsyncSessionLocal() as session:
+            dataset_ids = (await session.execute(
+                select(Dataset.id).where(Dataset.folder_path != None).order_by(Dataset.id)
+            )).scalars().all()
+
+        for dataset_id in dataset_ids:
+            try:
+                await index_dataset_folder(dataset_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Failed to index the files of dataset %d', dataset_id)
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import os
+import shutil
+from collections import defaultdict
+from typing import Iterable
+
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from somisana.api.lib.derivatives import rendition_folder
+from somisana.api.lib.files import remove_precompressed_variants
+from somisana.const import ResourceReferenceType
+from somisana.db import ApiSession, AsyncSessionLocal
+from somisana.db.models import Resource
+
+logger = logging.getLogger(__name__)
+
+
+def remove_resource_files(directory: str, references: list[str]) -> None:
+    """Remove resource files, together with their precompressed variants
+    and renditions. Runs in a worker thread."""
+    for reference in references:
+        file_path = f'{directory}/{reference}'
+        try:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            remove_precompressed_variants(file_path)
+            shutil.rmtree(f'{directory}/{rendition_folder(reference)}', ignore_errors=True)
+        except OSError as e:
+            logger.warning('Failed to remove resource file %s: %s', file_path, e)
+
+
+class FileRemover:
+    """Removes the files of deleted resources in a worker thread, so that
+    deleting requests need not wait for the filesystem."""
+
+    def __init__(self):
+        self._tasks: set[asyncio.Task] = set()
+
+    def submit(self, directory: str, references: list[str]) -> None:
+        task = asyncio.get_running_loop().create_task(self._run(directory, references))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def drain(self) -> None:
+        """Wait for all submitted removals to complete."""
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _run(self, directory: str, references: list[str]) -> None:
+        try:
+            # a file uploaded to the same path in the meantime belongs to another resource
+            async with AsyncSessionLocal() as session:
+                in_use = set((await session.execute(
+                    select(Resource.reference).where(
+                        Resource.reference.in_(references),
+                        Resource.reference_type == ResourceReferenceType.PATH.value,
+                    )
+                )).scalars())
+
+            await run_in_threadpool(
+                remove_resource_files, directory, [reference for reference in references if reference not in in_use]
+            )
+        except Exception:
+            logger.exception('Failed to remove %d resource files from %s', len(references), directory)
+
+
+file_remover = FileRemover()
+
+
+def schedule_file_removal(session: AsyncSession, directory: str, references: Iterable[str]) -> None:
+    """Remove resource files, given by their references relative to
+    ``directory``, once the session commits."""
+    session.info.setdefault('file_removals', []).extend((directory, reference) for reference in references)
+
+
+@event.listens_for(ApiSession, 'after_commit')
+def _submit_file_removals(session):
+    by_directory = defaultdict(list)
+    for directory, reference in session.info.pop('file_removals', []):
+        by_directory[directory].append(reference)
+
+    for directory, references in by_directory.items():
+        file_remover.submit(directory, references)
+
+
+@event.listens_for(ApiSession, 'after_rollback')
+def _discard_file_removals(session):
+    session.info.pop('file_removals', None)
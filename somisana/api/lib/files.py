@@ -0,0 +1,272 @@
+import os
+import stat
+import tempfile
+import zlib
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from mimetypes import guess_type
+from typing import Optional
+
+from sqlalchemy import select
+from starlette._utils import get_route_path
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, PlainTextResponse, Response
+from starlette.status import HTTP_304_NOT_MODIFIED, HTTP_404_NOT_FOUND, HTTP_405_METHOD_NOT_ALLOWED
+from starlette.types import Receive, Scope, Send
+
+from somisana.api.lib.compression import accepted_encodings, is_compressible_media_type
+from somisana.const import ResourceReferenceType
+from somisana.db import AsyncSessionLocal
+from somisana.db.models import Resource
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# lifetime in seconds for which clients may cache resource files
+RESOURCE_MAX_AGE = int(os.getenv('SOMISANA_RESOURCE_MAX_AGE', 86400))
+# maximum number of files whose stored checksum, or lack of one, is held in memory
+RESOURCE_CHECKSUM_CACHE_SIZE = int(os.getenv('SOMISANA_RESOURCE_CHECKSUM_CACHE_SIZE', 4096))
+# files smaller than this are not worth precompressing
+PRECOMPRESS_MIN_SIZE = 1024
+# number of bytes read from a file at a time while precompressing it
+PRECOMPRESS_CHUNK_SIZE = 1024 * 1024
+
+# content codings of precompressed variants, with their file suffixes,
+# in order of preference
+PRECOMPRESSED_ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def is_precompressible(path: str) -> bool:
+    """Whether a file is of a type given precompressed variants, judging by
+    its name."""
+    return is_compressible_media_type(guess_type(path)[0] or '')
+
+
+def _variant_compressor(encoding: str):
+    """Return the compress and finish functions of a streaming compressor
+    for the given content coding, at its highest level."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=11)
+        return compressor.process, compressor.finish
+
+    compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress, compressor.flush
+
+
+def write_precompressed_variants(file_path: str) -> None:
+    """Write compressed copies of a text file alongside it, for the file
+    server to send to clients that accept them. The file is read once, in
+    chunks, and a variant is kept only if it is smaller than the file.
+    Runs in a derivative worker process."""
+    if not is_precompressible(file_path) or os.path.getsize(file_path) < PRECOMPRESS_MIN_SIZE:
+        return
+
+    variants = []
+    try:
+        for encoding, suffix in PRECOMPRESSED_ENCODINGS:
+            if encoding == 'br' and brotli is None:
+                continue
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix='.', suffix='.part')
+            variants += [(suffix, temp_path, os.fdopen(fd, 'wb'), *_variant_compressor(encoding))]
+
+        size = 0
+        with open(file_path, 'rb') as f:
+            while chunk := f.read(PRECOMPRESS_CHUNK_SIZE):
+                size += len(chunk)
+                for _, _, variant_file, compress, _ in variants:
+                    variant_file.write(compress(chunk))
+
+        for suffix, temp_path, variant_file, _, finish in variants:
+            variant_file.write(finish())
+            variant_file.close()
+            if os.path.getsize(temp_path) < size:
+                os.replace(temp_path, file_path + suffix)
+    finally:
+        for _, temp_path, variant_file, _, _ in variants:
+            variant_file.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+def remove_precompressed_variants(file_path: str) -> None:
+    for _, suffix in PRECOMPRESSED_ENCODINGS:
+        if os.path.exists(file_path + suffix):
+            os.remove(file_path + suffix)
+
+
+def _file_stat(path: str) -> Optional[os.stat_result]:
+    try:
+        stat_result = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+    return stat_result if stat.S_ISREG(stat_result.st_mode) else None
+
+
+def _may_have_stored_checksum(relative_path: str) -> bool:
+    """Whether a file may be the file of a resource, rather than a
+    rendition or a precompressed variant, which are never stored."""
+    directories, _, name = relative_path.rpartition('/')
+    if any(directory.endswith('.renditions') for directory in directories.split('/')):
+        return False
+
+    return not any(name.endswith(suffix) for _, suffix in PRECOMPRESSED_ENCODINGS)
+
+
+class ResourceFileResponse(FileResponse):
+    """A FileResponse that leaves sending the file to the server when the
+    server supports the ASGI path send or zero-copy send extensions."""
+    chunk_size = 256 * 1024
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        extensions = scope.get('extensions') or {}
+        self.pathsend = 'http.response.pathsend' in extensions
+        self.zerocopysend = 'http.response.zerocopysend' in extensions
+        await super().__call__(scope, receive, send)
+
+    async def _handle_simple(self, send: Send, send_header_only: bool) -> None:
+        if send_header_only or not self.pathsend:
+            return await super()._handle_simple(send, send_header_only)
+
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        await send({'type': 'http.response.pathsend', 'path': str(self.path)})
+
+    def _should_use_range(self, http_if_range: str) -> bool:
+        # a weak ETag never validates a range
+        return not http_if_range.startswith('W/') and super()._should_use_range(http_if_range)
+
+    async def _handle_single_range(
+            self, send: Send, start: int, end: int, file_size: int, send_header_only: bool
+    ) -> None:
+        if send_header_only or not self.zerocopysend:
+            return await super()._handle_single_range(send, start, end, file_size, send_header_only)
+
+        self.headers['content-range'] = f'bytes {start}-{end - 1}/{file_size}'
+        self.headers['content-length'] = str(end - start)
+        await send({'type': 'http.response.start', 'status': 206, 'headers': self.raw_headers})
+        with open(self.path, 'rb') as file:
+            await send({'type': 'http.response.zerocopysend', 'file': file, 'offset': start, 'count': end - start})
+
+
+class ResourceFileServer:
+    """ASGI app serving the files under the local resource folder.
+
+    Responses carry a strong ETag derived from the checksum stored with the
+    resource, or a weak ETag derived from the file's modification time and
+    size if no checksum is stored for the file as it is. They support byte
+    ranges and conditional requests, and may be cached by clients for
+    ``RESOURCE_MAX_AGE`` seconds. Precompressed
+    variants of text files are sent to clients that accept them.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = os.path.realpath(directory)
+        # relative path -> (mtime_ns, size, checksum or None if not stored)
+        self._checksums: OrderedDict[str, tuple[int, int, Optional[str]]] = OrderedDict()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        assert scope['type'] == 'http'
+
+        if scope['method'] not in ('GET', 'HEAD'):
+            response = PlainTextResponse('Method Not Allowed', status_code=HTTP_405_METHOD_NOT_ALLOWED)
+        else:
+            response = await self.get_response(get_route_path(scope), Headers(scope=scope))
+
+        await response(scope, receive, send)
+
+    async def get_response(self, route_path: str, request_headers: Headers) -> Response:
+        relative_path = os.path.normpath(route_path.lstrip('/'))
+        full_path = os.path.realpath(os.path.join(self.directory, relative_path))
+        if os.path.commonpath([full_path, self.directory]) != self.directory or full_path == self.directory:
+            return PlainTextResponse('Not Found', status_code=HTTP_404_NOT_FOUND)
+
+        if not (stat_result := await run_in_threadpool(_file_stat, full_path)):
+            return PlainTextResponse('Not Found', status_code=HTTP_404_NOT_FOUND)
+
+        if checksum := await self.get_checksum(relative_path, stat_result):
+            validator, weak = checksum, ''
+        else:
+            validator, weak = f'{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}', 'W/'
+
+        headers = {'Cache-Control': f'public, max-age={RESOURCE_MAX_AGE}'}
+        send_path = full_path
+        send_stat = stat_result
+        etag = f'{weak}"{validator}"'
+
+        if is_precompressible(full_path):
+            headers['Vary'] = 'Accept-Encoding'
+            accepted = accepted_encodings(request_headers.get('accept-encoding'))
+            for encoding, suffix in PRECOMPRESSED_ENCODINGS:
+                if encoding not in accepted:
+                    continue
+                # ignore variants older than the file they were made from
+                variant_stat = await run_in_threadpool(_file_stat, full_path + suffix)
+                if variant_stat and variant_stat.st_mtime_ns >= stat_result.st_mtime_ns:
+                    headers['Content-Encoding'] = encoding
+                    send_path = full_path + suffix
+                    send_stat = variant_stat
+                    etag = f'{weak}"{validator}-{encoding}"'
+                    break
+
+        headers['ETag'] = etag
+        headers['Last-Modified'] = formatdate(stat_result.st_mtime, usegmt=True)
+
+        if self._is_not_modified(request_headers, etag, stat_result):
+            return Response(status_code=HTTP_304_NOT_MODIFIED, headers=headers)
+
+        return ResourceFileResponse(
+            send_path,
+            headers=headers,
+            media_type=guess_type(full_path)[0] or 'application/octet-stream',
+            stat_result=send_stat,
+        )
+
+    async def get_checksum(self, relative_path: str, stat_result: os.stat_result) -> Optional[str]:
+        """Return the SHA-256 checksum stored with the resource of a file, or
+        None if none is stored or the file no longer matches the stored
+        size. Files are never hashed while serving a request."""
+        if cached := self._checksums.get(relative_path):
+            mtime_ns, size, checksum = cached
+            if (mtime_ns, size) == (stat_result.st_mtime_ns, stat_result.st_size):
+                self._checksums.move_to_end(relative_path)
+                return checksum
+
+        checksum = None
+        if _may_have_stored_checksum(relative_path):
+            async with AsyncSessionLocal() as session:
+                stored = (await session.execute(
+                    select(Resource.checksum, Resource.size).where(
+                        Resource.reference == relative_path,
+                        Resource.reference_type == ResourceReferenceType.PATH.value,
+                        Resource.checksum != None,
+                    ).limit(1)
+                )).first()
+
+            if stored and stored.size == stat_result.st_size:
+                checksum = stored.checksum
+
+        self._checksums[relative_path] = (stat_result.st_mtime_ns, stat_result.st_size, checksum)
+        while len(self._checksums) > RESOURCE_CHECKSUM_CACHE_SIZE:
+            self._checksums.popitem(last=False)
+
+        return checksum
+
+    @staticmethod
+    def _is_not_modified(request_headers: Headers, etag: str, stat_result: os.stat_result) -> bool:
+        if if_none_match := request_headers.get('if-none-match'):
+            # If-None-Match uses the weak comparison function
+            return if_none_match.strip() == '*' or any(
+                tag.strip().removeprefix('W/') == etag.removeprefix('W/')
+                for tag in if_none_match.split(',')
+            )
+
+        if if_modified_since := request_headers.get('if-modified-since'):
+            try:
+                return int(stat_result.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+
+        return False
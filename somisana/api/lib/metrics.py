@@ -0,0 +1,213 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, \
+    generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+from sqlalchemy import event
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from somisana.db import async_engine
+from somisana.db.pool import pool_status
+
+# route label of requests that did not match any route
+UNMATCHED_ROUTE = 'unmatched'
+
+REQUEST_DURATION = Histogram(
+    'somisana_http_request_duration_seconds',
+    'Time taken to handle a request, including sending the response body',
+    ['method', 'route'],
+)
+REQUESTS = Counter(
+    'somisana_http_requests',
+    'Requests handled, by response status',
+    ['method', 'route', 'status'],
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    'somisana_http_requests_in_progress',
+    'Requests currently being handled',
+    ['method'],
+    multiprocess_mode='livesum',
+)
+REQUEST_DB_QUERIES = Histogram(
+    'somisana_http_request_db_queries',
+    'Database statements executed while handling a request',
+    ['method', 'route'],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 500),
+)
+REQUEST_DB_DURATION = Histogram(
+    'somisana_http_request_db_seconds',
+    'Time spent executing database statements while handling a request',
+    ['method', 'route'],
+)
+REQUEST_AUTH_DURATION = Histogram(
+    'somisana_http_request_auth_seconds',
+    'Time spent authorizing a request, including token introspection',
+    ['method', 'route'],
+)
+REQUEST_BODY_BYTES = Counter(
+    'somisana_http_request_body_bytes',
+    'Bytes received in request bodies, such as uploaded files',
+    ['method', 'route'],
+)
+DB_QUERIES = Counter(
+    'somisana_db_queries',
+    'Database statements executed by the API, within requests or not',
+)
+DB_DURATION = Counter(
+    'somisana_db_query_seconds',
+    'Time spent executing database statements by the API, within requests or not',
+)
+
+
+@dataclass
+class RequestMetrics:
+    """Resources used while handling a single request."""
+    db_queries: int = 0
+    db_seconds: float = 0.0
+    auth_seconds: float = 0.0
+    body_bytes: int = 0
+
+
+_request_metrics: ContextVar[Optional[RequestMetrics]] = ContextVar('request_metrics', default=None)
+
+
+def current_request_metrics() -> Optional[RequestMetrics]:
+    """Return the metrics of the request being handled, if any."""
+    return _request_metrics.get()
+
+
+@contextmanager
+def auth_timer() -> Iterator[None]:
+    """Record the time spent in the block against the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if request_metrics := _request_metrics.get():
+            request_metrics.auth_seconds += time.perf_counter() - start
+
+
+@event.listens_for(async_engine.sync_engine, 'before_cursor_execute')
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    context.somisana_query_start = time.perf_counter()
+
+
+@event.listens_for(async_engine.sync_engine, 'after_cursor_execute')
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - context.somisana_query_start
+    DB_QUERIES.inc()
+    DB_DURATION.inc(duration)
+
+    # the greenlet running the statement shares the request's context
+    if request_metrics := _request_metrics.get():
+        request_metrics.db_queries += 1
+        request_metrics.db_seconds += duration
+
+
+def _route_label(scope: Scope, root_path: str) -> str:
+    if route := scope.get('route'):
+        return route.path
+
+    # a mounted app, such as the local resource file server
+    if (mount_path := scope.get('root_path', '')) != root_path:
+        return mount_path.removeprefix(root_path)
+
+    return UNMATCHED_ROUTE
+
+
+class MetricsMiddleware:
+    """Records the latency, status, database usage, authorization time and
+    request body size of each HTTP request, labelled by the path template
+    of the route that handled it."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        method = scope['method']
+        root_path = scope.get('root_path', '')
+        request_metrics = RequestMetrics()
+        status_code = 500
+
+        async def receive_counting_bytes() -> Message:
+            message = await receive()
+            if message['type'] == 'http.request':
+                request_metrics.body_bytes += len(message.get('body', b''))
+            return message
+
+        async def send_recording_status(message: Message) -> None:
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        token = _request_metrics.set(request_metrics)
+        start = time.perf_counter()
+        try:
+            with REQUESTS_IN_PROGRESS.labels(method).track_inprogress():
+                await self.app(scope, receive_counting_bytes, send_recording_status)
+        finally:
+            duration = time.perf_counter() - start
+            _request_metrics.reset(token)
+
+            route = _route_label(scope, root_path)
+            REQUEST_DURATION.labels(method, route).observe(duration)
+            REQUESTS.labels(method, route, str(status_code)).inc()
+            REQUEST_DB_QUERIES.labels(method, route).observe(request_metrics.db_queries)
+            REQUEST_DB_DURATION.labels(method, route).observe(request_metrics.db_seconds)
+            REQUEST_AUTH_DURATION.labels(method, route).observe(request_metrics.auth_seconds)
+            if request_metrics.body_bytes:
+                REQUEST_BODY_BYTES.labels(method, route).inc(request_metrics.body_bytes)
+
+
+class PoolCollector:
+    """Exposes the state of the API's database connection pool, which
+    belongs to the process serving the scrape. When the metrics of several
+    worker processes are combined, the pool metrics are labelled with the
+    pid of that process."""
+
+    def __init__(self, multiprocess: bool = False):
+        self.labels = {'pid': str(os.getpid())} if multiprocess else {}
+
+    def _metric(self, metric_class, name: str, value: float):
+        metric = metric_class(f'somisana_db_pool_{name}', f'Connection pool {name.replace("_", " ")}',
+                              labels=list(self.labels))
+        metric.add_metric(list(self.labels.values()), value)
+        return metric
+
+    def collect(self):
+        status = pool_status(async_engine.sync_engine)
+        for name in 'size', 'checked_in', 'checked_out', 'overflow':
+            yield self._metric(GaugeMetricFamily, name, status[name])
+        for name in 'connections_opened', 'connections_closed', 'invalidations', 'checkouts', 'checkins', \
+                'timeouts', 'wait_seconds':
+            value = status['wait_seconds_total'] if name == 'wait_seconds' else status[name]
+            yield self._metric(CounterMetricFamily, name, value)
+
+
+REGISTRY.register(PoolCollector())
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    """Expose all metrics in the Prometheus text format. When the API runs
+    in several worker processes, each with PROMETHEUS_MULTIPROC_DIR set,
+    the metrics of all the workers are combined."""
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+        registry.register(PoolCollector(multiprocess=True))
+    else:
+        registry = REGISTRY
+
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
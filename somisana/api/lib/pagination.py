@@ -0,0 +1,63 @@
+from dataclasses import dataclass
+from typing import Annotated, Optional, Sequence
+
+from fastapi import Query
+from sqlalchemy import Select, and_, or_
+from sqlalchemy.orm import InstrumentedAttribute
+from sqlalchemy.sql.elements import ColumnElement
+from starlette.requests import Request
+
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+
+
+@dataclass
+class Page:
+    """Keyset pagination parameters. A page holds up to ``limit`` items
+    with an id greater than ``cursor``, in ascending id order."""
+    limit: int
+    cursor: Optional[int]
+
+
+async def page_params(
+        limit: Annotated[int, Query(ge=1, le=MAX_PAGE_LIMIT)] = DEFAULT_PAGE_LIMIT,
+        cursor: Annotated[Optional[int], Query(description='The id of the last item of the previous page')] = None,
+) -> Page:
+    """FastAPI dependency providing the requested page."""
+    return Page(limit=limit, cursor=cursor)
+
+
+def paginate(stmt: Select, id_column: InstrumentedAttribute, page: Page) -> Select:
+    """Restrict a select statement to the given page."""
+    if page.cursor is not None:
+        stmt = stmt.where(id_column > page.cursor)
+
+    return stmt.order_by(None).order_by(id_column).limit(page.limit)
+
+
+def paginate_ranked(
+        stmt: Select,
+        id_column: InstrumentedAttribute,
+        rank: ColumnElement,
+        cursor_rank: ColumnElement,
+        page: Page,
+) -> Select:
+    """Restrict a select statement to the given page of items in descending
+    order of ``rank``, then ascending id. The cursor is still the id of the
+    last item of the previous page; ``cursor_rank`` is a scalar expression
+    giving the rank of that item."""
+    if page.cursor is not None:
+        stmt = stmt.where(or_(rank < cursor_rank, and_(rank == cursor_rank, id_column > page.cursor)))
+
+    return stmt.order_by(None).order_by(rank.desc(), id_column).limit(page.limit)
+
+
+def next_page_headers(request: Request, items: Sequence, page: Page) -> dict[str, str]:
+    """Return a Link header pointing at the page following ``items``, if
+    there may be one. The link is relative to the origin, as cached
+    responses are served to clients using any host name."""
+    if len(items) < page.limit:
+        return {}
+
+    next_url = request.url.include_query_params(cursor=items[-1].id, limit=page.limit)
+    return {'Link': f'<{next_url.path}?{next_url.query}>; rel="next"'}
@@ -0,0 +1,271 @@
+import asyncio
+import logging
+import os
+import shutil
+import time
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from somisana.api.lib import local_resource_folder_path
+from somisana.api.lib.derivatives import rendition_folder
+from somisana.api.lib.files import PRECOMPRESSED_ENCODINGS
+from somisana.const import ResourceReferenceType
+from somisana.db import async_engine
+from somisana.db.models import ProductResource, DatasetResource, Resource, ResourceSweep
+
+logger = logging.getLogger(__name__)
+
+# seconds between sweeping one entity directory and the next; 0 disables the sweeper
+RESOURCE_SWEEP_INTERVAL = int(os.getenv('SOMISANA_RESOURCE_SWEEP_INTERVAL', 60))
+# seconds for which an unreferenced file is left alone after it was last
+# modified, and then kept in quarantine before it is deleted
+RESOURCE_SWEEP_GRACE_PERIOD = int(os.getenv('SOMISANA_RESOURCE_SWEEP_GRACE_PERIOD', 86400))
+# orphaned files are moved here, keeping their paths relative to the local resource folder
+RESOURCE_QUARANTINE_PATH = os.getenv('SOMISANA_RESOURCE_QUARANTINE_PATH', f'{local_resource_folder_path}.quarantine')
+
+# number of files looked up per query
+RESOURCE_SWEEP_BATCH_SIZE = 1000
+
+_RENDITION_FOLDER_SUFFIX = rendition_folder('')
+
+
+@dataclass
+class StoredFile:
+    # relative to the local resource folder
+    path: str
+    size: int
+    mtime_ns: int
+
+
+@dataclass
+class SweepResult:
+    # the entity directory swept, or None if the step ended a pass
+    directory: Optional[str] = None
+    files_quarantined: int = 0
+    bytes_quarantined: int = 0
+    files_deleted: int = 0
+    bytes_reclaimed: int = 0
+    resources_deleted: int = 0
+
+
+def _batches(items: list) -> Iterator[list]:
+    for i in range(0, len(items), RESOURCE_SWEEP_BATCH_SIZE):
+        yield items[i:i + RESOURCE_SWEEP_BATCH_SIZE]
+
+
+def candidate_references(path: str) -> list[str]:
+    """Return the resource references that would account for a stored file:
+    its own path, that of the file it is a precompressed variant of, and
+    that of the file whose renditions folder holds it."""
+    candidates = [path]
+    for _, suffix in PRECOMPRESSED_ENCODINGS:
+        if path.endswith(suffix):
+            candidates += [path.removesuffix(suffix)]
+
+    folders = path.split('/')[:-1]
+    for i, folder in enumerate(folders):
+        if folder.endswith(_RENDITION_FOLDER_SUFFIX):
+            candidates += ['/'.join([*folders[:i], folder.removesuffix(_RENDITION_FOLDER_SUFFIX)])]
+            break
+
+    return candidates
+
+
+def list_entity_directories(directory: str) -> list[str]:
+    """Return the paths, relative to ``directory``, of the folders holding
+    the files of each product and dataset, in sweep order."""
+    if not os.path.isdir(directory):
+        return []
+
+    entity_directories = []
+    for entity_type in os.scandir(directory):
+        if entity_type.is_dir(follow_symlinks=False):
+            entity_directories += [
+                f'{entity_type.name}/{entity.name}'
+                for entity in os.scandir(entity_type.path)
+                if entity.is_dir(follow_symlinks=False)
+            ]
+
+    return sorted(entity_directories)
+
+
+def list_files(directory: str, entity_directory: str) -> list[StoredFile]:
+    files = []
+    for folder, _, names in os.walk(f'{directory}/{entity_directory}'):
+        for name in names:
+            try:
+                file_stat = os.stat(f'{folder}/{name}', follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            files += [StoredFile(
+                path=os.path.relpath(f'{folder}/{name}', directory),
+                size=file_stat.st_size,
+                mtime_ns=file_stat.st_mtime_ns,
+            )]
+
+    return files
+
+
+def quarantine_files(directory: str, quarantine: str, files: list[StoredFile]) -> list[StoredFile]:
+    """Move files into the quarantine folder, stamping each with the time it
+    was quarantined. Files modified since they were listed are left alone.
+    Returns the files moved."""
+    moved = []
+    for file in files:
+        source = f'{directory}/{file.path}'
+        target = f'{quarantine}/{file.path}'
+        try:
+            if os.stat(source, follow_symlinks=False).st_mtime_ns != file.mtime_ns:
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.move(source, target)
+            os.utime(target)
+        except OSError as e:
+            logger.warning('Failed to quarantine resource file %s: %s', source, e)
+            continue
+
+        moved += [file]
+
+    return moved
+
+
+def purge_quarantine(quarantine: str, cutoff_ns: int) -> tuple[int, int]:
+    """Delete files quarantined before ``cutoff_ns``. Returns the number of
+    files deleted and the bytes reclaimed."""
+    files_deleted = bytes_reclaimed = 0
+    for folder, _, names in os.walk(quarantine):
+        for name in names:
+            try:
+                file_stat = os.stat(f'{folder}/{name}', follow_symlinks=False)
+                if file_stat.st_mtime_ns >= cutoff_ns:
+                    continue
+                os.remove(f'{folder}/{name}')
+            except OSError:
+                continue
+
+            files_deleted += 1
+            bytes_reclaimed += file_stat.st_size
+
+    remove_empty_folders(quarantine, cutoff_ns=None)
+    return files_deleted, bytes_reclaimed
+
+
+def remove_empty_folders(root: str, cutoff_ns: Optional[int]) -> None:
+    """Remove the empty folders under ``root``, and ``root`` itself, that
+    were last modified before ``cutoff_ns``. Without a cutoff, every empty
+    folder under ``root`` is removed, but ``root`` is kept."""
+    for folder, _, _ in os.walk(root, topdown=False):
+        if folder == root and cutoff_ns is None:
+            continue
+        try:
+            if cutoff_ns is None or os.stat(folder).st_mtime_ns < cutoff_ns:
+                os.rmdir(folder)
+        except OSError:
+            continue
+
+
+async def _referenced(session: AsyncSession, files: list[StoredFile]) -> set[str]:
+    candidates = {reference for file in files for reference in candidate_references(file.path)}
+    return set((await session.execute(
+        select(Resource.reference).where(
+            Resource.reference.in_(candidates),
+            Resource.reference_type == ResourceReferenceType.PATH.value,
+        )
+    )).scalars())
+
+
+async def _delete_unlinked_resources(session: AsyncSession) -> int:
+    return (await session.execute(
+        delete(Resource).where(
+            ~select(ProductResource.resource_id).where(ProductResource.resource_id == Resource.id).exists(),
+            ~select(DatasetResource.resource_id).where(DatasetResource.resource_id == Resource.id).exists(),
+        ),
+        execution_options={'synchronize_session': False},
+    )).rowcount
+
+
+async def sweep_next_directory(
+        session: AsyncSession,
+        directory: str = local_resource_folder_path,
+        quarantine: str = RESOURCE_QUARANTINE_PATH,
+) -> Optional[SweepResult]:
+    """Sweep the entity directory after the persisted cursor for files that
+    no resource references, moving those older than the grace period into
+    quarantine. Once the last directory has been swept, end the pass: delete
+    files quarantined for longer than the grace period, and resources linked
+    to no product or dataset, whose files the next pass will find.
+
+    Returns None if another process is sweeping the folder. The caller
+    commits the session, which saves the cursor and running totals.
+    """
+    # held until the session's transaction ends
+    if not (await session.execute(select(func.pg_try_advisory_xact_lock(
+            func.hashtext(ResourceSweep.__tablename__), func.hashtext(directory)
+    )))).scalar():
+        return None
+
+    await session.execute(insert(ResourceSweep).values(folder=directory).on_conflict_do_nothing())
+    sweep = await session.get(ResourceSweep, directory)
+
+    entity_directories = await run_in_threadpool(list_entity_directories, directory)
+    next_directory = next((path for path in entity_directories if sweep.cursor is None or path > sweep.cursor), None)
+    cutoff_ns = time.time_ns() - RESOURCE_SWEEP_GRACE_PERIOD * 1_000_000_000
+    result = SweepResult(directory=next_directory)
+
+    if next_directory is None:
+        result.files_deleted, result.bytes_reclaimed = await run_in_threadpool(purge_quarantine, quarantine, cutoff_ns)
+        result.resources_deleted = await _delete_unlinked_resources(session)
+        sweep.passes += 1
+    else:
+        orphans = []
+        for files in _batches(await run_in_threadpool(list_files, directory, next_directory)):
+            referenced = await _referenced(session, files)
+            orphans += [
+                file for file in files
+                if file.mtime_ns < cutoff_ns and referenced.isdisjoint(candidate_references(file.path))
+            ]
+
+        quarantined = await run_in_threadpool(quarantine_files, directory, quarantine, orphans)
+        await run_in_threadpool(remove_empty_folders, f'{directory}/{next_directory}', cutoff_ns)
+        result.files_quarantined = len(quarantined)
+        result.bytes_quarantined = sum(file.size for file in quarantined)
+
+    sweep.cursor = next_directory
+    sweep.files_quarantined += result.files_quarantined
+    sweep.bytes_quarantined += result.bytes_quarantined
+    sweep.files_deleted += result.files_deleted
+    sweep.bytes_reclaimed += result.bytes_reclaimed
+    sweep.resources_deleted += result.resources_deleted
+
+    return result
+
+
+async def sweep_resource_folder() -> None:
+    """Sweep the local resource folder one entity directory at a time, every
+    RESOURCE_SWEEP_INTERVAL seconds. Runs until cancelled."""
+    while RESOURCE_SWEEP_INTERVAL:
+        await asyncio.sleep(RESOURCE_SWEEP_INTERVAL)
+
+        try:
+            # not an API session: nothing the sweep deletes appears in cached responses
+            async with AsyncSession(async_engine, expire_on_commit=False) as session:
+                result = await sweep_next_directory(session)
+                await session.commit()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('Failed to sweep the local resource folder')
+            continue
+
+        if result and (result.files_quarantined or result.files_deleted or result.resources_deleted):
+            logger.info(
+                'Swept %s: quarantined %d files (%d bytes), deleted %d quarantined files (%d bytes reclaimed) '
+                'and %d unlinked resources',
+                result.directory or 'quarantine', result.files_quarantined, result.bytes_quarantined,
+                result.files_deleted, result.bytes_reclaimed, result.resources_deleted,
+            )
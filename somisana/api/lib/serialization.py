@@ -0,0 +1,79 @@
+import json
+import re
+from functools import cache
+from typing import Any
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+from starlette.responses import Response
+
+# Python writes floats below 1e-4 in magnitude in exponent notation with at
+# least two exponent digits (1e-05); orjson writes them positionally
+# (0.00001) or with a single exponent digit (1e-9). Bodies that may contain
+# such a number are serialized again by the standard encoder.
+_DIVERGENT_FLOAT = re.compile(rb'0\.0000|e-\d(?:[,\]}]|$)')
+
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+def standard_json(content: Any) -> bytes:
+    """Serialize content as FastAPI's JSONResponse does."""
+    return json.dumps(
+        jsonable_encoder(content),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(',', ':'),
+    ).encode('utf-8')
+
+
+@cache
+def _serializes_as_dict(model_class: type[BaseModel]) -> bool:
+    """Whether ``jsonable_encoder`` outputs a model of this class as the
+    instance's ``__dict__``, which holds the field values in order."""
+    return (
+            '__root__' not in model_class.__fields__
+            and not model_class.__config__.json_encoders
+            and all(field.alias == name for name, field in model_class.__fields__.items())
+    )
+
+
+def _default(obj: Any) -> Any:
+    # nested models are passed back to this function by orjson; this is
+    # much cheaper than BaseModel.dict(), which copies the whole tree
+    if isinstance(obj, BaseModel) and _serializes_as_dict(type(obj)):
+        return obj.__dict__
+
+    # datetimes, decimals and anything else orjson does not handle the same way
+    return jsonable_encoder(obj)
+
+
+def fast_json(content: Any) -> bytes:
+    """Serialize pydantic models, row dicts and other JSON-compatible content
+    directly to bytes with orjson, without the per-value traversal of
+    ``jsonable_encoder``.
+
+    The output is byte-for-byte the same as that of ``standard_json``,
+    except that non-finite floats, which the standard encoder refuses to
+    serialize, are written as null.
+    """
+    body = orjson.dumps(content, default=_default, option=_ORJSON_OPTIONS)
+    if _DIVERGENT_FLOAT.search(body):
+        return standard_json(content)
+
+    return body
+
+
+class FastJSONResponse(Response):
+    """A JSON response serialized with ``fast_json``.
+
+    Routes opt in by returning a ``FastJSONResponse`` of the model they have
+    built, which FastAPI then sends as is: the model is not validated again
+    against the route's ``response_model``, which only documents the schema.
+    The content must therefore be an instance of that model.
+    """
+    media_type = 'application/json'
+
+    def render(self, content: Any) -> bytes:
+        return fast_json(content)
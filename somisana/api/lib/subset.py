@@ -0,0 +1,258 @@
+import os
+import tempfile
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Iterator, Optional
+
+from fastapi import HTTPException
+from starlette.status import HTTP_413_REQUEST_ENTITY_TOO_LARGE, HTTP_422_UNPROCESSABLE_ENTITY
+
+from somisana.db.spatial import BoundingBox
+
+try:
+    import cftime
+    import numpy as np
+    import xarray as xr
+except ImportError:
+    cftime = np = xr = None
+
+# maximum number of bytes a subset request holds in memory: the size of the
+# selected data, or twice that if the subsets of several files are combined
+SUBSET_MAX_SIZE = int(os.getenv('SOMISANA_SUBSET_MAX_SIZE', 256 * 1024 ** 2))
+
+# number of rows per chunk of a streamed CSV subset
+CSV_CHUNK_ROWS = 10_000
+
+# coordinate roles, recognised by CF attributes or by common names
+COORDINATE_NAMES = {
+    'longitude': ('longitude', 'lon', 'lon_rho', 'nav_lon', 'x'),
+    'latitude': ('latitude', 'lat', 'lat_rho', 'nav_lat', 'y'),
+    'time': ('time', 'ocean_time', 't'),
+    'depth': ('depth', 'z', 'level', 'deptht', 's_rho'),
+}
+COORDINATE_AXES = {'longitude': 'X', 'latitude': 'Y', 'time': 'T', 'depth': 'Z'}
+
+
+@dataclass
+class SubsetQuery:
+    bbox: Optional[BoundingBox] = None
+    time_start: Optional[datetime] = None
+    time_end: Optional[datetime] = None
+    depth_min: Optional[float] = None
+    depth_max: Optional[float] = None
+    variables: Optional[list[str]] = None
+
+
+def _find_coordinate(ds: 'xr.Dataset', role: str) -> Optional[str]:
+    for name, variable in ds.variables.items():
+        if variable.attrs.get('standard_name') == role or variable.attrs.get('axis') == COORDINATE_AXES[role]:
+            return name
+
+    for name in COORDINATE_NAMES[role]:
+        if name in ds.variables:
+            return name
+
+    return None
+
+
+def _index_ranges(ds: 'xr.Dataset', coordinate: str, mask: 'np.ndarray') -> dict[str, slice]:
+    """Return, for each dimension of a coordinate, the smallest slice that
+    covers every point of the coordinate selected by ``mask``."""
+    dims = ds[coordinate].dims
+    if not mask.any():
+        return {dim: slice(0, 0) for dim in dims}
+
+    ranges = {}
+    for axis, dim in enumerate(dims):
+        other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+        selected = np.flatnonzero(mask.any(axis=other_axes) if other_axes else mask)
+        ranges[dim] = slice(int(selected[0]), int(selected[-1]) + 1)
+
+    return ranges
+
+
+def _merge_ranges(ranges: dict[str, slice], new_ranges: dict[str, slice]) -> None:
+    for dim, new_range in new_ranges.items():
+        if dim in ranges:
+            start = max(ranges[dim].start, new_range.start)
+            ranges[dim] = slice(start, max(start, min(ranges[dim].stop, new_range.stop)))
+        else:
+            ranges[dim] = new_range
+
+
+def _lon_mask(lon: 'np.ndarray', west: float, east: float) -> 'np.ndarray':
+    """Select the longitudes, normalized to [-180, 180), that lie between
+    ``west`` and ``east``. -180° is also selected by a box ending at 180°."""
+    def between(values):
+        if west <= east:
+            return (values >= west) & (values <= east)
+        return (values >= west) | (values <= east)
+
+    return between(lon) | ((lon == -180) & between(np.full_like(lon, 180)))
+
+
+def _time_bound(time: 'np.ndarray', value: datetime):
+    """Convert a query time to compare with the values of a time coordinate:
+    a naive UTC time, as a datetime64 or as a date in the calendar of the
+    file for times that xarray decodes to cftime objects."""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+
+    if time.dtype.kind == 'M':
+        return np.datetime64(value)
+
+    if time.dtype.kind != 'O' or not isinstance(time.flat[0], cftime.datetime):
+        raise HTTPException(HTTP_422_UNPROCESSABLE_ENTITY, 'The time coordinate of the dataset is not decoded as dates')
+
+    calendar = time.flat[0].calendar
+    try:
+        return cftime.datetime(*value.timetuple()[:6], value.microsecond, calendar=calendar)
+    except ValueError:
+        raise HTTPException(HTTP_422_UNPROCESSABLE_ENTITY, f'{value} is not a valid date in the {calendar} calendar')
+
+
+def _selection(ds: 'xr.Dataset', query: SubsetQuery) -> dict[str, slice]:
+    """Work out the index ranges selected by a query from the coordinate
+    variables alone, which are small compared to the data variables."""
+    ranges = {}
+
+    if query.bbox:
+        lon_name, lat_name = _find_coordinate(ds, 'longitude'), _find_coordinate(ds, 'latitude')
+        if not (lon_name and lat_name):
+            raise HTTPException(HTTP_422_UNPROCESSABLE_ENTITY, 'The dataset has no longitude and latitude coordinates')
+
+        lon = (ds[lon_name].values + 180) % 360 - 180
+        lat = ds[lat_name].values
+        lon_mask = _lon_mask(lon, query.bbox.west, query.bbox.east)
+        lat_mask = (lat >= query.bbox.south) & (lat <= query.bbox.north)
+
+        if ds[lon_name].dims == ds[lat_name].dims:
+            # curvilinear grid
+            _merge_ranges(ranges, _index_ranges(ds, lon_name, lon_mask & lat_mask))
+        else:
+            _merge_ranges(ranges, _index_ranges(ds, lon_name, lon_mask))
+            _merge_ranges(ranges, _index_ranges(ds, lat_name, lat_mask))
+
+    if query.time_start or query.time_end:
+        if not (time_name := _find_coordinate(ds, 'time')):
+            raise HTTPException(HTTP_422_UNPROCESSABLE_ENTITY, 'The dataset has no time coordinate')
+
+        time = ds[time_name].values
+        time_mask = np.ones(time.shape, dtype=bool)
+        if time.size and query.time_start:
+            time_mask &= time >= _time_bound(time, query.time_start)
+        if time.size and query.time_end:
+            time_mask &= time <= _time_bound(time, query.time_end)
+        _merge_ranges(ranges, _index_ranges(ds, time_name, time_mask))
+
+    if query.depth_min is not None or query.depth_max is not None:
+        if not (depth_name := _find_coordinate(ds, 'depth')):
+            raise HTTPException(HTTP_422_UNPROCESSABLE_ENTITY, 'The dataset has no depth coordinate')
+
+        depth = ds[depth_name].values
+        depth_mask = np.ones(depth.shape, dtype=bool)
+        if query.depth_min is not None:
+            depth_mask &= depth >= query.depth_min
+        if query.depth_max is not None:
+            depth_mask &= depth <= query.depth_max
+        _merge_ranges(ranges, _index_ranges(ds, depth_name, depth_mask))
+
+    return ranges
+
+
+def _subset_file(path: str, query: SubsetQuery) -> Optional['xr.Dataset']:
+    # data variables are read lazily: indexing a backend array reads only
+    # the selected hyperslab, and so only the chunks that overlap it
+    opened = xr.open_dataset(path, chunks=None, cache=False)
+    try:
+        ds = opened
+        if query.variables:
+            if unknown := set(query.variables) - set(ds.data_vars):
+                raise HTTPException(HTTP_422_UNPROCESSABLE_ENTITY, f'Unknown variables: {", ".join(sorted(unknown))}')
+            ds = ds[query.variables]
+
+        ranges = _selection(ds, query)
+    except BaseException:
+        opened.close()
+        raise
+
+    if any(r.stop <= r.start for r in ranges.values()):
+        opened.close()
+        return None
+
+    # a selection does not inherit the file handle of the dataset it is taken from
+    subset = ds.isel(ranges)
+    subset.set_close(opened.close)
+    return subset
+
+
+def _subset_size(ds: 'xr.Dataset') -> int:
+    return sum(variable.size * variable.dtype.itemsize for variable in ds.variables.values())
+
+
+def subset_files(paths: list[str], query: SubsetQuery) -> Optional['xr.Dataset']:
+    """Subset each of the given NetCDF files and combine the results along
+    the time dimension. Raises a 413 error if the request would hold more
+    than ``SUBSET_MAX_SIZE`` bytes in memory, before any data variable is
+    read."""
+    subsets = []
+    size = 0
+    try:
+        for path in paths:
+            if (subset := _subset_file(path, query)) is None:
+                continue
+
+            subsets += [subset]
+            size += _subset_size(subset)
+            # the subsets of several files are loaded, then copied into the combined subset
+            if size * min(len(subsets), 2) > SUBSET_MAX_SIZE:
+                raise HTTPException(
+                    HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    f'The subset would need more than {SUBSET_MAX_SIZE} bytes of memory; narrow the request',
+                )
+
+        if not subsets:
+            return None
+
+        loaded = [subset.load() for subset in subsets]
+    finally:
+        for subset in subsets:
+            subset.close()
+
+    if len(loaded) == 1:
+        return loaded[0]
+
+    if not (time_name := _find_coordinate(loaded[0], 'time')) or time_name not in loaded[0].dims:
+        raise HTTPException(HTTP_422_UNPROCESSABLE_ENTITY, 'Subsets of several files can only be combined along time')
+
+    return xr.concat(loaded, dim=time_name)
+
+
+def write_netcdf(ds: 'xr.Dataset') -> str:
+    """Write a subset to a temporary NetCDF file, returning its path."""
+    fd, path = tempfile.mkstemp(suffix='.nc')
+    os.close(fd)
+    try:
+        ds.to_netcdf(path)
+    except BaseException:
+        os.remove(path)
+        raise
+
+    return path
+
+
+def iter_csv(ds: 'xr.Dataset') -> Iterator[bytes]:
+    """Yield a subset as CSV, one row per grid point, in chunks. Rows are
+    built one time step at a time, so that the tabular form of the whole
+    subset is never held in memory."""
+    if (time_name := _find_coordinate(ds, 'time')) and time_name in ds.dims:
+        steps = [ds.isel({time_name: slice(i, i + 1)}) for i in range(ds.sizes[time_name])]
+    else:
+        steps = [ds]
+
+    header = True
+    for step in steps:
+        df = step.to_dataframe().reset_index()
+        for start in range(0, len(df), CSV_CHUNK_ROWS):
+            yield df.iloc[start:start + CSV_CHUNK_ROWS].to_csv(index=False, header=header).encode()
+            header = False
@@ -1,3 +1,6 @@
-from .product import ProductModel, ProductOut, CatalogProductModel
-from .dataset import DatasetModel, DatasetInModel
-from .resource import ResourceModel, ProductResourceModel, SimulationResourceModel
+from .product import ProductModel, ProductOut, CatalogProductModel, ProductSearchModel, ProductIngestModel, \
+    ProductIngestResultModel, ProductVersionModel, ProductLineageModel
+from .dataset import DatasetModel, DatasetInModel, DatasetIngestModel, DatasetIngestResultModel, DatasetFileModel, \
+    DatasetFileScanModel
+from .resource import ResourceModel, ProductResourceModel, SimulationResourceModel, LinkResourceModel
+from .instrumentation import PoolStatusModel, ResourceSweepModel
@@ -1,9 +1,10 @@
+from datetime import datetime
 from typing import Optional, List
 
 from pydantic import BaseModel
 
 from somisana.const import DatasetType
-from .resource import ResourceModel
+from .resource import ResourceModel, LinkResourceModel
 
 
 class DatasetInModel(BaseModel):
@@ -27,3 +28,34 @@ class DatasetModel(BaseModel):
     data_access_urls: Optional[List[ResourceModel]]
     cover_images: Optional[List[ResourceModel]]
 
+
+
+class DatasetIngestModel(BaseModel):
+    identifier: str
+    type: DatasetType
+    title: str
+    folder_path: Optional[str]
+    visualize: bool
+    resources: List[LinkResourceModel] = []
+
+
+class DatasetIngestResultModel(BaseModel):
+    id: int
+    identifier: str
+    resource_ids: List[int]
+
+
+class DatasetFileModel(BaseModel):
+    id: int
+    path: str
+    size: int
+    modified: datetime
+    checksum: Optional[str]
+
+
+class DatasetFileScanModel(BaseModel):
+    directories_listed: int
+    directories_unchanged: int
+    files_added: int
+    files_updated: int
+    files_removed: int
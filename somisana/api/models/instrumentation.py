@@ -0,0 +1,30 @@
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class PoolStatusModel(BaseModel):
+    size: int
+    max_overflow: int
+    timeout: float
+    checked_in: int
+    checked_out: int
+    overflow: int
+    connections_opened: int
+    connections_closed: int
+    invalidations: int
+    checkouts: int
+    checkins: int
+    timeouts: int
+    wait_seconds_total: float
+    wait_seconds_max: float
+
+
+class ResourceSweepModel(BaseModel):
+    cursor: Optional[str]
+    passes: int
+    files_quarantined: int
+    bytes_quarantined: int
+    files_deleted: int
+    bytes_reclaimed: int
+    resources_deleted: int
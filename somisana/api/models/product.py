@@ -2,8 +2,8 @@ from typing import Optional
 
 from pydantic import BaseModel
 
-from .dataset import DatasetModel
-from .resource import ResourceModel
+from .dataset import DatasetModel, DatasetIngestModel, DatasetIngestResultModel
+from .resource import ResourceModel, LinkResourceModel
 
 
 class ProductModel(BaseModel):
@@ -36,3 +36,40 @@ class CatalogProductModel(BaseModel):
     description: str
     doi: Optional[str]
     thumbnail: Optional[ResourceModel]
+
+
+class ProductIngestModel(ProductModel):
+    datasets: list[DatasetIngestModel] = []
+    resources: list[LinkResourceModel] = []
+
+
+class ProductIngestResultModel(BaseModel):
+    id: int
+    resource_ids: list[int]
+    datasets: list[DatasetIngestResultModel]
+
+
+class ProductSearchModel(CatalogProductModel):
+    north_bound: float
+    south_bound: float
+    east_bound: float
+    west_bound: float
+    # set for text searches
+    rank: Optional[float]
+    # plain text fragments of the description, with matching terms
+    # wrapped in « and »; not HTML, so it must be escaped for display
+    snippet: Optional[str]
+
+
+class ProductVersionModel(BaseModel):
+    id: int
+    title: str
+    doi: Optional[str]
+    # relative to the requested product: negative for older versions
+    generation: int
+
+
+class ProductLineageModel(BaseModel):
+    product_id: int
+    latest_product_id: int
+    versions: list[ProductVersionModel]
@@ -13,6 +13,12 @@ class ResourceModel(BaseModel):
     reference_type: Optional[ResourceReferenceType]
 
 
+class LinkResourceModel(BaseModel):
+    title: Optional[str]
+    reference: str
+    resource_type: ResourceType
+
+
 class ProductResourceModel(ResourceModel):
     product_id: int
 
@@ -1,14 +1,30 @@
-from typing import Annotated
-
-from fastapi import APIRouter, HTTPException, Depends, Query, UploadFile, File
-from starlette.status import HTTP_404_NOT_FOUND
-
-from somisana.api.lib import save_file_resource, delete_local_resource_file
+import os
+from datetime import datetime, timezone
+from typing import Annotated, Literal, Optional
+
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, Response, UploadFile, File
+from fastapi.responses import FileResponse, StreamingResponse
+from sqlalchemy import Select, delete, exists, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.background import BackgroundTask
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from starlette.status import HTTP_404_NOT_FOUND, HTTP_409_CONFLICT, HTTP_422_UNPROCESSABLE_ENTITY, \
+    HTTP_501_NOT_IMPLEMENTED
+
+from somisana.api.lib import save_file_resource, schedule_resource_file_removal
 from somisana.api.lib.auth import Authorize
-from somisana.api.models import DatasetModel, ResourceModel, DatasetInModel
-from somisana.const import SOMISANAScope, EntityType, ResourceType, ResourceReferenceType
-from somisana.db import Session
-from somisana.db.models import Dataset, DatasetResource, Resource
+from somisana.api.lib.cache import CacheLookup, response_cache_lookup
+from somisana.api.lib.file_index import scan_dataset_files, clear_dataset_files, dataset_folder
+from somisana.api.lib.pagination import Page, page_params, paginate, next_page_headers
+from somisana.api.lib.serialization import FastJSONResponse
+from somisana.api.lib.subset import SubsetQuery, subset_files, write_netcdf, iter_csv, xr
+from somisana.api.models import DatasetModel, ResourceModel, DatasetInModel, DatasetFileModel, DatasetFileScanModel
+from somisana.const import SOMISANAScope, EntityType, ResourceType, ResourceReferenceType, DatasetType
+from somisana.db import get_session
+from somisana.db.deletes import delete_owned_resources
+from somisana.db.loaders import dataset_graph_options
+from somisana.db.models import Dataset, DatasetResource, Resource, ProductVersion, DatasetFile
+from somisana.db.spatial import BoundingBox
 
 router = APIRouter()
 
@@ -17,10 +33,22 @@ router = APIRouter()
     '/all',
     dependencies=[Depends(Authorize(SOMISANAScope.DATASET_READ))]
 )
-async def list_datasets():
-    all_datasets = Session.query(Dataset).all()
+async def list_datasets(
+        request: Request,
+        session: Annotated[AsyncSession, Depends(get_session)],
+        cache: Annotated[CacheLookup, Depends(response_cache_lookup)],
+        page: Annotated[Page, Depends(page_params)],
+        dataset_type: Annotated[Optional[DatasetType], Query(alias='type')] = None,
+        visualize: Optional[bool] = None,
+        superseded: Annotated[Optional[bool], Query(description='Filter on whether the product is superseded')] = None,
+):
+    if cache.response:
+        return cache.response
 
-    return all_datasets
+    stmt = filter_datasets(select(Dataset), dataset_type, visualize, superseded)
+    all_datasets = (await session.execute(paginate(stmt, Dataset.id, page))).scalars().all()
+
+    return cache.store(all_datasets, headers=next_page_headers(request, all_datasets, page))
 
 
 @router.get(
@@ -28,9 +56,18 @@ async def list_datasets():
     dependencies=[Depends(Authorize(SOMISANAScope.DATASET_READ))]
 )
 async def list_product_datasets(
-        product_id: int
+        request: Request,
+        response: Response,
+        product_id: int,
+        session: Annotated[AsyncSession, Depends(get_session)],
+        page: Annotated[Page, Depends(page_params)],
+        dataset_type: Annotated[Optional[DatasetType], Query(alias='type')] = None,
+        visualize: Optional[bool] = None,
 ):
-    product_datasets = Session.query(Dataset).filter(Dataset.product_id == product_id).all()
+    stmt = filter_datasets(select(Dataset).where(Dataset.product_id == product_id), dataset_type, visualize)
+    product_datasets = (await session.execute(paginate(stmt, Dataset.id, page))).scalars().all()
+
+    response.headers.update(next_page_headers(request, product_datasets, page))
 
     return product_datasets
 
@@ -42,11 +79,12 @@ async def list_product_datasets(
 )
 async def get_dataset(
         dataset_id: int,
-) -> DatasetModel:
-    if not (dataset := Session.get(Dataset, dataset_id)):
+        session: Annotated[AsyncSession, Depends(get_session)],
+) -> FastJSONResponse:
+    if not (dataset := await session.get(Dataset, dataset_id, options=dataset_graph_options())):
         raise HTTPException(HTTP_404_NOT_FOUND)
 
-    return DatasetModel(
+    return FastJSONResponse(DatasetModel(
         id=dataset.id,
         product_id=dataset.product_id,
         title=dataset.title,
@@ -76,7 +114,7 @@ async def get_dataset(
             for resource in dataset.resources
             if resource.resource_type in [ResourceType.COVER_IMAGE, ResourceType.COVER_CLIP]
         ],
-    )
+    ))
 
 
 @router.post(
@@ -84,7 +122,8 @@ async def get_dataset(
     dependencies=[Depends(Authorize(SOMISANAScope.DATASET_ADMIN))]
 )
 async def create_dataset(
-        dataset_in: DatasetInModel
+        dataset_in: DatasetInModel,
+        session: Annotated[AsyncSession, Depends(get_session)],
 ) -> int:
     dataset = Dataset(
         product_id=dataset_in.product_id,
@@ -95,7 +134,7 @@ async def create_dataset(
         identifier=dataset_in.identifier,
     )
 
-    dataset.save()
+    await dataset.save(session)
 
     return dataset.id
 
@@ -106,11 +145,16 @@ async def create_dataset(
 )
 async def update_dataset(
         dataset_id: int,
-        dataset_in: DatasetInModel
+        dataset_in: DatasetInModel,
+        session: Annotated[AsyncSession, Depends(get_session)],
 ):
-    if not (dataset := Session.get(Dataset, dataset_id)):
+    if not (dataset := await session.get(Dataset, dataset_id)):
         raise HTTPException(HTTP_404_NOT_FOUND)
 
+    # the file index belongs to the previous folder
+    if dataset.folder_path != dataset_in.folder_path:
+        await clear_dataset_files(session, dataset_id)
+
     dataset.product_id = dataset_in.product_id
     dataset.title = dataset_in.title
     dataset.folder_path = dataset_in.folder_path
@@ -118,7 +162,7 @@ async def update_dataset(
     dataset.identifier = dataset_in.identifier
     dataset.visualize = dataset_in.visualize
 
-    dataset.save()
+    await dataset.save(session)
 
 
 @router.delete(
@@ -126,17 +170,148 @@ async def update_dataset(
     dependencies=[Depends(Authorize(SOMISANAScope.DATASET_ADMIN))]
 )
 async def delete_dataset(
-        dataset_id: int
+        dataset_id: int,
+        session: Annotated[AsyncSession, Depends(get_session)],
+):
+    deleted_resources = (await session.execute(
+        delete_owned_resources(dataset_ids=[dataset_id]),
+        execution_options={'synchronize_session': False},
+    )).all()
+
+    # indexed files and directories go by ON DELETE CASCADE
+    if not (await session.execute(
+            delete(Dataset).where(Dataset.id == dataset_id).returning(Dataset.id),
+            execution_options={'synchronize_session': False},
+    )).first():
+        raise HTTPException(HTTP_404_NOT_FOUND)
+
+    schedule_resource_file_removal(session, deleted_resources)
+
+
+@router.get(
+    '/{dataset_id}/files',
+    response_model=list[DatasetFileModel],
+    dependencies=[Depends(Authorize(SOMISANAScope.DATASET_READ))]
+)
+async def list_dataset_files(
+        request: Request,
+        dataset_id: int,
+        session: Annotated[AsyncSession, Depends(get_session)],
+        cache: Annotated[CacheLookup, Depends(response_cache_lookup)],
+        page: Annotated[Page, Depends(page_params)],
 ):
-    if not (dataset := Session.get(Dataset, dataset_id)):
+    if cache.response:
+        return cache.response
+
+    if not (await session.get(Dataset, dataset_id)):
         raise HTTPException(HTTP_404_NOT_FOUND)
 
-    # First delete all uploaded files for that dataset
-    for resource in dataset.resources:
-        if resource.reference_type == ResourceReferenceType.PATH:
-            delete_local_resource_file(resource.reference)
+    stmt = select(DatasetFile).where(DatasetFile.dataset_id == dataset_id)
+    dataset_files = (await session.execute(paginate(stmt, DatasetFile.id, page))).scalars().all()
 
-    dataset.delete()
+    return cache.store([
+        DatasetFileModel(
+            id=dataset_file.id,
+            path=dataset_file.path,
+            size=dataset_file.size,
+            modified=datetime.fromtimestamp(dataset_file.mtime_ns / 1e9, timezone.utc),
+            checksum=dataset_file.checksum,
+        )
+        for dataset_file in dataset_files
+    ], headers=next_page_headers(request, dataset_files, page))
+
+
+@router.post(
+    '/{dataset_id}/files/scan',
+    response_model=DatasetFileScanModel,
+    dependencies=[Depends(Authorize(SOMISANAScope.DATASET_ADMIN))]
+)
+async def scan_dataset_folder(
+        dataset_id: int,
+        session: Annotated[AsyncSession, Depends(get_session)],
+        full: Annotated[bool, Query(description='List every directory, not only those that have changed')] = False,
+):
+    if not (dataset := await session.get(Dataset, dataset_id)):
+        raise HTTPException(HTTP_404_NOT_FOUND)
+
+    if not (result := await scan_dataset_files(session, dataset, full)):
+        raise HTTPException(HTTP_409_CONFLICT, 'The dataset folder does not exist, lies outside the dataset '
+                                               'folder root, or is already being scanned')
+
+    return DatasetFileScanModel(**vars(result))
+
+
+@router.get(
+    '/{dataset_id}/subset',
+    dependencies=[Depends(Authorize(SOMISANAScope.DATASET_READ))]
+)
+async def subset_dataset(
+        dataset_id: int,
+        session: Annotated[AsyncSession, Depends(get_session)],
+        bbox: Annotated[Optional[str], Query(
+            description='Bounding box as west,south,east,north in decimal degrees; '
+                        'west may be greater than east for a box crossing the antimeridian',
+            example='16,-35,33,-22',
+        )] = None,
+        time_start: Optional[datetime] = None,
+        time_end: Optional[datetime] = None,
+        depth_min: Optional[float] = None,
+        depth_max: Optional[float] = None,
+        variables: Annotated[Optional[list[str]], Query(
+            alias='variable',
+            description='Variables to include; all variables if not given',
+        )] = None,
+        output_format: Annotated[Literal['netcdf', 'csv'], Query(alias='format')] = 'netcdf',
+):
+    """Return a subset of the NetCDF files indexed for the dataset, combined
+    along time. Only the selected part of each file is read, and requests
+    that would hold more than ``SOMISANA_SUBSET_MAX_SIZE`` bytes in memory
+    are refused."""
+    if xr is None:
+        raise HTTPException(HTTP_501_NOT_IMPLEMENTED, 'NetCDF subsetting is not available on this server')
+
+    if not (dataset := await session.get(Dataset, dataset_id)):
+        raise HTTPException(HTTP_404_NOT_FOUND)
+
+    try:
+        bounding_box = BoundingBox.parse(bbox) if bbox else None
+    except ValueError as e:
+        raise HTTPException(HTTP_422_UNPROCESSABLE_ENTITY, str(e))
+
+    paths = (await session.execute(
+        select(DatasetFile.path).where(
+            DatasetFile.dataset_id == dataset_id,
+            DatasetFile.path.endswith('.nc'),
+        ).order_by(DatasetFile.path)
+    )).scalars().all()
+    if not dataset.folder_path or not paths or not (root := dataset_folder(dataset.folder_path)):
+        raise HTTPException(HTTP_404_NOT_FOUND, 'No NetCDF files are indexed for the dataset')
+
+    subset = await run_in_threadpool(subset_files, [os.path.join(root, path) for path in paths], SubsetQuery(
+        bbox=bounding_box,
+        time_start=time_start,
+        time_end=time_end,
+        depth_min=depth_min,
+        depth_max=depth_max,
+        variables=variables,
+    ))
+    if subset is None:
+        raise HTTPException(HTTP_404_NOT_FOUND, 'The subset contains no data')
+
+    if output_format == 'csv':
+        return StreamingResponse(
+            iterate_in_threadpool(iter_csv(subset)),
+            media_type='text/csv',
+            headers={'Content-Disposition': f'attachment; filename="dataset-{dataset_id}-subset.csv"'},
+        )
+
+    subset_path = await run_in_threadpool(write_netcdf, subset)
+    return FileResponse(
+        subset_path,
+        media_type='application/x-netcdf',
+        filename=f'dataset-{dataset_id}-subset.nc',
+        background=BackgroundTask(os.remove, subset_path),
+    )
 
 
 @router.post(
@@ -146,8 +321,9 @@ async def delete_dataset(
 async def add_resource(
         dataset_id: int,
         resource_in: ResourceModel,
+        session: Annotated[AsyncSession, Depends(get_session)],
 ):
-    if not (Session.get(Dataset, dataset_id)):
+    if not (await session.get(Dataset, dataset_id)):
         raise HTTPException(HTTP_404_NOT_FOUND)
 
     resource = Resource(
@@ -157,12 +333,12 @@ async def add_resource(
         reference_type=ResourceReferenceType.LINK
     )
 
-    resource.save()
+    await resource.save(session)
 
-    DatasetResource(
+    await DatasetResource(
         dataset_id=dataset_id,
         resource_id=resource.id
-    ).save()
+    ).save(session)
 
     return resource.id
 
@@ -174,21 +350,42 @@ async def add_resource(
 async def add_file_resource(
         dataset_id: int,
         resource_query: Annotated[ResourceModel, Query()],
-        file: Annotated[UploadFile, File()]
+        file: Annotated[UploadFile, File()],
+        session: Annotated[AsyncSession, Depends(get_session)],
 ):
-    if not (Session.get(Dataset, dataset_id)):
+    if not (await session.get(Dataset, dataset_id)):
         raise HTTPException(HTTP_404_NOT_FOUND)
 
-    resource_id = save_file_resource(
+    resource_id = await save_file_resource(
+        session=session,
         file=file,
         resource_model=ResourceModel(**resource_query.dict()),
         entity_type=EntityType.DATASET,
         entity_id=dataset_id,
     )
 
-    DatasetResource(
+    await DatasetResource(
         dataset_id=dataset_id,
         resource_id=resource_id,
-    ).save()
+    ).save(session)
 
     return resource_id
+
+
+def filter_datasets(
+        stmt: Select,
+        dataset_type: Optional[DatasetType] = None,
+        visualize: Optional[bool] = None,
+        superseded: Optional[bool] = None,
+) -> Select:
+    if dataset_type is not None:
+        stmt = stmt.where(Dataset.type == dataset_type.value)
+
+    if visualize is not None:
+        stmt = stmt.where(Dataset.visualize == visualize)
+
+    if superseded is not None:
+        product_superseded = exists().where(ProductVersion.superseded_product_id == Dataset.product_id)
+        stmt = stmt.where(product_superseded if superseded else ~product_superseded)
+
+    return stmt
@@ -0,0 +1,55 @@
+from typing import Annotated
+
+from fastapi import APIRouter, Depends
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from somisana.api.lib import local_resource_folder_path
+from somisana.api.lib.auth import Authorize
+from somisana.api.models import PoolStatusModel, ResourceSweepModel
+from somisana.const import SOMISANAScope
+from somisana.db import DB_MAX_OVERFLOW, async_engine, get_session
+from somisana.db.models import ResourceSweep
+from somisana.db.pool import pool_status
+
+router = APIRouter()
+
+
+@router.get(
+    '/pool',
+    response_model=PoolStatusModel,
+    dependencies=[Depends(Authorize(SOMISANAScope.PRODUCT_ADMIN))]
+)
+async def get_pool_status() -> PoolStatusModel:
+    """Return the state of the API's database connection pool: connections
+    held open and checked out, overflow in use, and counters of checkouts,
+    time spent waiting for a connection and checkouts that timed out."""
+    return PoolStatusModel(
+        max_overflow=DB_MAX_OVERFLOW,
+        **pool_status(async_engine.sync_engine),
+    )
+
+
+@router.get(
+    '/resource_sweep',
+    response_model=ResourceSweepModel,
+    dependencies=[Depends(Authorize(SOMISANAScope.PRODUCT_ADMIN))]
+)
+async def get_resource_sweep_status(
+        session: Annotated[AsyncSession, Depends(get_session)],
+) -> ResourceSweepModel:
+    """Return the progress of the sweep for orphaned files under the local
+    resource folder, with the files quarantined, files deleted, bytes
+    reclaimed and unlinked resources deleted since it began."""
+    if not (sweep := await session.get(ResourceSweep, local_resource_folder_path)):
+        return ResourceSweepModel(cursor=None, passes=0, files_quarantined=0, bytes_quarantined=0,
+                                  files_deleted=0, bytes_reclaimed=0, resources_deleted=0)
+
+    return ResourceSweepModel(
+        cursor=sweep.cursor,
+        passes=sweep.passes,
+        files_quarantined=sweep.files_quarantined,
+        bytes_quarantined=sweep.bytes_quarantined,
+        files_deleted=sweep.files_deleted,
+        bytes_reclaimed=sweep.bytes_reclaimed,
+        resources_deleted=sweep.resources_deleted,
+    )
@@ -1,17 +1,30 @@
 import logging
-from typing import Annotated
-from sqlalchemy import or_
+from typing import Annotated, Literal, Optional
+from sqlalchemy import Row, or_, delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 
-from fastapi import APIRouter, HTTPException, Depends, Query, UploadFile, File
-from starlette.status import HTTP_404_NOT_FOUND
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, UploadFile, File
+from starlette.status import HTTP_404_NOT_FOUND, HTTP_422_UNPROCESSABLE_ENTITY
 
-from somisana.api.lib import save_file_resource, delete_local_resource_file
+from somisana.api.lib import save_file_resource, schedule_resource_file_removal
 from somisana.api.lib.auth import Authorize
+from somisana.api.lib.cache import CacheLookup, response_cache_lookup
+from somisana.api.lib.derivatives import CATALOG_THUMBNAIL_WIDTH
+from somisana.api.lib.pagination import Page, page_params, paginate, paginate_ranked, next_page_headers
+from somisana.api.lib.serialization import FastJSONResponse
 from somisana.api.models import ProductOut, ProductModel, ProductResourceModel, ResourceModel, CatalogProductModel, \
-    DatasetModel
+    DatasetModel, ProductSearchModel, ProductIngestModel, ProductIngestResultModel, DatasetIngestResultModel, \
+    LinkResourceModel, ProductVersionModel, ProductLineageModel
 from somisana.const import SOMISANAScope, EntityType, ResourceReferenceType, ResourceType
-from somisana.db import Session
-from somisana.db.models import Product, Resource, ProductResource, ProductVersion
+from somisana.db import get_session
+from somisana.db.deletes import delete_owned_resources
+from somisana.db.loaders import select_products, select_catalog_products, select_product_search, \
+    select_product_matches, select_ranked_product_search, product_search_rank, select_product_lineage, \
+    select_latest_product_id, product_graph_options, catalog_product_options
+from somisana.db.models import Product, Resource, ProductResource, ProductVersion, Dataset
+from somisana.db.search import search_query
+from somisana.db.spatial import BoundingBox, extent_intersects, extent_contains
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -22,13 +35,26 @@ logger = logging.getLogger(__name__)
     response_model=list[ProductOut],
     dependencies=[Depends(Authorize(SOMISANAScope.PRODUCT_READ))]
 )
-async def list_products():
-    all_products = Session.query(Product).all()
+async def list_products(
+        request: Request,
+        session: Annotated[AsyncSession, Depends(get_session)],
+        cache: Annotated[CacheLookup, Depends(response_cache_lookup)],
+        page: Annotated[Page, Depends(page_params)],
+        superseded: Annotated[Optional[bool], Query(description='Filter on whether products are superseded')] = None,
+):
+    if cache.response:
+        return cache.response
+
+    stmt = select_products()
+    if superseded is not None:
+        stmt = stmt.where(Product.superseded_by != None if superseded else Product.superseded_by == None)
 
-    return [
+    all_products = (await session.execute(paginate(stmt, Product.id, page))).scalars().all()
+
+    return cache.store([
         output_product_model(product)
         for product in all_products
-    ]
+    ], headers=next_page_headers(request, all_products, page))
 
 
 @router.get(
@@ -36,18 +62,91 @@ async def list_products():
     response_model=list[CatalogProductModel],
     dependencies=[Depends(Authorize(SOMISANAScope.PRODUCT_READ))]
 )
-async def catalog_products():
-    # we filter out the products that have been superseded
-    all_products = (
-        Session.query(Product)
-        .filter(Product.superseded_by == None)
-        .all()
-    )
+async def catalog_products(
+        request: Request,
+        session: Annotated[AsyncSession, Depends(get_session)],
+        cache: Annotated[CacheLookup, Depends(response_cache_lookup)],
+        page: Annotated[Page, Depends(page_params)],
+):
+    if cache.response:
+        return cache.response
 
-    return [
-        catalog_product_model(product)
-        for product in all_products
-    ]
+    # superseded products are left out of the catalog
+    catalog_rows = (
+        await session.execute(paginate(select_catalog_products(CATALOG_THUMBNAIL_WIDTH), Product.id, page))
+    ).all()
+
+    return cache.store([
+        catalog_product_model(row)
+        for row in catalog_rows
+    ], headers=next_page_headers(request, catalog_rows, page))
+
+
+@router.get(
+    '/search',
+    response_model=list[ProductSearchModel],
+    dependencies=[Depends(Authorize(SOMISANAScope.PRODUCT_READ))]
+)
+async def search_products(
+        request: Request,
+        session: Annotated[AsyncSession, Depends(get_session)],
+        cache: Annotated[CacheLookup, Depends(response_cache_lookup)],
+        page: Annotated[Page, Depends(page_params)],
+        q: Annotated[Optional[str], Query(
+            min_length=1,
+            description='Text to search for in the title, variables and description; supports quoted phrases, '
+                        '"or" and "-" to exclude a term. Results are ranked by relevance',
+            example='sea surface temperature',
+        )] = None,
+        bbox: Annotated[Optional[str], Query(
+            description='Bounding box as west,south,east,north in decimal degrees; '
+                        'west may be greater than east for a box crossing the antimeridian',
+            example='16,-35,33,-22',
+        )] = None,
+        mode: Annotated[Literal['intersects', 'contains'], Query(
+            description='Whether to match products whose extent intersects the bounding box, '
+                        'or only those whose extent contains all of it',
+        )] = 'intersects',
+):
+    if cache.response:
+        return cache.response
+
+    if q is None and bbox is None:
+        raise HTTPException(HTTP_422_UNPROCESSABLE_ENTITY, 'Either q or bbox must be given')
+
+    criteria = []
+    if bbox is not None:
+        try:
+            bounding_box = BoundingBox.parse(bbox)
+        except ValueError as e:
+            raise HTTPException(HTTP_422_UNPROCESSABLE_ENTITY, str(e))
+
+        extent_match = extent_contains if mode == 'contains' else extent_intersects
+        criteria += [extent_match(Product.extent_box, Product.extent_wrap_box, bounding_box)]
+
+    # superseded products are left out, as for the catalog
+    if q is None:
+        stmt = paginate(select_product_search(CATALOG_THUMBNAIL_WIDTH, *criteria), Product.id, page)
+    else:
+        text_query = search_query(q)
+        cursor_product = aliased(Product)
+        matches = paginate_ranked(
+            select_product_matches(text_query, *criteria),
+            Product.id,
+            product_search_rank(text_query),
+            select(product_search_rank(text_query, cursor_product))
+            .where(cursor_product.id == page.cursor)
+            .scalar_subquery(),
+            page,
+        ).subquery('matches')
+        stmt = select_ranked_product_search(CATALOG_THUMBNAIL_WIDTH, text_query, matches)
+
+    search_rows = (await session.execute(stmt)).all()
+
+    return cache.store([
+        product_search_model(row)
+        for row in search_rows
+    ], headers=next_page_headers(request, search_rows, page))
 
 
 @router.get(
@@ -57,11 +156,72 @@ async def catalog_products():
 )
 async def get_product(
         product_id: int,
+        session: Annotated[AsyncSession, Depends(get_session)],
+        cache: Annotated[CacheLookup, Depends(response_cache_lookup)],
 ) -> ProductOut:
-    if not (product := Session.get(Product, product_id)):
+    if cache.response:
+        return cache.response
+
+    if not (product := await session.get(Product, product_id, options=product_graph_options())):
         raise HTTPException(HTTP_404_NOT_FOUND)
 
-    return output_product_model(product)
+    return cache.store(output_product_model(product))
+
+
+@router.get(
+    '/{product_id}/lineage',
+    response_model=ProductLineageModel,
+    dependencies=[Depends(Authorize(SOMISANAScope.PRODUCT_READ))]
+)
+async def get_product_lineage(
+        product_id: int,
+        session: Annotated[AsyncSession, Depends(get_session)],
+        cache: Annotated[CacheLookup, Depends(response_cache_lookup)],
+):
+    if cache.response:
+        return cache.response
+
+    if not (lineage_rows := (await session.execute(select_product_lineage(product_id))).all()):
+        raise HTTPException(HTTP_404_NOT_FOUND)
+
+    # a cycle of version links reaches the same product more than once;
+    # keep the occurrence closest to the requested product
+    versions = {}
+    for row in sorted(lineage_rows, key=lambda row: abs(row.generation)):
+        versions.setdefault(row.id, row)
+    versions = sorted(versions.values(), key=lambda row: (row.generation, row.id))
+
+    return cache.store(ProductLineageModel(
+        product_id=product_id,
+        latest_product_id=max(versions, key=lambda row: (row.generation, row.id)).id,
+        versions=[
+            ProductVersionModel(id=row.id, title=row.title, doi=row.doi, generation=row.generation)
+            for row in versions
+        ],
+    ))
+
+
+@router.get(
+    '/{product_id}/latest',
+    response_model=ProductOut,
+    dependencies=[Depends(Authorize(SOMISANAScope.PRODUCT_READ))]
+)
+async def get_latest_product(
+        product_id: int,
+        session: Annotated[AsyncSession, Depends(get_session)],
+        cache: Annotated[CacheLookup, Depends(response_cache_lookup)],
+) -> ProductOut:
+    """Return the newest version of a product, which is the product itself
+    if it has not been superseded."""
+    if cache.response:
+        return cache.response
+
+    if not (product := (await session.execute(
+            select_products(Product.id == select_latest_product_id(product_id).scalar_subquery())
+    )).scalar_one_or_none()):
+        raise HTTPException(HTTP_404_NOT_FOUND)
+
+    return cache.store(output_product_model(product))
 
 
 @router.post(
@@ -69,7 +229,8 @@ async def get_product(
     dependencies=[Depends(Authorize(SOMISANAScope.PRODUCT_ADMIN))]
 )
 async def create_product(
-        product_in: ProductModel
+        product_in: ProductModel,
+        session: Annotated[AsyncSession, Depends(get_session)],
 ) -> int:
     product = Product(
         title=product_in.title,
@@ -87,35 +248,101 @@ async def create_product(
         variables=product_in.variables,
     )
 
-    product.save()
+    await product.save(session)
 
     if product_in.superseded_product_id:
-        ProductVersion(
+        await ProductVersion(
             product_id=product.id,
             superseded_product_id=product_in.superseded_product_id,
-        ).save()
+        ).save(session)
 
     return product.id
 
 
+@router.post(
+    '/ingest',
+    response_model=ProductIngestResultModel,
+    dependencies=[Depends(Authorize(SOMISANAScope.PRODUCT_ADMIN))]
+)
+async def ingest_product(
+        product_in: ProductIngestModel,
+        session: Annotated[AsyncSession, Depends(get_session)],
+) -> ProductIngestResultModel:
+    """Create a product together with its datasets, link resources and
+    version link, in a single transaction. Each table is written with one
+    multi-row insert, however large the product tree."""
+    if (product_in.superseded_product_id is not None
+            and not (await session.get(Product, product_in.superseded_product_id))):
+        raise HTTPException(HTTP_422_UNPROCESSABLE_ENTITY, 'The superseded product does not exist')
+
+    product = Product(
+        title=product_in.title,
+        description=product_in.description,
+        doi=product_in.doi,
+        north_bound=product_in.north_bound,
+        south_bound=product_in.south_bound,
+        east_bound=product_in.east_bound,
+        west_bound=product_in.west_bound,
+        horizontal_resolution=product_in.horizontal_resolution,
+        vertical_extent=product_in.vertical_extent,
+        vertical_resolution=product_in.vertical_resolution,
+        temporal_extent=product_in.temporal_extent,
+        temporal_resolution=product_in.temporal_resolution,
+        variables=product_in.variables,
+        datasets=[
+            Dataset(
+                title=dataset_in.title,
+                folder_path=dataset_in.folder_path,
+                visualize=dataset_in.visualize,
+                type=dataset_in.type,
+                identifier=dataset_in.identifier,
+                resources=[link_resource(resource_in) for resource_in in dataset_in.resources],
+            )
+            for dataset_in in product_in.datasets
+        ],
+        resources=[link_resource(resource_in) for resource_in in product_in.resources],
+    )
+    if product_in.superseded_product_id is not None:
+        product.supersedes = ProductVersion(superseded_product_id=product_in.superseded_product_id)
+
+    # flush now for the generated ids; the unit of work batches the inserts
+    # for each table, in dependency order
+    session.add(product)
+    await session.flush()
+
+    return ProductIngestResultModel(
+        id=product.id,
+        resource_ids=[resource.id for resource in product.resources],
+        datasets=[
+            DatasetIngestResultModel(
+                id=dataset.id,
+                identifier=dataset.identifier,
+                resource_ids=[resource.id for resource in dataset.resources],
+            )
+            for dataset in product.datasets
+        ],
+    )
+
+
 @router.put(
     '/{product_id}',
     dependencies=[Depends(Authorize(SOMISANAScope.PRODUCT_ADMIN))]
 )
 async def update_product(
         product_id: int,
-        product_in: ProductModel
+        product_in: ProductModel,
+        session: Annotated[AsyncSession, Depends(get_session)],
 ):
-    if not (product := Session.get(Product, product_id)):
+    if not (product := await session.get(Product, product_id)):
         raise HTTPException(HTTP_404_NOT_FOUND)
 
-    product.title = product_in.title,
-    product.description = product_in.description,
-    product.doi = product_in.doi,
-    product.north_bound = product_in.north_bound,
-    product.south_bound = product_in.south_bound,
-    product.east_bound = product_in.east_bound,
-    product.west_bound = product_in.west_bound,
+    product.title = product_in.title
+    product.description = product_in.description
+    product.doi = product_in.doi
+    product.north_bound = product_in.north_bound
+    product.south_bound = product_in.south_bound
+    product.east_bound = product_in.east_bound
+    product.west_bound = product_in.west_bound
     product.horizontal_resolution = product_in.horizontal_resolution
     product.vertical_extent = product_in.vertical_extent
     product.vertical_resolution = product_in.vertical_resolution
@@ -123,19 +350,19 @@ async def update_product(
     product.temporal_resolution = product_in.temporal_resolution
     product.variables = product_in.variables
 
-    product.save()
+    await product.save(session)
 
-    if product_version := Session.get(ProductVersion, product_id):
+    if product_version := await session.get(ProductVersion, product_id):
         if product_in.superseded_product_id:
             product_version.superseded_product_id = product_in.superseded_product_id
-            product_version.save()
+            await product_version.save(session)
         else:
-            product_version.delete()
+            await product_version.delete(session)
     elif product_in.superseded_product_id:
-        ProductVersion(
+        await ProductVersion(
             product_id=product.id,
             superseded_product_id=product_in.superseded_product_id,
-        ).save()
+        ).save(session)
 
 
 @router.delete(
@@ -143,26 +370,34 @@ async def update_product(
     dependencies=[Depends(Authorize(SOMISANAScope.PRODUCT_ADMIN))]
 )
 async def delete_product(
-        product_id: int
+        product_id: int,
+        session: Annotated[AsyncSession, Depends(get_session)],
 ):
-    if not (product := Session.get(Product, product_id)):
-        raise HTTPException(HTTP_404_NOT_FOUND)
-
-    for resource in product.resources:
-        if resource.reference_type == ResourceReferenceType.PATH:
-            delete_local_resource_file(resource.reference)
-
-    for dataset in product.datasets:
-        dataset.delete()
-
-    Session.query(ProductVersion).filter(
-        or_(
-            ProductVersion.product_id == product_id,
-            ProductVersion.superseded_product_id == product_id
+    deleted_resources = (await session.execute(
+        delete_owned_resources(
+            product_ids=[product_id],
+            dataset_ids=select(Dataset.id).where(Dataset.product_id == product_id),
+        ),
+        execution_options={'synchronize_session': False},
+    )).all()
+
+    await session.execute(
+        delete(ProductVersion).where(
+            or_(
+                ProductVersion.product_id == product_id,
+                ProductVersion.superseded_product_id == product_id
+            )
         )
-    ).delete()
+    )
+
+    # datasets, with their files and links, go by ON DELETE CASCADE
+    if not (await session.execute(
+            delete(Product).where(Product.id == product_id).returning(Product.id),
+            execution_options={'synchronize_session': False},
+    )).first():
+        raise HTTPException(HTTP_404_NOT_FOUND)
 
-    product.delete()
+    schedule_resource_file_removal(session, deleted_resources)
 
 
 @router.get(
@@ -171,12 +406,13 @@ async def delete_product(
     dependencies=[Depends(Authorize(SOMISANAScope.RESOURCE_READ))]
 )
 async def get_resources(
-        product_id: int
+        product_id: int,
+        session: Annotated[AsyncSession, Depends(get_session)],
 ):
-    if not (product := Session.get(Product, product_id)):
+    if not (product := await session.get(Product, product_id, options=catalog_product_options())):
         raise HTTPException(HTTP_404_NOT_FOUND)
 
-    return [
+    return FastJSONResponse([
         ProductResourceModel(
             id=resource.id,
             product_id=product_id,
@@ -185,7 +421,7 @@ async def get_resources(
             resource_type=resource.resource_type,
             reference_type=resource.reference_type,
         ) for resource in product.resources
-    ]
+    ])
 
 
 @router.post(
@@ -195,8 +431,9 @@ async def get_resources(
 async def add_resource(
         product_id: int,
         resource_in: ResourceModel,
+        session: Annotated[AsyncSession, Depends(get_session)],
 ):
-    if not (Session.get(Product, product_id)):
+    if not (await session.get(Product, product_id)):
         raise HTTPException(HTTP_404_NOT_FOUND)
 
     resource = Resource(
@@ -206,12 +443,12 @@ async def add_resource(
         reference_type=ResourceReferenceType.LINK
     )
 
-    resource.save()
+    await resource.save(session)
 
-    ProductResource(
+    await ProductResource(
         product_id=product_id,
         resource_id=resource.id
-    ).save()
+    ).save(session)
 
     return resource.id
 
@@ -223,22 +460,24 @@ async def add_resource(
 async def add_file_resource(
         product_id: int,
         resource_query: Annotated[ResourceModel, Query()],
-        file: Annotated[UploadFile, File()]
+        file: Annotated[UploadFile, File()],
+        session: Annotated[AsyncSession, Depends(get_session)],
 ):
-    if not (Session.get(Product, product_id)):
+    if not (await session.get(Product, product_id)):
         raise HTTPException(HTTP_404_NOT_FOUND)
 
-    resource_id = save_file_resource(
+    resource_id = await save_file_resource(
+        session=session,
         file=file,
         resource_model=ResourceModel(**resource_query.dict()),
         entity_type=EntityType.PRODUCT,
         entity_id=product_id
     )
 
-    ProductResource(
+    await ProductResource(
         product_id=product_id,
         resource_id=resource_id,
-    ).save()
+    ).save(session)
 
     return resource_id
 
@@ -308,27 +547,47 @@ def output_product_model(product: Product) -> ProductOut:
     )
 
 
-def catalog_product_model(product: Product) -> CatalogProductModel:
+def link_resource(resource_in: LinkResourceModel) -> Resource:
+    return Resource(
+        title=resource_in.title,
+        resource_type=resource_in.resource_type,
+        reference=resource_in.reference,
+        reference_type=ResourceReferenceType.LINK,
+    )
+
+
+def catalog_product_model(row: Row) -> CatalogProductModel:
     return CatalogProductModel(
-        id=product.id,
-        title=product.title,
-        description=product.description,
-        thumbnail=get_first_resource(product.resources, ResourceType.THUMBNAIL)
+        id=row.id,
+        title=row.title,
+        description=row.description,
+        thumbnail=catalog_thumbnail_model(row),
     )
 
 
-def get_first_resource(resources: list[Resource], resource_type: ResourceType) -> ResourceModel:
-    return next(
-        (
-            ResourceModel(
-                id=resource.id,
-                title=resource.title,
-                reference=resource.reference,
-                resource_type=resource_type,
-                reference_type=resource.reference_type,
-            )
-            for resource in resources
-            if resource.resource_type == resource_type
-        ),
-        None
+def catalog_thumbnail_model(row: Row) -> Optional[ResourceModel]:
+    if row.thumbnail_id is None:
+        return None
+
+    return ResourceModel(
+        id=row.thumbnail_id,
+        title=row.thumbnail_title,
+        reference=row.rendition_reference or row.thumbnail_reference,
+        resource_type=ResourceType.THUMBNAIL,
+        reference_type=ResourceReferenceType.PATH if row.rendition_reference else row.thumbnail_reference_type,
+    )
+
+
+def product_search_model(row: Row) -> ProductSearchModel:
+    return ProductSearchModel(
+        id=row.id,
+        title=row.title,
+        description=row.description,
+        thumbnail=catalog_thumbnail_model(row),
+        north_bound=row.north_bound,
+        south_bound=row.south_bound,
+        east_bound=row.east_bound,
+        west_bound=row.west_bound,
+        rank=row.rank,
+        snippet=row.snippet,
     )
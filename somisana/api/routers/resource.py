@@ -1,13 +1,17 @@
 from fastapi import APIRouter, HTTPException, Depends, Query, UploadFile, File
-from somisana.api.lib import save_file_resource, delete_local_resource_file, update_file_resource
+from somisana.api.lib import save_file_resource, update_file_resource
 from typing import Annotated
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette.status import HTTP_404_NOT_FOUND
 
-from somisana.api.lib import delete_local_resource_file
+from somisana.api.lib import schedule_resource_file_removal
 from somisana.api.lib.auth import Authorize
+from somisana.api.lib.serialization import FastJSONResponse
 from somisana.api.models import ResourceModel
-from somisana.const import ResourceReferenceType, EntityType, SOMISANAScope
-from somisana.db import Session
+from somisana.const import EntityType, SOMISANAScope
+from somisana.db import get_session
+from somisana.db.loaders import resource_owner_options
 from somisana.db.models import Resource
 
 router = APIRouter()
@@ -19,18 +23,19 @@ router = APIRouter()
     dependencies=[Depends(Authorize(SOMISANAScope.RESOURCE_READ))]
 )
 async def get_resource(
-        resource_id: int
+        resource_id: int,
+        session: Annotated[AsyncSession, Depends(get_session)],
 ):
-    if not (resource := Session.get(Resource, resource_id)):
+    if not (resource := await session.get(Resource, resource_id)):
         raise HTTPException(HTTP_404_NOT_FOUND)
 
-    return ResourceModel(
+    return FastJSONResponse(ResourceModel(
         id=resource.id,
         title=resource.title,
         reference=resource.reference,
         resource_type=resource.resource_type,
         reference_type=resource.reference_type,
-    )
+    ))
 
 
 @router.delete(
@@ -38,15 +43,16 @@ async def get_resource(
     dependencies=[Depends(Authorize(SOMISANAScope.RESOURCE_ADMIN))]
 )
 async def delete_resource(
-        resource_id: int
+        resource_id: int,
+        session: Annotated[AsyncSession, Depends(get_session)],
 ):
-    if not (resource := Session.get(Resource, resource_id)):
+    if not (deleted_resource := (await session.execute(
+            delete(Resource).where(Resource.id == resource_id).returning(Resource.reference, Resource.reference_type),
+            execution_options={'synchronize_session': False},
+    )).first()):
         raise HTTPException(HTTP_404_NOT_FOUND)
 
-    if resource.reference_type == ResourceReferenceType.PATH:
-        delete_local_resource_file(resource.reference)
-
-    resource.delete()
+    schedule_resource_file_removal(session, [deleted_resource])
 
 
 @router.post(
@@ -56,15 +62,16 @@ async def delete_resource(
 async def update_resource(
         resource_id: int,
         resource_in: ResourceModel,
+        session: Annotated[AsyncSession, Depends(get_session)],
 ):
-    if not (resource := Session.get(Resource, resource_id)):
+    if not (resource := await session.get(Resource, resource_id)):
         raise HTTPException(HTTP_404_NOT_FOUND)
 
-    resource.title = resource_in.title,
-    resource.resource_type = resource_in.resource_type,
-    resource.reference = resource_in.reference,
+    resource.title = resource_in.title
+    resource.resource_type = resource_in.resource_type
+    resource.reference = resource_in.reference
 
-    resource.save()
+    await resource.save(session)
 
     return resource.id
 
@@ -76,9 +83,10 @@ async def update_resource(
 async def update_resource_file(
         resource_id: int,
         resource_query: Annotated[ResourceModel, Query()],
-        file: Annotated[UploadFile, File()]
+        file: Annotated[UploadFile, File()],
+        session: Annotated[AsyncSession, Depends(get_session)],
 ):
-    if not (resource := Session.get(Resource, resource_id)):
+    if not (resource := await session.get(Resource, resource_id, options=resource_owner_options())):
         raise HTTPException(HTTP_404_NOT_FOUND)
 
     entity_type = ''
@@ -92,9 +100,9 @@ async def update_resource_file(
         entity_id = resource.datasets[0].id
 
     resource_model = ResourceModel(**resource_query.dict())
-    resource.title = resource_model.title,
-    resource.resource_type = resource_model.resource_type,
+    resource.title = resource_model.title
+    resource.resource_type = resource_model.resource_type
 
-    update_file_resource(file, resource, entity_type, entity_id)
+    await update_file_resource(session, file, resource, entity_type, entity_id)
 
     return resource_id
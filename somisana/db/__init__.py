@@ -1,9 +1,31 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import declarative_base, scoped_session, sessionmaker
+import os
+from collections import defaultdict, deque
+from typing import AsyncIterator, Iterable
+
+from sqlalchemy import Table, create_engine, func, inspect, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, declarative_base
 
 from somisana.config import somisana_config
+from somisana.db.pool import InstrumentedAsyncQueuePool, instrument_pool
+
+# number of primary keys fetched from a table's sequence at a time
+ID_BLOCK_SIZE = int(os.getenv('SOMISANA_DB_ID_BLOCK_SIZE', 20))
 
+# API connection pool: connections kept open, additional connections opened
+# under load, and seconds to wait for a connection before giving up
+DB_POOL_SIZE = int(os.getenv('SOMISANA_DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('SOMISANA_DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.getenv('SOMISANA_DB_POOL_TIMEOUT', 10))
+# seconds after which a connection is replaced; -1 keeps connections open
+DB_POOL_RECYCLE = int(os.getenv('SOMISANA_DB_POOL_RECYCLE', 1800))
+# whether to test each connection with a round trip when it is checked out
+DB_POOL_PRE_PING = os.getenv('SOMISANA_DB_POOL_PRE_PING', 'true').lower() == 'true'
+# milliseconds after which the server cancels an API statement; 0 disables
+DB_STATEMENT_TIMEOUT = int(os.getenv('SOMISANA_DB_STATEMENT_TIMEOUT', 30000))
 
+# synchronous engine, used for schema management and by the test suite
 engine = create_engine(
     somisana_config.SOMISANA.DB.URL,
     echo=somisana_config.SOMISANA.DB.ECHO,
@@ -11,24 +33,101 @@ engine = create_engine(
     future=True,
 )
 
-Session = scoped_session(
-    sessionmaker(
-        bind=engine,
-        autocommit=False,
-        autoflush=False,
-        future=True,
-    )
+# asynchronous engine, used by the API
+async_engine = create_async_engine(
+    make_url(somisana_config.SOMISANA.DB.URL).set(drivername='postgresql+asyncpg'),
+    echo=somisana_config.SOMISANA.DB.ECHO,
+    isolation_level=somisana_config.SOMISANA.DB.ISOLATION_LEVEL,
+    poolclass=InstrumentedAsyncQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    connect_args=dict(server_settings=dict(statement_timeout=str(DB_STATEMENT_TIMEOUT))),
+)
+instrument_pool(async_engine.sync_engine)
+
+
+class ApiSession(Session):
+    """The synchronous session proxied by each API AsyncSession. Session
+    event listeners for the API are registered on this class."""
+
+
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine,
+    sync_session_class=ApiSession,
+    autoflush=False,
+    expire_on_commit=False,
 )
 
 
+async def get_session() -> AsyncIterator[AsyncSession]:
+    """FastAPI dependency providing a database session for the lifetime
+    of a request. The session is committed if the request is handled
+    successfully, and rolled back if an error is raised."""
+    async with AsyncSessionLocal() as session:
+        try:
+            yield session
+            await session.commit()
+        except BaseException:
+            await session.rollback()
+            raise
+
+
+class IdAllocator:
+    """Hands out primary keys for tables with a serial id column, fetched
+    from each table's sequence in blocks. Ids are unique but, across
+    processes, not allocated in insertion order."""
+
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        self._ids: dict[Table, deque[int]] = defaultdict(deque)
+
+    async def allocate(self, session: AsyncSession, table: Table, count: int) -> list[int]:
+        ids = self._ids[table]
+        while len(ids) < count:
+            column = table.autoincrement_column
+            sequence = func.pg_get_serial_sequence(table.name, column.name)
+            ids.extend((await session.execute(
+                select(func.nextval(sequence)).select_from(func.generate_series(1, max(self.block_size, count)))
+            )).scalars())
+
+        return [ids.popleft() for _ in range(count)]
+
+    def clear(self) -> None:
+        self._ids.clear()
+
+
+id_allocator = IdAllocator(block_size=ID_BLOCK_SIZE)
+
+
+async def assign_ids(session: AsyncSession, objects: Iterable['_Base']) -> None:
+    """Assign primary keys to any of the given objects that do not have
+    one, so that they are known before the objects are flushed."""
+    pending = defaultdict(list)
+    for obj in objects:
+        table = inspect(obj).mapper.local_table
+        if (column := table.autoincrement_column) is not None and getattr(obj, column.key) is None:
+            pending[table].append(obj)
+
+    for table, table_objects in pending.items():
+        key = table.autoincrement_column.key
+        for obj, id_ in zip(table_objects, await id_allocator.allocate(session, table, len(table_objects))):
+            setattr(obj, key, id_)
+
+
 class _Base:
-    def save(self):
-        Session.add(self)
-        Session.flush()
+    async def save(self, session: AsyncSession):
+        """Add the object to the session, to be written when the session is
+        next flushed, usually when it commits. A generated primary key is
+        assigned immediately."""
+        await assign_ids(session, [self])
+        session.add(self)
 
-    def delete(self):
-        Session.delete(self)
-        Session.flush()
+    async def delete(self, session: AsyncSession):
+        """Mark the object for deletion when the session is next flushed."""
+        await session.delete(self)
 
     def to_dict(self):
         return {key: value for key, value in vars(self).items() if not key.startswith('_sa_')}
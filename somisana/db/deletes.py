@@ -0,0 +1,35 @@
+from typing import Iterable, Optional, Union
+
+from sqlalchemy import Delete, Select, delete, false, select, union
+
+from somisana.db.models import ProductResource, DatasetResource, Resource
+
+# the ids of the rows to be deleted, as a list or a subquery
+Ids = Union[Iterable[int], Select]
+
+
+def delete_owned_resources(product_ids: Optional[Ids] = None, dataset_ids: Optional[Ids] = None) -> Delete:
+    """A DELETE of the resources linked to the given products and datasets,
+    returning the reference and reference type of each deleted resource.
+
+    Resources that are also linked to any other product or dataset are
+    kept. The links themselves, and the renditions of the deleted
+    resources, are removed by their foreign keys' ON DELETE CASCADE.
+    """
+    product_linked = ProductResource.product_id.in_(product_ids) if product_ids is not None else false()
+    dataset_linked = DatasetResource.dataset_id.in_(dataset_ids) if dataset_ids is not None else false()
+
+    return delete(Resource).where(
+        Resource.id.in_(union(
+            select(ProductResource.resource_id).where(product_linked),
+            select(DatasetResource.resource_id).where(dataset_linked),
+        )),
+        ~select(ProductResource.resource_id).where(
+            ProductResource.resource_id == Resource.id,
+            ~product_linked,
+        ).exists(),
+        ~select(DatasetResource.resource_id).where(
+            DatasetResource.resource_id == Resource.id,
+            ~dataset_linked,
+        ).exists(),
+    ).returning(Resource.reference, Resource.reference_type)
@@ -0,0 +1,238 @@
+from sqlalchemy import CTE, Select, Subquery, and_, case, func, literal, null, or_, select, true
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.sql.elements import ColumnElement
+
+from somisana.const import ResourceType
+from somisana.db.models import Product, ProductResource, ProductVersion, Dataset, DatasetResource, Resource, \
+    ResourceRendition
+from somisana.db.search import search_match, search_rank, search_snippet
+
+# number of versions followed in each direction from a product, in case the
+# version links form a cycle
+LINEAGE_MAX_DEPTH = 1000
+
+
+def product_graph_options() -> tuple:
+    """Loader options that fetch a product together with its datasets, the
+    resources of the product and of each dataset, and both version links.
+
+    The whole graph is loaded in a fixed number of SELECTs, regardless of
+    how many products are being fetched.
+    """
+    return (
+        joinedload(Product.supersedes),
+        joinedload(Product.superseded_by),
+        selectinload(Product.product_resources).joinedload(ProductResource.resource),
+        selectinload(Product.datasets).selectinload(Dataset.dataset_resources).joinedload(DatasetResource.resource),
+    )
+
+
+def dataset_graph_options() -> tuple:
+    """Loader options that fetch a dataset together with its resources."""
+    return (
+        selectinload(Dataset.dataset_resources).joinedload(DatasetResource.resource),
+    )
+
+
+def resource_owner_options() -> tuple:
+    """Loader options that fetch the products and datasets a resource
+    is linked to."""
+    return (
+        selectinload(Resource.resource_products).joinedload(ProductResource.product),
+        selectinload(Resource.resource_datasets).joinedload(DatasetResource.dataset),
+    )
+
+
+def catalog_product_options() -> tuple:
+    """Loader options for building catalog entries, which only need the
+    product resources."""
+    return (
+        selectinload(Product.product_resources).joinedload(ProductResource.resource),
+    )
+
+
+def select_products(*criteria) -> Select:
+    """Select products matching the given criteria, with the full product
+    graph eagerly loaded."""
+    return (
+        select(Product)
+        .options(*product_graph_options())
+        .where(*criteria)
+        .order_by(Product.id)
+    )
+
+
+def product_superseded() -> ColumnElement:
+    """Criterion matching products that have been superseded."""
+    return select(ProductVersion.superseded_product_id).where(
+        ProductVersion.superseded_product_id == Product.id
+    ).exists()
+
+
+def select_catalog_products(thumbnail_width: int) -> Select:
+    """Select the columns needed for catalog entries of products that have
+    not been superseded, along with each product's first thumbnail and the
+    smallest rendition of it that is at least ``thumbnail_width`` pixels
+    wide, in a single query.
+
+    Rows have the attributes ``id``, ``title`` and ``description``, and
+    ``thumbnail_id``, ``thumbnail_title``, ``thumbnail_reference`` and
+    ``thumbnail_reference_type``, which are None for products without a
+    thumbnail, and ``rendition_reference``, which is None if the thumbnail
+    has no suitable rendition.
+    """
+    thumbnail = (
+        select(Resource.id, Resource.title, Resource.reference, Resource.reference_type)
+        .join(ProductResource, ProductResource.resource_id == Resource.id)
+        .where(
+            ProductResource.product_id == Product.id,
+            Resource.resource_type == ResourceType.THUMBNAIL.value,
+        )
+        .order_by(Resource.id)
+        .limit(1)
+        .lateral('thumbnail')
+    )
+    rendition = (
+        select(ResourceRendition.reference)
+        .where(
+            ResourceRendition.resource_id == thumbnail.c.id,
+            ResourceRendition.width >= thumbnail_width,
+        )
+        .order_by(ResourceRendition.width, ResourceRendition.media_type != 'image/webp')
+        .limit(1)
+        .lateral('rendition')
+    )
+    return (
+        select(
+            Product.id,
+            Product.title,
+            Product.description,
+            thumbnail.c.id.label('thumbnail_id'),
+            thumbnail.c.title.label('thumbnail_title'),
+            thumbnail.c.reference.label('thumbnail_reference'),
+            thumbnail.c.reference_type.label('thumbnail_reference_type'),
+            rendition.c.reference.label('rendition_reference'),
+        )
+        .select_from(Product)
+        .outerjoin(thumbnail, true())
+        .outerjoin(rendition, true())
+        .where(~product_superseded())
+        .order_by(Product.id)
+    )
+
+
+def select_product_search(thumbnail_width: int, *criteria) -> Select:
+    """Select catalog entries matching the given criteria, as for
+    ``select_catalog_products``, with the bounds of each product.
+
+    Rows also have the attributes ``rank`` and ``snippet``, which are None;
+    see ``select_ranked_product_search``.
+    """
+    return (
+        select_catalog_products(thumbnail_width)
+        .add_columns(
+            Product.north_bound,
+            Product.south_bound,
+            Product.east_bound,
+            Product.west_bound,
+            null().label('rank'),
+            null().label('snippet'),
+        )
+        .where(*criteria)
+    )
+
+
+def product_search_rank(text_query: ColumnElement, product=Product) -> ColumnElement:
+    return search_rank(product.search_vector, text_query)
+
+
+def select_product_matches(text_query: ColumnElement, *criteria) -> Select:
+    """Select the ids of products that have not been superseded, whose
+    search document matches ``text_query`` and that match the given
+    criteria, along with their ``rank``."""
+    return (
+        select(Product.id, product_search_rank(text_query).label('rank'))
+        .where(search_match(Product.search_vector, text_query), ~product_superseded(), *criteria)
+    )
+
+
+def select_ranked_product_search(thumbnail_width: int, text_query: ColumnElement, matches: Subquery) -> Select:
+    """Select search results for the products in ``matches``, a subquery of
+    (a page of) ``select_product_matches``, in descending order of rank,
+    with a highlighted snippet of each product's description.
+
+    Thumbnails and snippets are only looked up for the products in
+    ``matches``, rather than for every matching product.
+    """
+    return (
+        select_catalog_products(thumbnail_width)
+        .join(matches, matches.c.id == Product.id)
+        .add_columns(
+            Product.north_bound,
+            Product.south_bound,
+            Product.east_bound,
+            Product.west_bound,
+            matches.c.rank,
+            search_snippet(Product.description, text_query).label('snippet'),
+        )
+        .order_by(None)
+        .order_by(matches.c.rank.desc(), Product.id)
+    )
+
+
+def product_lineage_cte(product_id: int, older: bool = True) -> CTE:
+    """A recursive CTE of the versions of a product, walking the version
+    links in both directions, or only towards newer versions if ``older``
+    is false. Rows have the attributes ``id`` and ``generation``, which is
+    relative to the given product: negative for the versions it supersedes,
+    directly or not, and positive for those that supersede it.
+
+    The CTE is empty if the product does not exist.
+    """
+    lineage = select(
+        Product.id.label('id'),
+        literal(0).label('generation'),
+    ).where(Product.id == product_id).cte('lineage', recursive=True)
+
+    # a recursive CTE may only refer to itself once, so both directions
+    # are followed through a single join
+    newer = and_(lineage.c.generation >= 0, ProductVersion.superseded_product_id == lineage.c.id)
+    if older:
+        is_older = and_(lineage.c.generation <= 0, ProductVersion.product_id == lineage.c.id)
+        onclause = or_(is_older, newer)
+        version_id = case((is_older, ProductVersion.superseded_product_id), else_=ProductVersion.product_id)
+        generation = case((is_older, lineage.c.generation - 1), else_=lineage.c.generation + 1)
+    else:
+        onclause = newer
+        version_id = ProductVersion.product_id
+        generation = lineage.c.generation + 1
+
+    return lineage.union_all(
+        select(version_id, generation)
+        .select_from(lineage)
+        .join(ProductVersion, onclause)
+        .where(func.abs(lineage.c.generation) < LINEAGE_MAX_DEPTH)
+    )
+
+
+def select_product_lineage(product_id: int) -> Select:
+    """Select the versions of a product, oldest first, in a single query.
+    Rows have the attributes ``id``, ``title``, ``doi`` and ``generation``;
+    see ``product_lineage_cte``."""
+    lineage = product_lineage_cte(product_id)
+    return (
+        select(Product.id, Product.title, Product.doi, lineage.c.generation)
+        .join(lineage, lineage.c.id == Product.id)
+        .order_by(lineage.c.generation, Product.id)
+    )
+
+
+def select_latest_product_id(product_id: int) -> Select:
+    """Select the id of the newest version of a product, which is the
+    product itself if it has not been superseded."""
+    lineage = product_lineage_cte(product_id, older=False)
+    return (
+        select(lineage.c.id)
+        .order_by(lineage.c.generation.desc(), lineage.c.id.desc())
+        .limit(1)
+    )
@@ -1,3 +1,3 @@
 from .product import Product, ProductResource, ProductVersion
-from .resource import Resource
-from .dataset import Dataset, DatasetResource
+from .resource import Resource, ResourceRendition, ResourceSweep
+from .dataset import Dataset, DatasetResource, DatasetFile, DatasetDirectory
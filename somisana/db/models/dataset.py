@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, ForeignKey, Boolean
+from sqlalchemy import BigInteger, Column, String, Integer, ForeignKey, Boolean, Index, UniqueConstraint
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import relationship
 
@@ -12,8 +12,13 @@ class Dataset(Base):
 
     __tablename__ = 'dataset'
 
+    __table_args__ = (
+        # supports keyset pagination over a product's datasets
+        Index('ix_dataset_product_id_id', 'product_id', 'id'),
+    )
+
     id = Column(Integer, primary_key=True)
-    product_id = Column(Integer, ForeignKey('product.id'), nullable=False)
+    product_id = Column(Integer, ForeignKey('product.id', ondelete='CASCADE'), nullable=False)
     title = Column(String, nullable=False)
     identifier = Column(String, nullable=False)
     type = Column(String, nullable=False)
@@ -35,7 +40,45 @@ class DatasetResource(Base):
     __tablename__ = 'dataset_resource'
 
     dataset_id = Column(Integer, ForeignKey('dataset.id', ondelete='CASCADE'), primary_key=True)
-    resource_id = Column(Integer, ForeignKey('resource.id', ondelete='CASCADE'), primary_key=True)
+    resource_id = Column(Integer, ForeignKey('resource.id', ondelete='CASCADE'), primary_key=True, index=True)
 
     dataset = relationship('Dataset', viewonly=True)
     resource = relationship('Resource')
+
+
+class DatasetFile(Base):
+    """
+    An indexed file under the folder of a dataset
+    """
+
+    __tablename__ = 'dataset_file'
+
+    __table_args__ = (
+        UniqueConstraint('dataset_id', 'path'),
+        # supports keyset pagination over a dataset's files
+        Index('ix_dataset_file_dataset_id_id', 'dataset_id', 'id'),
+        Index('ix_dataset_file_dataset_id_directory', 'dataset_id', 'directory'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    dataset_id = Column(Integer, ForeignKey('dataset.id', ondelete='CASCADE'), nullable=False)
+    # paths are relative to the dataset folder
+    path = Column(String, nullable=False)
+    directory = Column(String, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    mtime_ns = Column(BigInteger, nullable=False)
+    checksum = Column(String, nullable=True)
+
+
+class DatasetDirectory(Base):
+    """
+    An indexed directory under the folder of a dataset, with the
+    modification time at which its entries were last listed
+    """
+
+    __tablename__ = 'dataset_directory'
+
+    dataset_id = Column(Integer, ForeignKey('dataset.id', ondelete='CASCADE'), primary_key=True)
+    path = Column(String, primary_key=True)
+    # null if the directory must be listed again on the next scan
+    mtime_ns = Column(BigInteger, nullable=True)
@@ -1,8 +1,13 @@
-from sqlalchemy import Column, Numeric, String, Integer, ForeignKey
+from decimal import Decimal
+
+from sqlalchemy import Column, Computed, Numeric, String, Integer, ForeignKey, Index
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.ext.associationproxy import association_proxy
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship, validates
 
 from somisana.db import Base
+from somisana.db.search import PRODUCT_SEARCH_VECTOR_SQL
+from somisana.db.spatial import Box, EXTENT_BOX_SQL, EXTENT_WRAP_BOX_SQL
 
 
 class Product(Base):
@@ -27,7 +32,20 @@ class Product(Base):
     variables = Column(String, nullable=False)
     doi = Column(String)
 
-    datasets = relationship("Dataset", back_populates="product")
+    # spatial extent, derived from the bounds for indexed bounding box search
+    extent_box = deferred(Column(Box, Computed(EXTENT_BOX_SQL, persisted=True)))
+    extent_wrap_box = deferred(Column(Box, Computed(EXTENT_WRAP_BOX_SQL, persisted=True)))
+
+    # full text search document, derived from the title, variables and description
+    search_vector = deferred(Column(TSVECTOR, Computed(PRODUCT_SEARCH_VECTOR_SQL, persisted=True)))
+
+    __table_args__ = (
+        Index('ix_product_extent_box', 'extent_box', postgresql_using='gist'),
+        Index('ix_product_extent_wrap_box', 'extent_wrap_box', postgresql_using='gist'),
+        Index('ix_product_search_vector', 'search_vector', postgresql_using='gin'),
+    )
+
+    datasets = relationship("Dataset", back_populates="product", passive_deletes=True)
 
     product_resources = relationship('ProductResource', cascade='all, delete-orphan', passive_deletes=True)
     resources = association_proxy('product_resources', 'resource',
@@ -38,6 +56,12 @@ class Product(Base):
     superseded_by = relationship('ProductVersion', foreign_keys='ProductVersion.superseded_product_id',
                                  back_populates='superseded_product', uselist=False)
 
+    @validates('north_bound', 'south_bound', 'east_bound', 'west_bound')
+    def validate_bound(self, key, value):
+        # asyncpg binds floats to numeric by their exact binary value;
+        # store the shortest decimal representation instead
+        return Decimal(repr(value)) if isinstance(value, float) else value
+
 
 class ProductResource(Base):
     """
@@ -47,7 +71,7 @@ class ProductResource(Base):
     __tablename__ = 'product_resource'
 
     product_id = Column(Integer, ForeignKey('product.id', ondelete='CASCADE'), primary_key=True)
-    resource_id = Column(Integer, ForeignKey('resource.id', ondelete='CASCADE'), primary_key=True)
+    resource_id = Column(Integer, ForeignKey('resource.id', ondelete='CASCADE'), primary_key=True, index=True)
 
     product = relationship('Product', viewonly=True)
     resource = relationship('Resource')
@@ -61,7 +85,7 @@ class ProductVersion(Base):
     __tablename__ = 'product_version'
 
     product_id = Column(Integer, ForeignKey('product.id'), primary_key=True)
-    superseded_product_id = Column(Integer, ForeignKey('product.id'), nullable=False)
+    superseded_product_id = Column(Integer, ForeignKey('product.id'), nullable=False, index=True)
 
     product = relationship('Product', foreign_keys=[product_id], back_populates='supersedes')
     superseded_product = relationship('Product', foreign_keys=[superseded_product_id], back_populates='superseded_by')
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer
+from sqlalchemy import BigInteger, Column, String, Integer, ForeignKey
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import relationship
 
@@ -14,12 +14,53 @@ class Resource(Base):
 
     id = Column(Integer, primary_key=True)
     title = Column(String)
-    reference = Column(String, nullable=False)
+    reference = Column(String, nullable=False, index=True)
     reference_type = Column(String, nullable=True)
     resource_type = Column(String, nullable=False)
+    # SHA-256 hex digest and size in bytes of locally stored files
+    checksum = Column(String, nullable=True)
+    size = Column(BigInteger, nullable=True)
 
     resource_products = relationship('ProductResource', viewonly=True)
     products = association_proxy('resource_products', 'product')
 
     resource_datasets = relationship('DatasetResource', viewonly=True)
     datasets = association_proxy('resource_datasets', 'dataset')
+
+    renditions = relationship('ResourceRendition', cascade='all, delete-orphan', passive_deletes=True,
+                              order_by='ResourceRendition.width')
+
+
+class ResourceRendition(Base):
+    """
+    A resized image derived from an image or clip resource file
+    """
+
+    __tablename__ = 'resource_rendition'
+
+    id = Column(Integer, primary_key=True)
+    resource_id = Column(Integer, ForeignKey('resource.id', ondelete='CASCADE'), nullable=False, index=True)
+    reference = Column(String, nullable=False)
+    media_type = Column(String, nullable=False)
+    width = Column(Integer, nullable=False)
+    height = Column(Integer, nullable=False)
+    size = Column(BigInteger, nullable=False)
+
+
+class ResourceSweep(Base):
+    """
+    Progress and running totals of the sweep for orphaned files under a
+    local resource folder
+    """
+
+    __tablename__ = 'resource_sweep'
+
+    folder = Column(String, primary_key=True)
+    # the entity directory, relative to the folder, swept last in the current pass
+    cursor = Column(String, nullable=True)
+    passes = Column(Integer, nullable=False, default=0)
+    files_quarantined = Column(BigInteger, nullable=False, default=0)
+    bytes_quarantined = Column(BigInteger, nullable=False, default=0)
+    files_deleted = Column(BigInteger, nullable=False, default=0)
+    bytes_reclaimed = Column(BigInteger, nullable=False, default=0)
+    resources_deleted = Column(BigInteger, nullable=False, default=0)
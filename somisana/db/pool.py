@@ -0,0 +1,84 @@
+import time
+from dataclasses import dataclass
+
+from sqlalchemy import Engine, event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, PoolProxiedConnection
+
+
+@dataclass
+class PoolStats:
+    """Counters of connection pool activity since the process started."""
+    connections_opened: int = 0
+    connections_closed: int = 0
+    invalidations: int = 0
+    checkouts: int = 0
+    checkins: int = 0
+    timeouts: int = 0
+    wait_seconds_total: float = 0.0
+    wait_seconds_max: float = 0.0
+
+    def reset(self) -> None:
+        for name, value in vars(PoolStats()).items():
+            setattr(self, name, value)
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedAsyncQueuePool(AsyncAdaptedQueuePool):
+    """An AsyncAdaptedQueuePool that records in ``pool_stats`` how long each
+    checkout takes, including waiting for a connection to be returned when
+    the pool is exhausted and any pre-ping, and how many time out."""
+
+    def connect(self) -> PoolProxiedConnection:
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        except PoolTimeoutError:
+            pool_stats.timeouts += 1
+            raise
+        finally:
+            wait = time.perf_counter() - start
+            pool_stats.wait_seconds_total += wait
+            pool_stats.wait_seconds_max = max(pool_stats.wait_seconds_max, wait)
+
+
+def instrument_pool(engine: Engine) -> None:
+    """Count connection pool events of an engine in ``pool_stats``. The
+    listeners carry over to the pool that replaces the current one when
+    the engine is disposed."""
+
+    @event.listens_for(engine, 'connect')
+    def _connect(dbapi_connection, connection_record):
+        pool_stats.connections_opened += 1
+
+    @event.listens_for(engine, 'close')
+    def _close(dbapi_connection, connection_record):
+        pool_stats.connections_closed += 1
+
+    @event.listens_for(engine, 'invalidate')
+    def _invalidate(dbapi_connection, connection_record, exception):
+        pool_stats.invalidations += 1
+
+    @event.listens_for(engine, 'checkout')
+    def _checkout(dbapi_connection, connection_record, connection_proxy):
+        pool_stats.checkouts += 1
+
+    @event.listens_for(engine, 'checkin')
+    def _checkin(dbapi_connection, connection_record):
+        pool_stats.checkins += 1
+
+
+def pool_status(engine: Engine) -> dict:
+    """Return the current state of an engine's connection pool, along with
+    the counters in ``pool_stats``."""
+    pool = engine.pool
+    return dict(
+        size=pool.size(),
+        checked_in=pool.checkedin(),
+        checked_out=pool.checkedout(),
+        overflow=max(pool.overflow(), 0),
+        timeout=pool.timeout(),
+        **vars(pool_stats),
+    )
@@ -0,0 +1,39 @@
+from sqlalchemy import cast, func
+from sqlalchemy.dialects.postgresql import REGCONFIG
+from sqlalchemy.sql.elements import ColumnElement
+
+# text search configuration used for both documents and queries
+SEARCH_CONFIG = 'english'
+
+# Product search documents weight the title above the variables, and the
+# variables above the description. The expression must be immutable to be
+# used for a generated column, hence the explicit configuration.
+PRODUCT_SEARCH_VECTOR_SQL = (
+    f"setweight(to_tsvector('{SEARCH_CONFIG}'::regconfig, coalesce(title, '')), 'A') || "
+    f"setweight(to_tsvector('{SEARCH_CONFIG}'::regconfig, coalesce(variables, '')), 'B') || "
+    f"setweight(to_tsvector('{SEARCH_CONFIG}'::regconfig, coalesce(description, '')), 'C')"
+)
+
+# options for highlighted snippets of matching text; the text is not
+# escaped, so matches are marked with characters rather than HTML tags
+SNIPPET_OPTIONS = 'StartSel=«, StopSel=», MaxWords=30, MinWords=10, MaxFragments=2, FragmentDelimiter=" … "'
+
+
+def search_query(q: str) -> ColumnElement:
+    """Parse a web search style query, supporting quoted phrases, ``or``
+    and ``-`` for exclusion, into a tsquery."""
+    return func.websearch_to_tsquery(cast(SEARCH_CONFIG, REGCONFIG), q)
+
+
+def search_match(search_vector: ColumnElement, query: ColumnElement) -> ColumnElement:
+    return search_vector.bool_op('@@')(query)
+
+
+def search_rank(search_vector: ColumnElement, query: ColumnElement) -> ColumnElement:
+    return func.ts_rank(search_vector, query)
+
+
+def search_snippet(text: ColumnElement, query: ColumnElement) -> ColumnElement:
+    """Return fragments of ``text`` around the terms matching the query,
+    as plain text with the terms wrapped in ``«`` and ``»``."""
+    return func.ts_headline(cast(SEARCH_CONFIG, REGCONFIG), text, query, SNIPPET_OPTIONS)
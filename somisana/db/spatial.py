@@ -0,0 +1,88 @@
+from dataclasses import dataclass
+
+from sqlalchemy import Float, and_, func, literal, or_
+from sqlalchemy.sql.elements import ColumnElement
+from sqlalchemy.types import UserDefinedType
+
+
+class Box(UserDefinedType):
+    """The PostgreSQL geometric box type."""
+    cache_ok = True
+
+    def get_col_spec(self, **kw):
+        return 'BOX'
+
+
+# A product extent is stored as up to two boxes, so that extents crossing
+# the antimeridian (west bound greater than east bound) can be indexed:
+# the part east of the west bound, up to 180°, and the part west of the
+# east bound, from -180°, which is only set for crossing extents.
+EXTENT_BOX_SQL = (
+    'box(point(west_bound::float8, south_bound::float8), '
+    'point((CASE WHEN west_bound <= east_bound THEN east_bound ELSE 180 END)::float8, north_bound::float8))'
+)
+EXTENT_WRAP_BOX_SQL = (
+    'CASE WHEN west_bound > east_bound THEN '
+    'box(point(-180.0, south_bound::float8), point(east_bound::float8, north_bound::float8)) END'
+)
+
+
+@dataclass(frozen=True)
+class BoundingBox:
+    """A geographic bounding box in decimal degrees. If ``west`` is greater
+    than ``east``, the box crosses the antimeridian."""
+    west: float
+    south: float
+    east: float
+    north: float
+
+    @classmethod
+    def parse(cls, value: str) -> 'BoundingBox':
+        """Parse a bounding box given as 'west,south,east,north', raising
+        ValueError if it is malformed or out of range."""
+        try:
+            west, south, east, north = (float(v) for v in value.split(','))
+        except ValueError:
+            raise ValueError('bbox must be given as west,south,east,north')
+
+        if not all(-180 <= lon <= 180 for lon in (west, east)):
+            raise ValueError('bbox longitudes must be between -180 and 180')
+
+        if not -90 <= south <= north <= 90:
+            raise ValueError('bbox latitudes must be between -90 and 90, with south not greater than north')
+
+        return cls(west, south, east, north)
+
+    def parts(self) -> list[tuple[float, float, float, float]]:
+        """Split the box at the antimeridian, returning (west, south, east,
+        north) tuples that do not cross it."""
+        if self.west <= self.east:
+            return [(self.west, self.south, self.east, self.north)]
+
+        return [
+            (self.west, self.south, 180.0, self.north),
+            (-180.0, self.south, self.east, self.north),
+        ]
+
+
+def _box(west: float, south: float, east: float, north: float) -> ColumnElement:
+    return func.box(
+        func.point(literal(west, Float), literal(south, Float)),
+        func.point(literal(east, Float), literal(north, Float)),
+    )
+
+
+def extent_intersects(extent_box, extent_wrap_box, bbox: BoundingBox) -> ColumnElement[bool]:
+    """Criterion for extents that intersect the bounding box."""
+    return or_(*(
+        or_(extent_box.op('&&')(box), extent_wrap_box.op('&&')(box))
+        for box in (_box(*part) for part in bbox.parts())
+    ))
+
+
+def extent_contains(extent_box, extent_wrap_box, bbox: BoundingBox) -> ColumnElement[bool]:
+    """Criterion for extents that contain the whole bounding box."""
+    return and_(*(
+        or_(extent_box.op('@>')(box), extent_wrap_box.op('@>')(box))
+        for box in (_box(*part) for part in bbox.parts())
+    ))
@@ -2,8 +2,11 @@ import logging
 import os
 import pathlib
 from dotenv import load_dotenv
+from sqlalchemy import text
 from somisana.db import Base, engine
 from somisana.db.models import Product, Dataset, Resource, ProductResource, DatasetResource
+from somisana.db.search import PRODUCT_SEARCH_VECTOR_SQL
+from somisana.db.spatial import EXTENT_BOX_SQL, EXTENT_WRAP_BOX_SQL
 
 logger = logging.getLogger(__name__)
 
@@ -20,3 +23,64 @@ def initialize():
 
 def init_database_schema():
     Base.metadata.create_all(engine)
+    upgrade_database_schema()
+
+
+def upgrade_database_schema():
+    """Apply changes to tables created by earlier versions, which
+    create_all leaves as they are."""
+    with engine.begin() as conn:
+        # checksums and sizes of locally stored resource files
+        conn.execute(text(
+            'ALTER TABLE resource ADD COLUMN IF NOT EXISTS checksum varchar, ADD COLUMN IF NOT EXISTS size bigint'
+        ))
+        # looking up the resource stored at a local file path
+        conn.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_resource_reference ON resource (reference)'
+        ))
+        # bounding box search over product extents
+        conn.execute(text(
+            f'ALTER TABLE product '
+            f'ADD COLUMN IF NOT EXISTS extent_box box GENERATED ALWAYS AS ({EXTENT_BOX_SQL}) STORED, '
+            f'ADD COLUMN IF NOT EXISTS extent_wrap_box box GENERATED ALWAYS AS ({EXTENT_WRAP_BOX_SQL}) STORED'
+        ))
+        conn.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_product_extent_box ON product USING gist (extent_box)'
+        ))
+        conn.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_product_extent_wrap_box ON product USING gist (extent_wrap_box)'
+        ))
+        # full text search over product metadata
+        conn.execute(text(
+            f'ALTER TABLE product ADD COLUMN IF NOT EXISTS search_vector tsvector '
+            f'GENERATED ALWAYS AS ({PRODUCT_SEARCH_VECTOR_SQL}) STORED'
+        ))
+        conn.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_product_search_vector ON product USING gin (search_vector)'
+        ))
+        # keyset pagination and superseded status filters
+        conn.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_dataset_product_id_id ON dataset (product_id, id)'
+        ))
+        conn.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_product_version_superseded_product_id '
+            'ON product_version (superseded_product_id)'
+        ))
+        # deleting a product deletes its datasets; the constraint is only
+        # replaced if it does not cascade yet, as replacing it locks the table
+        # and checks every row
+        if conn.execute(text(
+                "SELECT 1 FROM pg_constraint WHERE conname = 'dataset_product_id_fkey' "
+                "AND conrelid = 'dataset'::regclass AND confdeltype <> 'c'"
+        )).first():
+            conn.execute(text(
+                'ALTER TABLE dataset DROP CONSTRAINT dataset_product_id_fkey, ADD CONSTRAINT dataset_product_id_fkey '
+                'FOREIGN KEY (product_id) REFERENCES product (id) ON DELETE CASCADE'
+            ))
+        # deleting a resource looks up its links by resource id
+        conn.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_product_resource_resource_id ON product_resource (resource_id)'
+        ))
+        conn.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_dataset_resource_resource_id ON dataset_resource (resource_id)'
+        ))
@@ -1,3 +1,8 @@
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+import somisana.db
 from somisana.const import SOMISANAScope
 
 
@@ -8,3 +13,20 @@ def all_scopes_excluding(scope):
 def assert_forbidden(response):
     assert response.status_code == 403
     assert response.json() == {'detail': 'Forbidden'}
+
+
+@contextmanager
+def count_queries():
+    """Context manager yielding a list that collects the SQL statements
+    executed against the database while the context is active."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = somisana.db.async_engine.sync_engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
@@ -1,8 +1,17 @@
 import somisana.api
+import somisana.db
 from collections import namedtuple
-from test.api import all_scopes_excluding
+from contextlib import contextmanager
+from sqlalchemy import select
+from test import TestSession
+from test.api import all_scopes_excluding, count_queries
+from test.benchmark import seed_catalog
 from odp.lib.hydra import HydraAdminAPI
+from somisana.api.lib.auth import introspection_cache
+from somisana.api.lib.cache import response_cache
+from somisana.db import id_allocator
 from somisana.const import SOMISANAScope, ResourceType, ResourceReferenceType
+from somisana.db.models import Product
 from starlette.testclient import TestClient
 import pytest
 
@@ -28,29 +37,38 @@ def api(request, monkeypatch):
     :param scopes: iterable of ODPScope granted to the test client/user
     """
 
-    def api_test_client(
-            scopes: list[SOMISANAScope],
-            *,
-            client_id: str = 'somisana.test.client',
-            role_id: str = 'somisana.test.role',
-            user_id: str = 'somisana.test.user'
-    ):
-        monkeypatch.setattr(HydraAdminAPI, 'introspect_token', lambda _, access_token, required_scopes: MockToken(
-            active=required_scopes[0] in scopes,
-            client_id=client_id,
-            sub=user_id if request.param == 'authorization_code' else client_id,
-        ))
+    response_cache.clear()
+    id_allocator.clear()
 
-        return TestClient(
+    with TestClient(
             app=somisana.api.app,
             headers={
                 'Accept': 'application/json',
                 'Authorization': 'Bearer t0k3n',
             }
-        )
-
-    api_test_client.grant_type = request.param
-    return api_test_client
+    ) as client:
+        def api_test_client(
+                scopes: list[SOMISANAScope],
+                *,
+                client_id: str = 'somisana.test.client',
+                role_id: str = 'somisana.test.role',
+                user_id: str = 'somisana.test.user'
+        ):
+            monkeypatch.setattr(HydraAdminAPI, 'introspect_token', lambda _, access_token, required_scopes: MockToken(
+                active=required_scopes[0] in scopes,
+                client_id=client_id,
+                sub=user_id if request.param == 'authorization_code' else client_id,
+            ))
+            introspection_cache.clear()
+
+            return client
+
+        api_test_client.grant_type = request.param
+        yield api_test_client
+
+        # The test client runs the app on its own event loop; pooled
+        # connections are bound to that loop, so release them before it closes.
+        client.portal.call(somisana.db.async_engine.dispose)
 
 
 @pytest.fixture(params=['scope_match', 'scope_mismatch'])
@@ -79,3 +97,36 @@ def scopes(request):
     elif request.param == 'scope_mismatch':
         return all_scopes_excluding(scope)
 
+
+@pytest.fixture
+def query_budget():
+    """Fixture returning a context manager that fails the calling test
+    if more SQL statements than the given budget are executed within it::
+
+        with query_budget(2):
+            r = api(scopes).get('/product/all_products')
+
+    The context manager yields the list of statements executed so far.
+    """
+
+    @contextmanager
+    def check_query_budget(max_queries: int):
+        with count_queries() as statements:
+            yield statements
+
+        assert len(statements) <= max_queries, (
+                f'{len(statements)} queries exceeded the budget of {max_queries}:\n' +
+                '\n'.join(statements)
+        )
+
+    return check_query_budget
+
+
+@pytest.fixture(params=[1, 100], ids=['1_product', '100_products'])
+def catalog(request):
+    """Fixture that seeds a catalog of 1 or 100 products, each with datasets
+    and resources, and returns the first product. Tests declaring a query
+    budget use it so that the budget must hold regardless of the size of
+    the catalog, catching N+1 queries in response model builders."""
+    seed_catalog(request.param)
+    return TestSession.scalars(select(Product).order_by(Product.id)).first()
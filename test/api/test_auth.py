@@ -0,0 +1,276 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from authlib.common.encoding import json_dumps, urlsafe_b64encode
+from authlib.jose import JsonWebKey
+
+import somisana.api.lib.auth
+from odp.lib.hydra import HydraAdminAPI
+from somisana.api.lib.auth import AUTH_JWT_ISSUER, IntrospectionCache, JWKSCache, JWKSUnavailableError, \
+    introspection_cache, jwt
+from somisana.const import SOMISANAScope
+from test.api import assert_forbidden
+from test.api.conftest import MockToken
+from test.factories import ResourceFactory
+
+
+class MockClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_introspection_cache_expires_at_ttl():
+    clock = MockClock()
+    cache = IntrospectionCache(max_size=10, ttl=60, negative_ttl=5, clock=clock)
+    token = MockToken(active=True, client_id='client', sub='client')
+
+    cache.put('t0k3n', SOMISANAScope.PRODUCT_READ, token)
+    assert cache.get('t0k3n', SOMISANAScope.PRODUCT_READ) is token
+    assert cache.get('t0k3n', SOMISANAScope.PRODUCT_ADMIN) is None
+
+    clock.now += 60
+    assert cache.get('t0k3n', SOMISANAScope.PRODUCT_READ) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_introspection_cache_expires_at_token_exp():
+    clock = MockClock()
+    cache = IntrospectionCache(max_size=10, ttl=60, negative_ttl=5, clock=clock)
+
+    class ExpiringToken:
+        active = True
+        exp = clock.now + 10
+
+    cache.put('t0k3n', SOMISANAScope.PRODUCT_READ, ExpiringToken)
+    clock.now += 10
+    assert cache.get('t0k3n', SOMISANAScope.PRODUCT_READ) is None
+
+
+def test_introspection_cache_negative_ttl():
+    clock = MockClock()
+    cache = IntrospectionCache(max_size=10, ttl=60, negative_ttl=5, clock=clock)
+    token = MockToken(active=False, client_id=None, sub=None)
+
+    cache.put('t0k3n', SOMISANAScope.PRODUCT_READ, token)
+    assert cache.get('t0k3n', SOMISANAScope.PRODUCT_READ) is token
+
+    clock.now += 5
+    assert cache.get('t0k3n', SOMISANAScope.PRODUCT_READ) is None
+
+
+def test_introspection_cache_evicts_least_recently_used():
+    cache = IntrospectionCache(max_size=2, ttl=60, negative_ttl=5, clock=MockClock())
+    token = MockToken(active=True, client_id='client', sub='client')
+
+    cache.put('a', SOMISANAScope.PRODUCT_READ, token)
+    cache.put('b', SOMISANAScope.PRODUCT_READ, token)
+    cache.get('a', SOMISANAScope.PRODUCT_READ)
+    cache.put('c', SOMISANAScope.PRODUCT_READ, token)
+
+    assert len(cache) == 2
+    assert cache.get('a', SOMISANAScope.PRODUCT_READ) is token
+    assert cache.get('b', SOMISANAScope.PRODUCT_READ) is None
+    assert cache.get('c', SOMISANAScope.PRODUCT_READ) is token
+
+
+@pytest.mark.require_scope(SOMISANAScope.RESOURCE_READ)
+def test_repeated_requests_introspect_once(api, scopes, monkeypatch):
+    authorized = SOMISANAScope.RESOURCE_READ in scopes
+
+    resource = ResourceFactory.create()
+    client = api(scopes)
+
+    introspected = []
+    introspect_token = HydraAdminAPI.introspect_token
+
+    def counting_introspect_token(self, access_token, required_scopes):
+        introspected.append(access_token)
+        return introspect_token(self, access_token, required_scopes)
+
+    monkeypatch.setattr(HydraAdminAPI, 'introspect_token', counting_introspect_token)
+
+    for _ in range(3):
+        r = client.get(f'/resource/{resource.id}')
+        if not authorized:
+            assert_forbidden(r)
+        else:
+            assert r.status_code == 200
+
+    assert len(introspected) == 1
+    assert (introspection_cache.hits, introspection_cache.misses) == (2, 1)
+
+
+def generate_key(kid):
+    return JsonWebKey.generate_key('RSA', 2048, is_private=True, options={'kid': kid})
+
+
+def issue_jwt(key, scopes, *, client_id='somisana.test.client', sub='somisana.test.client', expires_in=300,
+              scp=None):
+    now = int(time.time())
+    claims = {
+        'iss': AUTH_JWT_ISSUER,
+        'client_id': client_id,
+        'sub': sub,
+        'scp': [s.value for s in scopes] if scp is None else scp,
+        'iat': now,
+        'exp': now + expires_in,
+    }
+    return jwt.encode({'alg': 'RS256', 'kid': key.kid}, {k: v for k, v in claims.items() if v is not None}, key).decode()
+
+
+class MockJWKS:
+    def __init__(self, *keys):
+        self.keys = list(keys)
+        self.fetches = 0
+        self.failing = False
+
+    async def __call__(self):
+        self.fetches += 1
+        if self.failing:
+            raise httpx.ConnectError('Connection refused')
+        return {'keys': [key.as_dict(is_private=False) for key in self.keys]}
+
+
+def test_jwks_cache_refetches_on_unknown_kid():
+    clock = MockClock()
+    old_key, new_key = generate_key('old'), generate_key('new')
+    jwks = MockJWKS(old_key)
+    cache = JWKSCache(fetch=jwks, refresh_interval=300, min_refresh_interval=30, clock=clock)
+
+    assert asyncio.run(cache.get_key('old')).kid == 'old'
+    assert jwks.fetches == 1
+
+    # the signing key is rotated
+    jwks.keys = [new_key]
+    with pytest.raises(ValueError):
+        asyncio.run(cache.get_key('new'))
+    assert jwks.fetches == 1
+
+    clock.now += 30
+    assert asyncio.run(cache.get_key('new')).kid == 'new'
+    assert jwks.fetches == 2
+
+
+def test_jwks_cache_backs_off_failed_fetches():
+    clock = MockClock()
+    jwks = MockJWKS(generate_key('key'))
+    jwks.failing = True
+    cache = JWKSCache(fetch=jwks, refresh_interval=300, min_refresh_interval=30, clock=clock)
+
+    for _ in range(3):
+        with pytest.raises(JWKSUnavailableError):
+            asyncio.run(cache.get_key('key'))
+    assert jwks.fetches == 1
+
+    jwks.failing = False
+    clock.now += 30
+    assert asyncio.run(cache.get_key('key')).kid == 'key'
+    assert jwks.fetches == 2
+
+
+def test_jwks_cache_refreshes_in_background():
+    clock = MockClock()
+    key = generate_key('key')
+    jwks = MockJWKS(key)
+    cache = JWKSCache(fetch=jwks, refresh_interval=300, min_refresh_interval=30, clock=clock)
+
+    async def get_key_after_refresh_interval():
+        await cache.get_key('key')
+        clock.now += 300
+        # the stale key set is still used while it is refreshed
+        found = await cache.get_key('key')
+        await asyncio.sleep(0)
+        return found
+
+    assert asyncio.run(get_key_after_refresh_interval()).kid == 'key'
+    assert jwks.fetches == 2
+
+
+@pytest.mark.require_scope(SOMISANAScope.RESOURCE_READ)
+def test_jwt_authorization(api, scopes, monkeypatch):
+    authorized = SOMISANAScope.RESOURCE_READ in scopes
+
+    key = generate_key('key')
+    monkeypatch.setattr(somisana.api.lib.auth, 'jwks_cache', JWKSCache(
+        fetch=MockJWKS(key), refresh_interval=300, min_refresh_interval=30,
+    ))
+
+    resource = ResourceFactory.create()
+    client = api(scopes)
+
+    def introspect_token(self, access_token, required_scopes):
+        raise AssertionError('JWT access tokens should not be introspected')
+
+    monkeypatch.setattr(HydraAdminAPI, 'introspect_token', introspect_token)
+
+    r = client.get(f'/resource/{resource.id}', headers={'Authorization': f'Bearer {issue_jwt(key, scopes)}'})
+    if not authorized:
+        assert_forbidden(r)
+    else:
+        assert r.status_code == 200
+
+    expired_token = issue_jwt(key, scopes, expires_in=-300)
+    assert_forbidden(client.get(f'/resource/{resource.id}', headers={'Authorization': f'Bearer {expired_token}'}))
+
+    forged_token = issue_jwt(generate_key('key'), scopes)
+    assert_forbidden(client.get(f'/resource/{resource.id}', headers={'Authorization': f'Bearer {forged_token}'}))
+
+
+def test_jwt_scope_string(api, monkeypatch):
+    key = generate_key('key')
+    monkeypatch.setattr(somisana.api.lib.auth, 'jwks_cache', JWKSCache(
+        fetch=MockJWKS(key), refresh_interval=300, min_refresh_interval=30,
+    ))
+
+    resource = ResourceFactory.create()
+    client = api([SOMISANAScope.RESOURCE_READ])
+
+    token = issue_jwt(key, [], scp=f'{SOMISANAScope.PRODUCT_READ.value} {SOMISANAScope.RESOURCE_READ.value}')
+    r = client.get(f'/resource/{resource.id}', headers={'Authorization': f'Bearer {token}'})
+    assert r.status_code == 200
+
+    # scopes are matched whole, not as substrings of the scope string
+    token = issue_jwt(key, [], scp=f'{SOMISANAScope.RESOURCE_READ.value}only')
+    assert_forbidden(client.get(f'/resource/{resource.id}', headers={'Authorization': f'Bearer {token}'}))
+
+
+def test_jwt_malformed(api, monkeypatch):
+    key = generate_key('key')
+    monkeypatch.setattr(somisana.api.lib.auth, 'jwks_cache', JWKSCache(
+        fetch=MockJWKS(key), refresh_interval=300, min_refresh_interval=30,
+    ))
+
+    resource = ResourceFactory.create()
+    client = api([SOMISANAScope.RESOURCE_READ])
+    scopes = [SOMISANAScope.RESOURCE_READ]
+
+    non_object_header = urlsafe_b64encode(json_dumps(['RS256']).encode()).decode().rstrip('=')
+    tokens = [
+        f'{non_object_header}.e30.c2ln',
+        issue_jwt(key, scopes, client_id=None),
+        issue_jwt(key, scopes, sub=None),
+    ]
+    for token in tokens:
+        assert_forbidden(client.get(f'/resource/{resource.id}', headers={'Authorization': f'Bearer {token}'}))
+
+
+def test_jwks_unavailable(api, monkeypatch):
+    jwks = MockJWKS(generate_key('key'))
+    jwks.failing = True
+    monkeypatch.setattr(somisana.api.lib.auth, 'jwks_cache', JWKSCache(
+        fetch=jwks, refresh_interval=300, min_refresh_interval=30,
+    ))
+
+    resource = ResourceFactory.create()
+    client = api([SOMISANAScope.RESOURCE_READ])
+    token = issue_jwt(generate_key('key'), [SOMISANAScope.RESOURCE_READ])
+
+    for _ in range(2):
+        r = client.get(f'/resource/{resource.id}', headers={'Authorization': f'Bearer {token}'})
+        assert r.status_code == 503
+    assert jwks.fetches == 1
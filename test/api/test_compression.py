@@ -0,0 +1,184 @@
+import gzip
+import threading
+from unittest.mock import patch
+
+import brotli
+import pytest
+from starlette.responses import StreamingResponse
+from starlette.testclient import TestClient
+
+import somisana.api.lib.cache
+import somisana.api.lib.compression
+from somisana.api.lib.cache import CachedResponse, ResponseCache
+from somisana.api.lib.compression import CompressionMiddleware, accepted_encodings, negotiate_encoding
+from somisana.const import SOMISANAScope
+from test.api import count_queries
+from test.factories import ProductFactory, ProductResourceFactory, ResourceFactory
+
+
+def decompress(data, encoding):
+    if encoding == 'br':
+        return brotli.decompress(data)
+    return gzip.decompress(data)
+
+
+def test_negotiate_brotli():
+    assert negotiate_encoding('gzip, deflate, br') == 'br'
+
+
+@pytest.mark.parametrize('accept_encoding, encoding', [
+    ('gzip, deflate', 'gzip'),
+    ('br;q=0, gzip;q=0.5', 'gzip'),
+    ('GZIP', 'gzip'),
+    ('identity', None),
+    ('gzip;q=0', None),
+    ('', None),
+    (None, None),
+])
+def test_negotiate_encoding(accept_encoding, encoding):
+    assert negotiate_encoding(accept_encoding) == encoding
+
+
+def test_accepted_encodings():
+    assert accepted_encodings('gzip;q=1.0, br;q=0, deflate;q=bad, identity') == {'gzip', 'identity'}
+
+
+def fetch_raw(client, path, accept_encoding):
+    """Return the response to a GET request, with its body as sent on the
+    wire; the test client would otherwise decode it."""
+    with client.stream('GET', path, headers={'Accept-Encoding': accept_encoding}) as r:
+        r.raw_body = b''.join(r.iter_raw())
+    return r
+
+
+@pytest.mark.parametrize('encoding', ['br', 'gzip'])
+def test_cached_response_compression(api, encoding):
+    client = api([SOMISANAScope.PRODUCT_READ])
+    ProductFactory.create_batch(10)
+
+    identity_r = fetch_raw(client, '/product/all_products', 'identity')
+    assert 'Content-Encoding' not in identity_r.headers
+    assert identity_r.headers['Vary'] == 'Accept-Encoding'
+    etag = identity_r.headers['ETag']
+
+    r = fetch_raw(client, '/product/all_products', encoding)
+    assert r.headers['Content-Encoding'] == encoding
+    assert r.headers['Vary'] == 'Accept-Encoding'
+    assert r.headers['ETag'] == f'W/{etag}'
+    assert len(r.raw_body) < len(identity_r.raw_body)
+    assert decompress(r.raw_body, encoding) == identity_r.raw_body
+
+    # the compressed variant is cached along with the body
+    with count_queries() as queries, patch(
+            'somisana.api.lib.cache.compress_off_loop', wraps=somisana.api.lib.cache.compress_off_loop
+    ) as compress_off_loop:
+        cached_r = fetch_raw(client, '/product/all_products', encoding)
+
+    assert not queries
+    assert not compress_off_loop.called
+    assert cached_r.raw_body == r.raw_body
+    assert cached_r.headers['ETag'] == r.headers['ETag']
+
+
+def test_cached_response_not_modified(api):
+    client = api([SOMISANAScope.PRODUCT_READ])
+    ProductFactory.create_batch(10)
+
+    r = client.get('/product/all_products', headers={'Accept-Encoding': 'gzip'})
+    assert r.headers['Content-Encoding'] == 'gzip'
+
+    # a weak ETag matches the same representation in any content coding
+    for accept_encoding in 'gzip', 'deflate', 'identity':
+        not_modified_r = client.get('/product/all_products', headers={
+            'Accept-Encoding': accept_encoding,
+            'If-None-Match': r.headers['ETag'],
+        })
+        assert not_modified_r.status_code == 304
+        assert not not_modified_r.content
+
+
+def test_small_response_not_compressed(api):
+    client = api([SOMISANAScope.RESOURCE_READ, SOMISANAScope.PRODUCT_READ])
+    resource = ResourceFactory.create()
+
+    r = client.get(f'/resource/{resource.id}', headers={'Accept-Encoding': 'gzip, br'})
+    assert r.status_code == 200
+    assert 'Content-Encoding' not in r.headers
+    assert r.json()['title'] == resource.title
+
+
+def test_uncached_response_compression(api):
+    client = api([SOMISANAScope.RESOURCE_READ, SOMISANAScope.PRODUCT_READ])
+    product = ProductFactory.create()
+    ProductResourceFactory.create_batch(20, product=product)
+
+    identity_r = fetch_raw(client, f'/product/{product.id}/resources/', 'identity')
+    assert 'Content-Encoding' not in identity_r.headers
+    assert len(identity_r.raw_body) >= 1024
+
+    for encoding in 'br', 'gzip':
+        r = fetch_raw(client, f'/product/{product.id}/resources/', encoding)
+        assert r.headers['Content-Encoding'] == encoding
+        assert r.headers['Vary'] == 'Accept-Encoding'
+        assert int(r.headers['Content-Length']) == len(r.raw_body)
+        assert decompress(r.raw_body, encoding) == identity_r.raw_body
+
+
+def test_streamed_response_compression():
+    chunks = [f'line {i}\n'.encode() * 100 for i in range(10)]
+
+    async def app(scope, receive, send):
+        await StreamingResponse(iter(chunks), media_type='text/csv')(scope, receive, send)
+
+    client = TestClient(CompressionMiddleware(app))
+    with client.stream('GET', '/', headers={'Accept-Encoding': 'gzip'}) as r:
+        raw_body = b''.join(r.iter_raw())
+
+    assert r.headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Length' not in r.headers
+    assert gzip.decompress(raw_body) == b''.join(chunks)
+
+
+def test_response_cache_max_bytes():
+    cache = ResponseCache(max_size=10, max_bytes=1000)
+
+    for key in 'a', 'b', 'c':
+        cache.put(key, CachedResponse(body=b'x' * 300, etag='"etag"'), cache.generation)
+    assert cache.nbytes == 900
+
+    # compressed variants count towards the size of the cache
+    cache.add_encoded_body('a', cache.get('a'), 'gzip', b'x' * 200)
+    assert cache.nbytes == 800
+    assert cache.get('b') is None
+    assert len(cache) == 2
+
+    # entries larger than the cache are not stored
+    cache.put('d', CachedResponse(body=b'x' * 1001, etag='"etag"'), cache.generation)
+    assert cache.get('d') is None
+    assert cache.nbytes == 800
+
+
+def test_large_body_compressed_off_loop(monkeypatch):
+    monkeypatch.setattr(somisana.api.lib.compression, 'COMPRESSION_THREAD_MIN_SIZE', 2048)
+    threads = []
+    compress = somisana.api.lib.compression.compress
+
+    def recording_compress(data, encoding):
+        threads.append(threading.current_thread())
+        return compress(data, encoding)
+
+    monkeypatch.setattr(somisana.api.lib.compression, 'compress', recording_compress)
+    body = b'x' * 4096
+    loop_threads = []
+
+    async def app(scope, receive, send):
+        loop_threads.append(threading.current_thread())
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    client = TestClient(CompressionMiddleware(app))
+    r = client.get('/', headers={'Accept-Encoding': 'gzip'})
+
+    assert r.content == body
+    assert len(threads) == 1
+    assert threads[0] is not loop_threads[0]
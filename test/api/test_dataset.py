@@ -1,16 +1,31 @@
 import filecmp
+import hashlib
+import os
 import shutil
+import time
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
+import numpy as np
 import pytest
+import xarray as xr
+from fastapi import HTTPException
 
+import somisana.api.lib.file_index
 from somisana.api.lib import local_resource_folder_path
+from somisana.api.lib.cache import response_cache
+from somisana.api.lib.derivatives import derivative_pipeline
+from somisana.api.lib.file_index import index_dataset_folder
+from somisana.api.lib.file_removal import file_remover
+from somisana.api.lib.subset import SubsetQuery, subset_files
 from somisana.const import SOMISANAScope, ResourceType, ResourceReferenceType
+from somisana.db.spatial import BoundingBox
 from test import TestSession
-from somisana.db.models import Dataset, Resource
+from somisana.db.models import Dataset, Resource, DatasetFile
 from test.api import assert_forbidden
 from test.api.lib import compare_datasets, compare_resources
-from test.factories import DatasetFactory, ProductFactory, ResourceFactory, DatasetResourceFactory
+from test.factories import DatasetFactory, ProductFactory, ResourceFactory, DatasetResourceFactory, \
+    ProductVersionFactory
 
 
 @pytest.mark.require_scope(SOMISANAScope.DATASET_READ)
@@ -28,6 +43,52 @@ def test_list_datasets(api, scopes):
         assert len(r.json()) == batch_size
 
 
+@pytest.mark.require_scope(SOMISANAScope.DATASET_READ)
+def test_list_datasets_pagination(api, scopes):
+    authorized = SOMISANAScope.DATASET_READ in scopes
+
+    datasets = DatasetFactory.create_batch(5)
+
+    r = api(scopes).get('/dataset/all/', params={'limit': 2})
+
+    if not authorized:
+        assert_forbidden(r)
+    else:
+        pages = [r.json()]
+        assert r.headers['Link'] == f'</dataset/all?cursor={datasets[1].id}&limit=2>; rel="next"'
+        while 'next' in r.links:
+            r = api(scopes).get(r.links['next']['url'])
+            pages.append(r.json())
+
+        assert [len(page) for page in pages] == [2, 2, 1]
+        assert [dataset['id'] for page in pages for dataset in page] == sorted(dataset.id for dataset in datasets)
+
+
+@pytest.mark.require_scope(SOMISANAScope.DATASET_READ)
+def test_list_datasets_filters(api, scopes):
+    authorized = SOMISANAScope.DATASET_READ in scopes
+
+    superseded_product = ProductFactory.create()
+    ProductVersionFactory.create(superseded_product=superseded_product)
+
+    superseded_dataset = DatasetFactory.create(product=superseded_product, visualize=True)
+    visualized_dataset = DatasetFactory.create(visualize=True)
+    hidden_dataset = DatasetFactory.create(visualize=False)
+
+    r = api(scopes).get('/dataset/all/', params={'visualize': True, 'superseded': False})
+
+    if not authorized:
+        assert_forbidden(r)
+    else:
+        assert [dataset['id'] for dataset in r.json()] == [visualized_dataset.id]
+
+        r = api(scopes).get('/dataset/all/', params={'superseded': True})
+        assert [dataset['id'] for dataset in r.json()] == [superseded_dataset.id]
+
+        r = api(scopes).get('/dataset/all/', params={'type': hidden_dataset.type, 'visualize': False})
+        assert [dataset['id'] for dataset in r.json()] == [hidden_dataset.id]
+
+
 @pytest.mark.require_scope(SOMISANAScope.DATASET_READ)
 def test_list_product_datasets(api, scopes):
     authorized = SOMISANAScope.DATASET_READ in scopes
@@ -194,4 +255,329 @@ def test_add_file_resource(api, scopes):
 
         assert filecmp.cmp(mock_file_path, f'{stored_resource_path}/{file_name}', shallow=False)
 
-        shutil.rmtree(stored_resource_path)
\ No newline at end of file
+        api(scopes).portal.call(derivative_pipeline.drain)
+        shutil.rmtree(stored_resource_path)
+
+@pytest.fixture
+def dataset_folder_root(tmp_path, monkeypatch):
+    """Configure tmp_path as the directory under which dataset folders lie."""
+    monkeypatch.setattr(somisana.api.lib.file_index, 'DATASET_FOLDER_ROOT', str(tmp_path))
+    return tmp_path
+
+
+def write_files(root, files, age):
+    """Write files under root, then set the modification times of the
+    files and of every directory to ``age`` seconds ago, so that the index
+    treats them as settled."""
+    mtime_ns = time.time_ns() - age * 1_000_000_000
+    for path, content in files.items():
+        (root / path).parent.mkdir(parents=True, exist_ok=True)
+        (root / path).write_bytes(content)
+        os.utime(root / path, ns=(mtime_ns, mtime_ns))
+
+    for directory, _, _ in os.walk(root):
+        os.utime(directory, ns=(mtime_ns, mtime_ns))
+
+
+@pytest.mark.require_scope(SOMISANAScope.DATASET_ADMIN)
+def test_scan_dataset_files(api, scopes, tmp_path, dataset_folder_root, monkeypatch):
+    authorized = SOMISANAScope.DATASET_ADMIN in scopes
+    monkeypatch.setattr(somisana.api.lib.file_index, 'FILE_INDEX_CHECKSUMS', True)
+
+    write_files(tmp_path, {
+        'a.nc': b'a' * 10,
+        'b.nc': b'b' * 20,
+        'sub/c.nc': b'c' * 30,
+        'sub/deep/d.nc': b'd' * 40,
+    }, age=100)
+    dataset = DatasetFactory.create(folder_path=str(tmp_path))
+
+    r = api(scopes).post(f'/dataset/{dataset.id}/files/scan')
+
+    if not authorized:
+        assert_forbidden(r)
+    else:
+        assert r.json() == dict(directories_listed=3, directories_unchanged=0,
+                                files_added=4, files_updated=0, files_removed=0)
+
+        indexed = {f.path: f for f in TestSession.query(DatasetFile).filter_by(dataset_id=dataset.id)}
+        assert sorted(indexed) == ['a.nc', 'b.nc', 'sub/c.nc', 'sub/deep/d.nc']
+        assert indexed['sub/c.nc'].directory == 'sub'
+        assert indexed['sub/c.nc'].size == 30
+        assert indexed['sub/c.nc'].checksum == hashlib.sha256(b'c' * 30).hexdigest()
+
+        # nothing has changed, so no directory is listed
+        r = api(scopes).post(f'/dataset/{dataset.id}/files/scan')
+        assert r.json() == dict(directories_listed=0, directories_unchanged=3,
+                                files_added=0, files_updated=0, files_removed=0)
+
+        (tmp_path / 'a.nc').unlink()
+        shutil.rmtree(tmp_path / 'sub/deep')
+        write_files(tmp_path, {'sub/e.nc': b'e' * 50}, age=50)
+
+        r = api(scopes).post(f'/dataset/{dataset.id}/files/scan')
+        assert r.json() == dict(directories_listed=2, directories_unchanged=0,
+                                files_added=1, files_updated=0, files_removed=2)
+
+        TestSession.expire_all()
+        assert sorted(f.path for f in TestSession.query(DatasetFile).filter_by(dataset_id=dataset.id)) == [
+            'b.nc', 'sub/c.nc', 'sub/e.nc'
+        ]
+
+        # a full scan also finds files rewritten in place
+        (tmp_path / 'b.nc').write_bytes(b'B' * 25)
+        r = api(scopes).post(f'/dataset/{dataset.id}/files/scan', params={'full': True})
+        assert r.json() == dict(directories_listed=2, directories_unchanged=0,
+                                files_added=0, files_updated=1, files_removed=0)
+
+
+def test_scan_dataset_files_recent_changes(api, tmp_path, dataset_folder_root):
+    client = api([SOMISANAScope.DATASET_ADMIN])
+
+    write_files(tmp_path, {'a.nc': b'a'}, age=0)
+    dataset = DatasetFactory.create(folder_path=str(tmp_path))
+
+    assert client.post(f'/dataset/{dataset.id}/files/scan').json()['files_added'] == 1
+
+    # the folder may still be changing within its timestamp resolution
+    assert client.post(f'/dataset/{dataset.id}/files/scan').json()['directories_listed'] == 1
+
+
+def test_index_dataset_folder_idle(api, tmp_path, dataset_folder_root):
+    client = api([SOMISANAScope.DATASET_READ])
+
+    write_files(tmp_path, {'recent/c.nc': b'c'}, age=0)
+    write_files(tmp_path, {'a.nc': b'a', 'sub/b.nc': b'b'}, age=100)
+    dataset = DatasetFactory.create(folder_path=str(tmp_path))
+
+    generation = response_cache.generation
+    assert client.portal.call(index_dataset_folder, dataset.id).files_added == 3
+
+    # the change is applied locally, and notified to every process
+    deadline = time.monotonic() + 5
+    while response_cache.generation < generation + 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert response_cache.generation == generation + 2
+
+    # an idle rescan, including of a recently changed directory that is
+    # listed again, leaves cached responses alone
+    generation = response_cache.generation
+    result = client.portal.call(index_dataset_folder, dataset.id)
+    assert (result.directories_listed, result.files_added, result.files_updated, result.files_removed) == (1, 0, 0, 0)
+    time.sleep(0.5)
+    assert response_cache.generation == generation
+
+
+def test_scan_dataset_files_missing_folder(api, tmp_path, dataset_folder_root):
+    dataset = DatasetFactory.create(folder_path=str(tmp_path / 'missing'))
+
+    r = api([SOMISANAScope.DATASET_ADMIN]).post(f'/dataset/{dataset.id}/files/scan')
+    assert r.status_code == 409
+
+
+def test_scan_dataset_files_outside_root(api, tmp_path, monkeypatch):
+    write_files(tmp_path, {'data/a.nc': b'a', 'other/b.nc': b'b'}, age=100)
+    client = api([SOMISANAScope.DATASET_ADMIN])
+
+    # folders are not indexed until a root is configured
+    dataset = DatasetFactory.create(folder_path=str(tmp_path / 'other'))
+    assert client.post(f'/dataset/{dataset.id}/files/scan').status_code == 409
+
+    monkeypatch.setattr(somisana.api.lib.file_index, 'DATASET_FOLDER_ROOT', str(tmp_path / 'data'))
+    for folder_path in str(tmp_path / 'other'), '../other':
+        dataset = DatasetFactory.create(folder_path=folder_path)
+        assert client.post(f'/dataset/{dataset.id}/files/scan').status_code == 409
+
+    dataset = DatasetFactory.create(folder_path='.')
+    assert client.post(f'/dataset/{dataset.id}/files/scan').json()['files_added'] == 1
+
+
+@pytest.mark.require_scope(SOMISANAScope.DATASET_READ)
+def test_list_dataset_files(api, scopes, tmp_path, dataset_folder_root):
+    authorized = SOMISANAScope.DATASET_READ in scopes
+
+    write_files(tmp_path, {f'{i:03}.nc': bytes(i) for i in range(5)}, age=100)
+    dataset = DatasetFactory.create(folder_path=str(tmp_path))
+    api([SOMISANAScope.DATASET_ADMIN]).post(f'/dataset/{dataset.id}/files/scan')
+
+    r = api(scopes).get(f'/dataset/{dataset.id}/files', params={'limit': 3})
+
+    if not authorized:
+        assert_forbidden(r)
+    else:
+        first_page = r.json()
+        assert len(first_page) == 3
+        assert 'rel="next"' in r.headers['Link']
+
+        r = api(scopes).get(f'/dataset/{dataset.id}/files', params={'limit': 3, 'cursor': first_page[-1]['id']})
+        files = first_page + r.json()
+        assert sorted((f['path'], f['size']) for f in files) == [(f'{i:03}.nc', i) for i in range(5)]
+        # checksums are not recorded by default
+        assert all(f['checksum'] is None for f in files)
+
+        assert api(scopes).get('/dataset/999999/files').status_code == 404
+
+
+@pytest.fixture
+def netcdf_dataset(tmp_path, dataset_folder_root):
+    """A dataset whose folder holds two synthetic NetCDF files of three
+    daily time steps each, on a 4x5 grid with three depth levels."""
+    lon = np.array([15.0, 16.0, 17.0, 18.0, 19.0])
+    lat = np.array([-36.0, -35.0, -34.0, -33.0])
+    depth = np.array([0.0, 10.0, 50.0])
+    for i, start in enumerate(('2024-01-01', '2024-01-04')):
+        time_ = np.arange(np.datetime64(start), np.datetime64(start) + 3, dtype='datetime64[D]').astype('datetime64[ns]')
+        shape = (len(time_), len(depth), len(lat), len(lon))
+        values = np.arange(np.prod(shape), dtype='float32').reshape(shape) + 1000 * i
+        xr.Dataset(
+            data_vars=dict(
+                temp=(('time', 'depth', 'lat', 'lon'), values),
+                salt=(('time', 'depth', 'lat', 'lon'), values + 0.5),
+            ),
+            coords=dict(time=time_, depth=depth, lat=lat, lon=lon),
+        ).to_netcdf(tmp_path / f'model_{i}.nc')
+
+    mtime_ns = time.time_ns() - 100 * 1_000_000_000
+    for path in tmp_path.iterdir():
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+    os.utime(tmp_path, ns=(mtime_ns, mtime_ns))
+
+    return DatasetFactory.create(folder_path=str(tmp_path))
+
+
+@pytest.mark.require_scope(SOMISANAScope.DATASET_READ)
+def test_subset_dataset(api, scopes, netcdf_dataset, tmp_path_factory):
+    authorized = SOMISANAScope.DATASET_READ in scopes
+
+    api([SOMISANAScope.DATASET_ADMIN]).post(f'/dataset/{netcdf_dataset.id}/files/scan')
+
+    # times with an offset are converted to UTC
+    r = api(scopes).get(f'/dataset/{netcdf_dataset.id}/subset', params={
+        'bbox': '16,-35,18,-34',
+        'time_start': '2024-01-03T02:00:00+02:00',
+        'time_end': '2024-01-03T22:00:00-02:00',
+        'depth_max': 10,
+        'variable': ['temp'],
+    })
+
+    if not authorized:
+        assert_forbidden(r)
+    else:
+        assert r.status_code == 200
+        assert r.headers['Content-Type'] == 'application/x-netcdf'
+
+        subset_path = tmp_path_factory.mktemp('subset') / 'subset.nc'
+        subset_path.write_bytes(r.content)
+        with xr.open_dataset(subset_path) as subset:
+            assert list(subset.data_vars) == ['temp']
+            assert dict(subset.sizes) == dict(time=2, depth=2, lat=2, lon=3)
+            assert subset.lon.values.tolist() == [16.0, 17.0, 18.0]
+            assert subset.lat.values.tolist() == [-35.0, -34.0]
+            # the last step of the first file, then the first step of the second
+            assert subset.temp.values[0, 0, 0, 0] == 2 * 60 + 5 + 1
+            assert subset.temp.values[1, 0, 0, 0] == 1000 + 5 + 1
+
+
+def test_subset_dataset_csv(api, netcdf_dataset):
+    client = api([SOMISANAScope.DATASET_ADMIN, SOMISANAScope.DATASET_READ])
+    client.post(f'/dataset/{netcdf_dataset.id}/files/scan')
+
+    r = client.get(f'/dataset/{netcdf_dataset.id}/subset', params={
+        'bbox': '19,-33,19,-33',
+        'time_end': '2024-01-01T00:00:00',
+        'variable': ['salt'],
+        'format': 'csv',
+    })
+    assert r.status_code == 200
+    assert r.headers['Content-Type'].startswith('text/csv')
+
+    lines = r.text.splitlines()
+    assert lines[0].split(',') == ['time', 'depth', 'lat', 'lon', 'salt']
+    assert [line.split(',')[-1] for line in lines[1:]] == ['19.5', '39.5', '59.5']
+
+    # rows are written a time step at a time, under a single header
+    r = client.get(f'/dataset/{netcdf_dataset.id}/subset', params={'variable': ['salt'], 'format': 'csv'})
+    lines = r.text.splitlines()
+    assert lines.count(lines[0]) == 1
+    assert len(lines) == 1 + 6 * 3 * 4 * 5
+    assert [line.split(',')[0] for line in lines[1::3 * 4 * 5]] == [
+        f'2024-01-0{day}' for day in range(1, 7)
+    ]
+
+
+def test_subset_dataset_invalid(api, netcdf_dataset, monkeypatch):
+    client = api([SOMISANAScope.DATASET_ADMIN, SOMISANAScope.DATASET_READ])
+    url = f'/dataset/{netcdf_dataset.id}/subset'
+
+    # nothing is indexed yet
+    assert client.get(url).status_code == 404
+
+    client.post(f'/dataset/{netcdf_dataset.id}/files/scan')
+    assert client.get(url, params={'bbox': '16,-35'}).status_code == 422
+    assert client.get(url, params={'variable': ['oxygen']}).status_code == 422
+    assert client.get(url, params={'time_start': '2030-01-01T00:00:00'}).status_code == 404
+
+    monkeypatch.setattr('somisana.api.lib.subset.SUBSET_MAX_SIZE', 1000)
+    assert client.get(url).status_code == 413
+    assert client.get(url, params={'bbox': '15,-36,15,-36', 'variable': ['temp']}).status_code == 200
+
+    # each file holds 1560 bytes; combining files needs twice their size
+    monkeypatch.setattr('somisana.api.lib.subset.SUBSET_MAX_SIZE', 5000)
+    assert client.get(url, params={'time_end': '2024-01-03T00:00:00'}).status_code == 200
+    assert client.get(url).status_code == 413
+
+
+def test_subset_noleap_calendar(tmp_path):
+    xr.Dataset(
+        data_vars=dict(temp=(('time',), np.arange(4, dtype='float32'))),
+        coords=dict(time=('time', np.arange(4), dict(units='days since 2024-02-27', calendar='noleap'))),
+    ).to_netcdf(tmp_path / 'model.nc')
+    path = str(tmp_path / 'model.nc')
+
+    # times are compared in the calendar of the file, in which 2024 has no 29 February
+    subset = subset_files([path], SubsetQuery(
+        time_start=datetime(2024, 2, 28, 1, tzinfo=timezone(timedelta(hours=2))),
+        time_end=datetime(2024, 3, 1, 12),
+    ))
+    assert subset.temp.values.tolist() == [1.0, 2.0]
+    assert [t.isoformat() for t in subset.time.values] == ['2024-02-28T00:00:00', '2024-03-01T00:00:00']
+
+    with pytest.raises(HTTPException) as exc_info:
+        subset_files([path], SubsetQuery(time_start=datetime(2024, 2, 29)))
+    assert exc_info.value.status_code == 422
+
+
+@pytest.mark.parametrize('bbox, lons', [
+    (BoundingBox(170, -10, 180, 10), [170.0, 175.0, 180.0]),
+    (BoundingBox(-180, -10, -170, 10), [180.0, -175.0, -170.0]),
+    (BoundingBox(175, -10, -175, 10), [175.0, 180.0, -175.0]),
+])
+def test_subset_antimeridian(tmp_path, bbox, lons):
+    lon = np.array([165.0, 170.0, 175.0, 180.0, -175.0, -170.0])
+    xr.Dataset(
+        data_vars=dict(temp=(('lat', 'lon'), np.zeros((1, len(lon)), dtype='float32'))),
+        coords=dict(lat=[0.0], lon=lon),
+    ).to_netcdf(tmp_path / 'pacific.nc')
+
+    subset = subset_files([str(tmp_path / 'pacific.nc')], SubsetQuery(bbox=bbox))
+    assert subset.lon.values.tolist() == lons
+
+
+@pytest.mark.parametrize('method, path, budget', [
+    ('GET', '/dataset/all', 1),
+    ('GET', '/dataset/product_datasets/{product_id}', 1),
+    ('GET', '/dataset/{dataset_id}', 2),
+    ('GET', '/dataset/{dataset_id}/files', 2),
+    # set-based deletes, and the catalog change notification
+    ('DELETE', '/dataset/{dataset_id}', 3),
+])
+def test_dataset_query_budget(api, catalog, query_budget, method, path, budget):
+    client = api([SOMISANAScope.DATASET_READ, SOMISANAScope.DATASET_ADMIN])
+
+    with query_budget(budget):
+        r = client.request(method, path.format(product_id=catalog.id, dataset_id=catalog.datasets[0].id))
+
+    # files of deleted resources are removed by a worker after the response, outside the budget
+    client.portal.call(file_remover.drain)
+
+    assert r.status_code == 200
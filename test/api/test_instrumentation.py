@@ -0,0 +1,74 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import somisana.db
+from somisana.const import SOMISANAScope
+from somisana.db import AsyncSessionLocal
+from somisana.db.pool import InstrumentedAsyncQueuePool, instrument_pool, pool_stats
+from test.api import assert_forbidden
+from test.factories import ProductFactory
+
+
+@pytest.mark.require_scope(SOMISANAScope.PRODUCT_ADMIN)
+def test_pool_status_authorization(api, scopes):
+    r = api(scopes).get('/instrumentation/pool')
+
+    if SOMISANAScope.PRODUCT_ADMIN not in scopes:
+        assert_forbidden(r)
+    else:
+        assert r.status_code == 200
+
+
+def test_pool_status(api):
+    client = api([SOMISANAScope.PRODUCT_READ, SOMISANAScope.PRODUCT_ADMIN])
+    ProductFactory.create()
+
+    before = client.get('/instrumentation/pool').json()
+    client.get('/product/all_products')
+    after = client.get('/instrumentation/pool').json()
+
+    assert after['size'] == somisana.db.DB_POOL_SIZE
+    assert after['max_overflow'] == somisana.db.DB_MAX_OVERFLOW
+    assert after['checked_out'] == 0
+    assert after['checkouts'] > before['checkouts']
+    assert after['checkins'] - before['checkins'] == after['checkouts'] - before['checkouts']
+    assert after['wait_seconds_total'] >= before['wait_seconds_total']
+
+
+def test_statement_timeout(api):
+    client = api([])
+
+    async def show_statement_timeout():
+        async with AsyncSessionLocal() as session:
+            return (await session.execute(
+                text("SELECT setting FROM pg_settings WHERE name = 'statement_timeout'")
+            )).scalar()
+
+    assert client.portal.call(show_statement_timeout) == str(somisana.db.DB_STATEMENT_TIMEOUT)
+
+
+def test_pool_timeouts(api):
+    client = api([])
+    engine = create_async_engine(
+        somisana.db.async_engine.url,
+        poolclass=InstrumentedAsyncQueuePool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=0.1,
+    )
+    instrument_pool(engine.sync_engine)
+
+    async def exhaust_pool():
+        async with engine.connect():
+            with pytest.raises(PoolTimeoutError):
+                async with engine.connect():
+                    pass
+        await engine.dispose()
+
+    timeouts = pool_stats.timeouts
+    client.portal.call(exhaust_pool)
+
+    assert pool_stats.timeouts == timeouts + 1
+    assert pool_stats.wait_seconds_max >= 0.1
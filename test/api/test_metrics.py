@@ -0,0 +1,78 @@
+import os
+
+import pytest
+from prometheus_client import REGISTRY
+
+from somisana.const import SOMISANAScope
+from test.api import assert_forbidden
+from test.factories import ProductFactory
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_request_metrics(api):
+    client = api([SOMISANAScope.PRODUCT_READ])
+    ProductFactory.create_batch(2)
+    labels = dict(method='GET', route='/product/all_products')
+
+    requests = sample('somisana_http_requests_total', status='200', **labels)
+    db_queries = sample('somisana_http_request_db_queries_sum', **labels)
+    db_seconds = sample('somisana_http_request_db_seconds_sum', **labels)
+    auth_seconds = sample('somisana_http_request_auth_seconds_sum', **labels)
+
+    assert client.get('/product/all_products').status_code == 200
+
+    assert sample('somisana_http_requests_total', status='200', **labels) == requests + 1
+    assert sample('somisana_http_request_duration_seconds_count', **labels) > 0
+    assert sample('somisana_http_request_db_queries_sum', **labels) > db_queries
+    assert sample('somisana_http_request_db_seconds_sum', **labels) > db_seconds
+    assert sample('somisana_http_request_auth_seconds_sum', **labels) > auth_seconds
+    assert sample('somisana_http_requests_in_progress', method='GET') == 0
+
+    client.get('/no/such/route')
+    assert sample('somisana_http_requests_total', method='GET', route='unmatched', status='404') > 0
+
+
+def test_request_body_metrics(api):
+    client = api([SOMISANAScope.PRODUCT_ADMIN])
+    labels = dict(method='POST', route='/product/')
+    body_bytes = sample('somisana_http_request_body_bytes_total', **labels)
+
+    r = client.post('/product/', json=dict(
+        title='Title', description='Description', north_bound=1, south_bound=0, east_bound=1, west_bound=0,
+        horizontal_resolution='1km', vertical_extent='0-100m', vertical_resolution='1m',
+        temporal_extent='2024', temporal_resolution='1h', variables='temp',
+    ))
+    assert r.status_code == 200
+
+    assert sample('somisana_http_request_body_bytes_total', **labels) == body_bytes + len(r.request.content)
+
+
+@pytest.mark.require_scope(SOMISANAScope.PRODUCT_ADMIN)
+def test_metrics_endpoint(api, scopes):
+    authorized = SOMISANAScope.PRODUCT_ADMIN in scopes
+
+    r = api(scopes).get('/metrics')
+
+    if not authorized:
+        assert_forbidden(r)
+    else:
+        assert r.status_code == 200
+        assert r.headers['Content-Type'].startswith('text/plain')
+        assert 'somisana_http_requests_total{' in r.text
+        assert 'somisana_db_pool_checked_out ' in r.text
+        assert 'somisana_db_queries_total ' in r.text
+
+
+def test_metrics_endpoint_multiprocess(api, tmp_path, monkeypatch):
+    client = api([SOMISANAScope.PRODUCT_ADMIN])
+    monkeypatch.setenv('PROMETHEUS_MULTIPROC_DIR', str(tmp_path))
+
+    r = client.get('/metrics')
+
+    assert r.status_code == 200
+    # the pool of the worker serving the scrape, alongside the combined metrics
+    assert f'somisana_db_pool_checked_out{{pid="{os.getpid()}"}} ' in r.text
+    assert f'somisana_db_pool_checkouts_total{{pid="{os.getpid()}"}} ' in r.text
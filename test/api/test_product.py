@@ -1,14 +1,23 @@
 import filecmp
+import hashlib
+import io
+import os
 import shutil
 from pathlib import Path
 
 import pytest
+from PIL import Image
 
+import somisana.api.lib
 from somisana.api.lib import local_resource_folder_path
+from somisana.api.lib.cache import response_cache
+from somisana.api.lib.derivatives import derivative_pipeline
+from somisana.api.lib.file_removal import file_remover
+from somisana.api.lib.files import write_precompressed_variants
 from somisana.const import SOMISANAScope, ResourceType, ResourceReferenceType
-from somisana.db.models import Product, Resource
+from somisana.db.models import Product, Resource, ResourceRendition, Dataset, ProductVersion
 from test import TestSession
-from test.api import assert_forbidden
+from test.api import assert_forbidden, count_queries
 from test.api.lib import compare_datasets, compare_resources, compare_products
 from test.factories import ProductFactory, DatasetFactory, ResourceFactory, ProductVersionFactory, \
     DatasetResourceFactory, ProductResourceFactory
@@ -35,6 +44,212 @@ def test_get_catalog_products(api, scopes):
         assert all(product['id'] != superseded_product.id for product in catalog_products)
 
 
+def create_product_graph():
+    """Create a product with a superseded version, a dataset and resources
+    on both the product and the dataset."""
+    product = ProductFactory.create()
+    ProductVersionFactory.create(product=product, superseded_product=ProductFactory.create())
+
+    dataset = DatasetFactory.create(product=product)
+    DatasetResourceFactory.create(dataset=dataset, resource=ResourceFactory.create())
+    DatasetResourceFactory.create(dataset=dataset, resource=ResourceFactory.create())
+
+    ProductResourceFactory.create(product=product, resource=ResourceFactory.create())
+
+    return product
+
+
+@pytest.mark.require_scope(SOMISANAScope.PRODUCT_READ)
+def test_list_products_filter_superseded(api, scopes):
+    authorized = SOMISANAScope.PRODUCT_READ in scopes
+
+    product_version = ProductVersionFactory.create()
+
+    r = api(scopes).get('/product/all_products', params={'superseded': True})
+
+    if not authorized:
+        assert_forbidden(r)
+    else:
+        assert [product['id'] for product in r.json()] == [product_version.superseded_product.id]
+
+        r = api(scopes).get('/product/all_products', params={'superseded': False})
+        assert [product['id'] for product in r.json()] == [product_version.product.id]
+
+
+@pytest.mark.require_scope(SOMISANAScope.PRODUCT_READ)
+def test_search_products_bbox(api, scopes):
+    authorized = SOMISANAScope.PRODUCT_READ in scopes
+
+    west_coast = ProductFactory.create(west_bound=16, south_bound=-35, east_bound=33, north_bound=-22)
+    false_bay = ProductFactory.create(west_bound=18, south_bound=-34.5, east_bound=19, north_bound=-33.5)
+    # crosses the antimeridian
+    pacific = ProductFactory.create(west_bound=170, south_bound=-20, east_bound=-170, north_bound=0)
+    equator = ProductFactory.create(west_bound=-10, south_bound=-10, east_bound=10, north_bound=10)
+    ProductVersionFactory.create(
+        product=equator,
+        superseded_product=ProductFactory.create(west_bound=16, south_bound=-35, east_bound=33, north_bound=-22),
+    )
+
+    def search(bbox, mode='intersects'):
+        r = api(scopes).get('/product/search', params={'bbox': bbox, 'mode': mode})
+        r.raise_for_status()
+        return [product['id'] for product in r.json()]
+
+    r = api(scopes).get('/product/search', params={'bbox': '18,-34,18.5,-33.8'})
+
+    if not authorized:
+        assert_forbidden(r)
+    else:
+        assert [product['id'] for product in r.json()] == [west_coast.id, false_bay.id]
+        assert r.json()[0]['west_bound'] == 16
+
+        assert search('18,-34,18.5,-33.8', 'contains') == [west_coast.id, false_bay.id]
+        assert search('17,-34,20,-30', 'contains') == [west_coast.id]
+        assert search('175,-10,-175,-5') == [pacific.id]
+        assert search('-179,-10,-178,-5') == [pacific.id]
+        assert search('172,-10,-172,-5', 'contains') == [pacific.id]
+        assert search('160,-10,-172,-5', 'contains') == []
+        assert search('160,-25,17,-5') == [west_coast.id, pacific.id, equator.id]
+
+
+@pytest.mark.parametrize('bbox', ['16,-35,33', '16,-35,33,north', '16,-35,190,-22', '16,-22,33,-35'])
+def test_search_products_invalid_bbox(api, bbox):
+    r = api([SOMISANAScope.PRODUCT_READ]).get('/product/search', params={'bbox': bbox})
+    assert r.status_code == 422
+
+
+@pytest.mark.require_scope(SOMISANAScope.PRODUCT_READ)
+def test_search_products_text(api, scopes):
+    authorized = SOMISANAScope.PRODUCT_READ in scopes
+
+    forecast = ProductFactory.create(title='Sea surface temperature forecast', variables='sst',
+                                     west_bound=16, south_bound=-35, east_bound=33, north_bound=-22)
+    currents = ProductFactory.create(title='Ocean currents', variables='temperature, salinity',
+                                     west_bound=-10, south_bound=-10, east_bound=10, north_bound=10)
+    waves = ProductFactory.create(title='Wave model', variables='hs',
+                                  description='Wave heights driven by <em>gradients</em> in sea surface temperature.',
+                                  west_bound=16, south_bound=-35, east_bound=33, north_bound=-22)
+    ProductFactory.create(title='Chlorophyll', variables='chl', description='Ocean colour.')
+    ProductVersionFactory.create(
+        product=ProductFactory.create(title='Tides', variables='zeta', description='Tidal elevation.'),
+        superseded_product=ProductFactory.create(title='Sea surface temperature hindcast'),
+    )
+
+    def search(**params):
+        r = api(scopes).get('/product/search', params=params)
+        r.raise_for_status()
+        return [product['id'] for product in r.json()]
+
+    r = api(scopes).get('/product/search', params={'q': 'temperature'})
+
+    if not authorized:
+        assert_forbidden(r)
+    else:
+        results = r.json()
+        # title matches rank above variable matches, which rank above description matches
+        assert [product['id'] for product in results] == [forecast.id, currents.id, waves.id]
+        assert results[0]['rank'] > results[1]['rank'] > results[2]['rank']
+        # matches are marked in plain text, leaving any markup in the description to be escaped
+        assert '«temperature»' in results[2]['snippet']
+        assert '<b>' not in results[2]['snippet']
+
+        pages = []
+        r = api(scopes).get('/product/search', params={'q': 'temperature', 'limit': 1})
+        while True:
+            pages += [product['id'] for product in r.json()]
+            if 'next' not in r.links:
+                break
+            r = api(scopes).get(r.links['next']['url'])
+        assert pages == [forecast.id, currents.id, waves.id]
+
+        assert search(q='temperature -wave') == [forecast.id, currents.id]
+        assert search(q='"surface temperature"') == [forecast.id, waves.id]
+        assert search(q='temperatures', bbox='18,-34,18.5,-33.8') == [forecast.id, waves.id]
+        assert search(q='tsunami') == []
+
+        # bbox searches are unranked
+        assert {product['rank'] for product in api(scopes).get(
+            '/product/search', params={'bbox': '18,-34,18.5,-33.8'}
+        ).json()} == {None}
+
+
+def test_search_products_no_criteria(api):
+    client = api([SOMISANAScope.PRODUCT_READ])
+    assert client.get('/product/search').status_code == 422
+    assert client.get('/product/search', params={'q': ''}).status_code == 422
+
+
+@pytest.mark.require_scope(SOMISANAScope.PRODUCT_READ)
+def test_list_products_query_count(api, scopes):
+    authorized = SOMISANAScope.PRODUCT_READ in scopes
+
+    create_product_graph()
+
+    with count_queries() as small_catalog_queries:
+        r = api(scopes).get('/product/all_products')
+
+    if not authorized:
+        assert_forbidden(r)
+    else:
+        # each graph holds a product and the product it supersedes
+        assert len(r.json()) == 2
+
+        for _ in range(10):
+            create_product_graph()
+        response_cache.bump()
+
+        with count_queries() as large_catalog_queries:
+            r = api(scopes).get('/product/all_products')
+
+        assert len(r.json()) == 22
+        assert len(large_catalog_queries) == len(small_catalog_queries)
+
+
+@pytest.mark.require_scope(SOMISANAScope.PRODUCT_READ)
+def test_list_products_cache(api, scopes):
+    authorized = SOMISANAScope.PRODUCT_READ in scopes
+
+    product = create_product_graph()
+
+    r = api(scopes).get('/product/all_products')
+
+    if not authorized:
+        assert_forbidden(r)
+    else:
+        etag = r.headers['ETag']
+
+        with count_queries() as queries:
+            cached_r = api(scopes).get('/product/all_products')
+            not_modified_r = api(scopes).get('/product/all_products', headers={'If-None-Match': etag})
+
+        assert not queries
+        assert cached_r.content == r.content
+        assert cached_r.headers['ETag'] == etag
+        assert not_modified_r.status_code == 304
+        assert not_modified_r.headers['ETag'] == etag
+
+        # any change to the catalog invalidates the cached response
+        api([*scopes, SOMISANAScope.PRODUCT_ADMIN]).put(f'/product/{product.id}', json=dict(
+            title='Updated title',
+            description=product.description,
+            north_bound=str(product.north_bound),
+            south_bound=str(product.south_bound),
+            east_bound=str(product.east_bound),
+            west_bound=str(product.west_bound),
+            horizontal_resolution=product.horizontal_resolution,
+            vertical_extent=product.vertical_extent,
+            vertical_resolution=product.vertical_resolution,
+            temporal_extent=product.temporal_extent,
+            temporal_resolution=product.temporal_resolution,
+            variables=product.variables,
+        ))
+
+        r = api(scopes).get('/product/all_products', headers={'If-None-Match': etag})
+        assert r.status_code == 200
+        assert r.headers['ETag'] != etag
+        assert 'Updated title' in [p['title'] for p in r.json()]
+
+
 @pytest.mark.require_scope(SOMISANAScope.PRODUCT_READ)
 def test_get_product(api, scopes):
     authorized = SOMISANAScope.PRODUCT_READ in scopes
@@ -73,6 +288,77 @@ def test_get_product(api, scopes):
         compare_resources(product_thumbnail, fetched_product['resources'][0])
 
 
+def create_version_chain(length):
+    """Create products each superseding the previous one, oldest first."""
+    versions = [ProductFactory.create()]
+    for _ in range(length - 1):
+        versions += [ProductVersionFactory.create(superseded_product=versions[-1]).product]
+
+    return versions
+
+
+@pytest.mark.require_scope(SOMISANAScope.PRODUCT_READ)
+def test_get_product_lineage(api, scopes):
+    authorized = SOMISANAScope.PRODUCT_READ in scopes
+
+    versions = create_version_chain(4)
+
+    with count_queries() as lineage_queries:
+        r = api(scopes).get(f'/product/{versions[1].id}/lineage')
+
+    if not authorized:
+        assert_forbidden(r)
+    else:
+        assert len(lineage_queries) == 1
+        assert r.json() == dict(
+            product_id=versions[1].id,
+            latest_product_id=versions[3].id,
+            versions=[
+                dict(id=version.id, title=version.title, doi=version.doi, generation=generation)
+                for generation, version in enumerate(versions, start=-1)
+            ],
+        )
+
+        r = api(scopes).get(f'/product/{versions[3].id}/lineage')
+        assert [version['generation'] for version in r.json()['versions']] == [-3, -2, -1, 0]
+        assert r.json()['latest_product_id'] == versions[3].id
+
+        unversioned = ProductFactory.create()
+        r = api(scopes).get(f'/product/{unversioned.id}/lineage')
+        assert r.json()['latest_product_id'] == unversioned.id
+        assert [version['id'] for version in r.json()['versions']] == [unversioned.id]
+
+        assert api(scopes).get('/product/999999/lineage').status_code == 404
+
+
+def test_get_product_lineage_cycle(api):
+    first, second = ProductFactory.create_batch(2)
+    ProductVersionFactory.create(product=first, superseded_product=second)
+    ProductVersionFactory.create(product=second, superseded_product=first)
+
+    r = api([SOMISANAScope.PRODUCT_READ]).get(f'/product/{first.id}/lineage')
+    assert sorted((version['id'], abs(version['generation'])) for version in r.json()['versions']) == [
+        (first.id, 0), (second.id, 1)
+    ]
+
+
+@pytest.mark.require_scope(SOMISANAScope.PRODUCT_READ)
+def test_get_latest_product(api, scopes):
+    authorized = SOMISANAScope.PRODUCT_READ in scopes
+
+    versions = create_version_chain(3)
+
+    r = api(scopes).get(f'/product/{versions[0].id}/latest')
+
+    if not authorized:
+        assert_forbidden(r)
+    else:
+        compare_products(versions[2], r.json())
+
+        assert api(scopes).get(f'/product/{versions[2].id}/latest').json()['id'] == versions[2].id
+        assert api(scopes).get('/product/999999/latest').status_code == 404
+
+
 @pytest.mark.require_scope(SOMISANAScope.PRODUCT_ADMIN)
 def test_add_product(api, scopes):
     authorized = SOMISANAScope.PRODUCT_ADMIN in scopes
@@ -108,6 +394,105 @@ def test_add_product(api, scopes):
         assert (created_product.to_dict() == product.to_dict())
 
 
+def product_ingest_document(dataset_count, resources_per_dataset, **product_fields):
+    product = ProductFactory.build()
+    return dict(
+        title=product.title,
+        description=product.description,
+        doi=product.doi,
+        north_bound=str(product.north_bound),
+        south_bound=str(product.south_bound),
+        east_bound=str(product.east_bound),
+        west_bound=str(product.west_bound),
+        horizontal_resolution=product.horizontal_resolution,
+        vertical_extent=product.vertical_extent,
+        vertical_resolution=product.vertical_resolution,
+        temporal_extent=product.temporal_extent,
+        temporal_resolution=product.temporal_resolution,
+        variables=product.variables,
+        resources=[
+            dict(title='Thumbnail', reference='https://example.org/thumbnail.png',
+                 resource_type=ResourceType.THUMBNAIL.value),
+        ],
+        datasets=[
+            dict(
+                identifier=f'dataset-{i}',
+                type=DatasetFactory.build().type,
+                title=f'Dataset {i}',
+                folder_path=f'/data/dataset-{i}',
+                visualize=True,
+                resources=[
+                    dict(title=f'Access {j}', reference=f'https://example.org/{i}/{j}',
+                         resource_type=ResourceType.DATA_ACCESS_URL.value)
+                    for j in range(resources_per_dataset)
+                ],
+            )
+            for i in range(dataset_count)
+        ],
+        **product_fields,
+    )
+
+
+@pytest.mark.require_scope(SOMISANAScope.PRODUCT_ADMIN)
+def test_ingest_product(api, scopes):
+    authorized = SOMISANAScope.PRODUCT_ADMIN in scopes
+
+    superseded_product = ProductFactory.create()
+    document = product_ingest_document(3, 2, superseded_product_id=superseded_product.id)
+
+    r = api(scopes).post('/product/ingest', json=document)
+
+    if not authorized:
+        assert_forbidden(r)
+    else:
+        result = r.json()
+
+        created_product = TestSession.get(Product, result['id'])
+        assert created_product.title == document['title']
+        assert TestSession.get(ProductVersion, result['id']).superseded_product_id == superseded_product.id
+        assert [resource.id for resource in created_product.resources] == result['resource_ids']
+
+        assert [dataset['identifier'] for dataset in result['datasets']] == ['dataset-0', 'dataset-1', 'dataset-2']
+        for dataset_in, dataset_result in zip(document['datasets'], result['datasets']):
+            created_dataset = TestSession.get(Dataset, dataset_result['id'])
+            assert created_dataset.product_id == result['id']
+            assert created_dataset.title == dataset_in['title']
+            assert sorted(
+                (resource.id, resource.reference, resource.reference_type)
+                for resource in created_dataset.resources
+            ) == [
+                (resource_id, resource_in['reference'], ResourceReferenceType.LINK.value)
+                for resource_id, resource_in in zip(dataset_result['resource_ids'], dataset_in['resources'])
+            ]
+
+
+def test_ingest_product_query_count(api):
+    client = api([SOMISANAScope.PRODUCT_ADMIN])
+
+    with count_queries() as small_tree_queries:
+        assert client.post('/product/ingest', json=product_ingest_document(1, 1)).status_code == 200
+
+    with count_queries() as large_tree_queries:
+        assert client.post('/product/ingest', json=product_ingest_document(20, 10)).status_code == 200
+
+    assert len(large_tree_queries) == len(small_tree_queries)
+    assert TestSession.query(Resource).count() == 2 + 1 + 20 * 10
+
+
+def test_ingest_product_invalid(api):
+    client = api([SOMISANAScope.PRODUCT_ADMIN])
+
+    r = client.post('/product/ingest', json=product_ingest_document(1, 1, superseded_product_id=999))
+    assert r.status_code == 422
+
+    document = product_ingest_document(1, 1)
+    del document['datasets'][0]['resources'][0]['reference']
+    r = client.post('/product/ingest', json=document)
+    assert r.status_code == 422
+
+    assert TestSession.query(Product).count() == 0
+
+
 @pytest.mark.require_scope(SOMISANAScope.PRODUCT_ADMIN)
 def test_update_product(api, scopes):
     authorized = SOMISANAScope.PRODUCT_ADMIN in scopes
@@ -160,6 +545,104 @@ def test_delete_product(api, scopes):
         assert TestSession.get(Product, product.id) is None
 
 
+def test_delete_product_query_count(api):
+    client = api([SOMISANAScope.PRODUCT_ADMIN])
+
+    small_product = ProductFactory.create()
+    DatasetFactory.create(product=small_product)
+    large_product = ProductFactory.create()
+    DatasetFactory.create_batch(10, product=large_product)
+
+    with count_queries() as small_product_queries:
+        assert client.delete(f'/product/{small_product.id}').status_code == 200
+
+    with count_queries() as large_product_queries:
+        assert client.delete(f'/product/{large_product.id}').status_code == 200
+
+    # the dataset deletes are flushed together
+    assert len(large_product_queries) == len(small_product_queries)
+    assert TestSession.query(Dataset).count() == 0
+
+
+def test_delete_product_cascade(api):
+    client = api([SOMISANAScope.PRODUCT_ADMIN])
+
+    product = ProductFactory.create()
+    dataset = DatasetFactory.create(product=product)
+    file_resources = [
+        ProductResourceFactory.create(product=product, resource=ResourceFactory.create(
+            reference=f'product/{product.id}/squares.csv', reference_type=ResourceReferenceType.PATH.value,
+        )).resource,
+        DatasetResourceFactory.create(dataset=dataset, resource=ResourceFactory.create(
+            reference=f'dataset/{dataset.id}/squares.csv', reference_type=ResourceReferenceType.PATH.value,
+        )).resource,
+    ]
+    for resource in file_resources:
+        file_path = f'{local_resource_folder_path}/{resource.reference}'
+        os.makedirs(f'{file_path}.renditions')
+        Path(file_path).write_text(''.join(f'{i},{i * i}\n' for i in range(1000)))
+        write_precompressed_variants(file_path)
+
+    link = ProductResourceFactory.create(product=product, resource=ResourceFactory.create(
+        reference_type=ResourceReferenceType.LINK.value,
+    )).resource
+    shared = DatasetResourceFactory.create(dataset=dataset).resource
+    ProductResourceFactory.create(product=ProductFactory.create(), resource=shared)
+    product_id, dataset_id, link_id, shared_id = product.id, dataset.id, link.id, shared.id
+
+    assert client.delete(f'/product/{product_id}').status_code == 200
+    client.portal.call(file_remover.drain)
+
+    assert TestSession.get(Product, product_id) is None
+    assert TestSession.get(Dataset, dataset_id) is None
+    assert TestSession.get(Resource, link_id) is None
+    # a resource linked elsewhere is kept
+    assert TestSession.get(Resource, shared_id) is not None
+    assert TestSession.query(Resource).count() == 1
+
+    for folder in f'product/{product_id}', f'dataset/{dataset_id}':
+        assert os.listdir(f'{local_resource_folder_path}/{folder}') == []
+        shutil.rmtree(f'{local_resource_folder_path}/{folder}')
+
+
+def test_delete_product_not_found(api):
+    assert api([SOMISANAScope.PRODUCT_ADMIN]).delete('/product/0').status_code == 404
+
+
+def test_create_product_query_count(api):
+    client = api([SOMISANAScope.PRODUCT_ADMIN])
+
+    def create_product():
+        product = ProductFactory.build()
+        return client.post('/product/', json=dict(
+            title=product.title,
+            description=product.description,
+            north_bound=str(product.north_bound),
+            south_bound=str(product.south_bound),
+            east_bound=str(product.east_bound),
+            west_bound=str(product.west_bound),
+            horizontal_resolution=product.horizontal_resolution,
+            vertical_extent=product.vertical_extent,
+            vertical_resolution=product.vertical_resolution,
+            temporal_extent=product.temporal_extent,
+            temporal_resolution=product.temporal_resolution,
+            variables=product.variables,
+        ))
+
+    with count_queries() as first_queries:
+        first_id = create_product().json()
+
+    with count_queries() as later_queries:
+        later_ids = [create_product().json() for _ in range(5)]
+
+    # a block of ids is fetched up front, after which each product is
+    # written with a single insert when the session commits
+    assert len(first_queries) == 3
+    assert len(later_queries) == 5 * 2
+    assert all(not statement.startswith('SELECT') for statement in later_queries)
+    assert [product.id for product in TestSession.query(Product).order_by(Product.id)] == [first_id, *later_ids]
+
+
 @pytest.mark.require_scope(SOMISANAScope.RESOURCE_READ)
 def test_get_resources(api, scopes):
     authorized = SOMISANAScope.RESOURCE_READ in scopes
@@ -240,5 +723,105 @@ def test_add_file_resource(api, scopes):
 
         assert filecmp.cmp(mock_file_path, f'{stored_resource_path}/{file_name}', shallow=False)
 
+        with open(mock_file_path, 'rb') as f:
+            mock_file_bytes = f.read()
+
+        created_resource = TestSession.get(Resource, r.json())
+        assert created_resource.checksum == hashlib.sha256(mock_file_bytes).hexdigest()
+        assert created_resource.size == len(mock_file_bytes)
+
+        api(scopes).portal.call(derivative_pipeline.drain)
         shutil.rmtree(stored_resource_path)
 
+
+@pytest.mark.require_scope(SOMISANAScope.RESOURCE_ADMIN)
+def test_add_file_resource_too_large(api, scopes, monkeypatch):
+    authorized = SOMISANAScope.RESOURCE_ADMIN in scopes
+
+    product = ProductFactory.create(id=0)
+
+    monkeypatch.setattr(somisana.api.lib, 'UPLOAD_MAX_SIZE', 16)
+    monkeypatch.setattr(somisana.api.lib, 'UPLOAD_CHUNK_SIZE', 4)
+
+    r = api(scopes).put(
+        f'/product/{product.id}/resource/?resource_type={ResourceType.THUMBNAIL.value}&title=Too Large',
+        files={'file': ('too_large.png', b'x' * 17, 'application/octet-stream')}
+    )
+
+    if not authorized:
+        assert_forbidden(r)
+    else:
+        assert r.status_code == 413
+        assert TestSession.query(Resource).count() == 0
+
+        assert not os.path.exists(f'{local_resource_folder_path}/product/{product.id}/too_large.png')
+
+
+
+def png_image(width, height):
+    data = io.BytesIO()
+    Image.new('RGB', (width, height), (0, 96, 160)).save(data, 'PNG')
+    return data.getvalue()
+
+
+@pytest.mark.parametrize('width, rendition_widths', [
+    (1600, [320, 640, 1280]),
+    (500, [320]),
+    (200, []),
+])
+def test_add_file_resource_renditions(api, width, rendition_widths):
+    client = api([SOMISANAScope.RESOURCE_ADMIN, SOMISANAScope.PRODUCT_READ])
+    product = ProductFactory.create()
+
+    r = client.put(
+        f'/product/{product.id}/resource/?resource_type={ResourceType.THUMBNAIL.value}&title=Thumbnail',
+        files={'file': ('thumbnail.png', png_image(width, width // 2), 'image/png')}
+    )
+    resource_id = r.json()
+    client.portal.call(derivative_pipeline.drain)
+
+    renditions = TestSession.query(ResourceRendition).filter_by(resource_id=resource_id).all()
+    assert sorted((rendition.width, rendition.media_type) for rendition in renditions) == [
+        (rendition_width, media_type)
+        for rendition_width in rendition_widths
+        for media_type in ('image/jpeg', 'image/webp')
+    ]
+    for rendition in renditions:
+        assert rendition.height == round(width // 2 * rendition.width / width)
+        rendition_path = f'{local_resource_folder_path}/{rendition.reference}'
+        assert os.path.getsize(rendition_path) == rendition.size
+        with Image.open(rendition_path) as image:
+            assert image.size == (rendition.width, rendition.height)
+
+    # the catalog offers the smallest rendition, preferring WebP
+    thumbnail = client.get('/product/catalog_products').json()[0]['thumbnail']
+    if rendition_widths:
+        assert thumbnail['reference'] == f'product/{product.id}/thumbnail.png.renditions/320.webp'
+    else:
+        assert thumbnail['reference'] == f'product/{product.id}/thumbnail.png'
+
+    shutil.rmtree(f'{local_resource_folder_path}/product/{product.id}')
+
+
+@pytest.mark.parametrize('method, path, budget', [
+    ('GET', '/product/all_products', 4),
+    ('GET', '/product/catalog_products', 1),
+    ('GET', '/product/search?q={term}', 1),
+    ('GET', '/product/search?bbox=-180,-90,180,90', 1),
+    ('GET', '/product/{product_id}', 4),
+    ('GET', '/product/{product_id}/lineage', 1),
+    ('GET', '/product/{product_id}/latest', 4),
+    ('GET', '/product/{product_id}/resources/', 2),
+    # set-based deletes, and the catalog change notification
+    ('DELETE', '/product/{product_id}', 4),
+])
+def test_product_query_budget(api, catalog, query_budget, method, path, budget):
+    client = api([SOMISANAScope.PRODUCT_READ, SOMISANAScope.PRODUCT_ADMIN, SOMISANAScope.RESOURCE_READ])
+
+    with query_budget(budget):
+        r = client.request(method, path.format(product_id=catalog.id, term=catalog.title.split()[0]))
+
+    # files of deleted resources are removed by a worker after the response, outside the budget
+    client.portal.call(file_remover.drain)
+
+    assert r.status_code == 200
@@ -1,11 +1,24 @@
+import brotli
+import gzip
+import hashlib
+import os
+import shutil
+
 import pytest
+from sqlalchemy import delete
 
-from somisana.const import SOMISANAScope
+import somisana.api.lib.files
+from somisana.api.lib import local_resource_folder_path, schedule_resource_file_removal
+from somisana.api.lib.derivatives import derivative_pipeline
+from somisana.api.lib.file_removal import file_remover
+from somisana.api.lib.files import write_precompressed_variants
+from somisana.const import SOMISANAScope, ResourceType
+from somisana.db import AsyncSessionLocal
 from somisana.db.models import Resource
 from test import TestSession
-from test.api import assert_forbidden
+from test.api import assert_forbidden, count_queries
 from test.api.lib import compare_resources
-from test.factories import ResourceFactory
+from test.factories import ResourceFactory, ProductFactory
 
 
 @pytest.mark.require_scope(SOMISANAScope.RESOURCE_READ)
@@ -34,3 +47,213 @@ def test_delete_resource(api, scopes):
         assert_forbidden(r)
     else:
         assert TestSession.get(Resource, resource.id) is None
+
+
+@pytest.fixture
+def resource_file(api):
+    """Upload a text resource file for a product, returning its URL and
+    contents."""
+    product = ProductFactory.create()
+    contents = ''.join(f'{i},{i * i}\n' for i in range(1000)).encode()
+
+    client = api([SOMISANAScope.RESOURCE_ADMIN])
+    r = client.put(
+        f'/product/{product.id}/resource/?resource_type={ResourceType.DOCUMENT.value}&title=Squares',
+        files={'file': ('squares.csv', contents, 'text/csv')}
+    )
+    assert r.status_code == 200
+    # precompressed variants are written in the background
+    client.portal.call(derivative_pipeline.drain)
+
+    yield f'/local_resources/product/{product.id}/squares.csv', contents
+
+    shutil.rmtree(f'{local_resource_folder_path}/product/{product.id}')
+
+
+def test_get_resource_file(api, resource_file):
+    url, contents = resource_file
+
+    r = api([]).get(url, headers={'Accept-Encoding': 'identity'})
+
+    assert r.status_code == 200
+    assert r.content == contents
+    assert r.headers['ETag'] == f'"{hashlib.sha256(contents).hexdigest()}"'
+    assert r.headers['Cache-Control'].startswith('public, max-age=')
+    assert r.headers['Accept-Ranges'] == 'bytes'
+    assert 'Content-Encoding' not in r.headers
+
+    assert api([]).get('/local_resources/product/0/missing.csv').status_code == 404
+    assert api([]).get('/local_resources/../somisana/api/__init__.py').status_code == 404
+
+
+def test_get_resource_file_range(api, resource_file):
+    url, contents = resource_file
+    headers = {'Accept-Encoding': 'identity'}
+
+    r = api([]).get(url, headers=headers | {'Range': 'bytes=10-19'})
+    assert r.status_code == 206
+    assert r.content == contents[10:20]
+    assert r.headers['Content-Range'] == f'bytes 10-19/{len(contents)}'
+
+    r = api([]).get(url, headers=headers | {'Range': 'bytes=-5'})
+    assert r.status_code == 206
+    assert r.content == contents[-5:]
+
+    r = api([]).get(url, headers=headers | {'Range': f'bytes={len(contents)}-'})
+    assert r.status_code == 416
+
+    # the range is ignored if the file has changed since the client's copy
+    etag = api([]).head(url, headers=headers).headers['ETag']
+    r = api([]).get(url, headers=headers | {'Range': 'bytes=10-19', 'If-Range': etag})
+    assert r.status_code == 206
+    r = api([]).get(url, headers=headers | {'Range': 'bytes=10-19', 'If-Range': '"stale"'})
+    assert r.status_code == 200
+    assert r.content == contents
+
+
+def test_get_resource_file_conditional(api, resource_file):
+    url, contents = resource_file
+    headers = {'Accept-Encoding': 'identity'}
+
+    r = api([]).get(url, headers=headers)
+    etag, last_modified = r.headers['ETag'], r.headers['Last-Modified']
+
+    r = api([]).get(url, headers=headers | {'If-None-Match': etag})
+    assert r.status_code == 304
+    assert r.content == b''
+    assert r.headers['ETag'] == etag
+
+    r = api([]).get(url, headers=headers | {'If-None-Match': f'"other", W/{etag}'})
+    assert r.status_code == 304
+
+    r = api([]).get(url, headers=headers | {'If-Modified-Since': last_modified})
+    assert r.status_code == 304
+
+    r = api([]).get(url, headers=headers | {'If-None-Match': '"other"'})
+    assert r.status_code == 200
+    assert r.content == contents
+
+
+def test_get_resource_file_precompressed(api, resource_file):
+    url, contents = resource_file
+    checksum = hashlib.sha256(contents).hexdigest()
+
+    r = api([]).get(url, headers={'Accept-Encoding': 'gzip'})
+    assert r.headers['Content-Encoding'] == 'gzip'
+    assert r.headers['Vary'] == 'Accept-Encoding'
+    assert r.headers['ETag'] == f'"{checksum}-gzip"'
+    assert int(r.headers['Content-Length']) < len(contents)
+    assert r.content == contents
+
+    r = api([]).get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': f'"{checksum}-gzip"'})
+    assert r.status_code == 304
+
+    r = api([]).get(url, headers={'Accept-Encoding': 'gzip;q=0, identity'})
+    assert 'Content-Encoding' not in r.headers
+
+
+@pytest.fixture
+def unstored_files():
+    """Files under the local resource folder with no checksum stored for
+    them: a legacy upload, a rendition and a precompressed variant."""
+    directory = f'{local_resource_folder_path}/legacy'
+    os.makedirs(f'{directory}/data.nc.renditions')
+    for path, contents in ('data.nc', b'x' * 100), ('data.nc.renditions/thumb.png', b'p'), ('notes.txt.gz', b'g'):
+        with open(f'{directory}/{path}', 'wb') as f:
+            f.write(contents)
+
+    yield '/local_resources/legacy', directory
+
+    shutil.rmtree(directory)
+
+
+def test_get_resource_file_weak_etag(api, unstored_files):
+    url, directory = unstored_files
+    stat_result = os.stat(f'{directory}/data.nc')
+    etag = f'W/"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+    r = api([]).get(f'{url}/data.nc', headers={'Range': 'bytes=0-9'})
+    assert r.status_code == 206
+    assert r.headers['ETag'] == etag
+
+    r = api([]).get(f'{url}/data.nc', headers={'If-None-Match': etag})
+    assert r.status_code == 304
+
+    # a weak ETag does not validate a range
+    r = api([]).get(f'{url}/data.nc', headers={'Range': 'bytes=0-9', 'If-Range': etag})
+    assert r.status_code == 200
+    assert len(r.content) == 100
+
+    # the missing checksum is remembered, and renditions and precompressed
+    # variants are not looked up at all
+    with count_queries() as statements:
+        for path in 'data.nc', 'data.nc.renditions/thumb.png', 'notes.txt.gz':
+            r = api([]).get(f'{url}/{path}')
+            assert r.status_code == 200
+            assert r.headers['ETag'].startswith('W/')
+    assert statements == []
+
+
+def test_delete_resource_file(api, resource_file):
+    resource = TestSession.query(Resource).one()
+    resource_id = resource.id
+    file_path = f'{local_resource_folder_path}/{resource.reference}'
+    client = api([SOMISANAScope.RESOURCE_ADMIN])
+
+    # files are not removed if the deleting transaction rolls back
+    async def delete_and_roll_back():
+        async with AsyncSessionLocal() as session:
+            await session.execute(delete(Resource).where(Resource.id == resource_id))
+            schedule_resource_file_removal(session, [resource])
+            await session.rollback()
+
+    client.portal.call(delete_and_roll_back)
+    client.portal.call(file_remover.drain)
+    assert os.path.exists(file_path)
+
+    assert client.delete(f'/resource/{resource_id}').status_code == 200
+    client.portal.call(file_remover.drain)
+
+    assert TestSession.query(Resource).count() == 0
+    assert not os.path.exists(file_path)
+    assert not os.path.exists(f'{file_path}.gz')
+
+
+def test_get_resource_file_brotli(api, resource_file):
+    url, contents = resource_file
+
+    r = api([]).get(url, headers={'Accept-Encoding': 'gzip, br'})
+    assert r.headers['Content-Encoding'] == 'br'
+    assert r.content == contents
+
+
+def test_write_precompressed_variants(tmp_path, monkeypatch):
+    monkeypatch.setattr(somisana.api.lib.files, 'PRECOMPRESS_CHUNK_SIZE', 1000)
+    contents = ''.join(f'{i},{i * i}\n' for i in range(1000)).encode()
+    (tmp_path / 'squares.csv').write_bytes(contents)
+    (tmp_path / 'random.csv').write_bytes(os.urandom(2000))
+
+    write_precompressed_variants(str(tmp_path / 'squares.csv'))
+    write_precompressed_variants(str(tmp_path / 'random.csv'))
+
+    assert gzip.decompress((tmp_path / 'squares.csv.gz').read_bytes()) == contents
+    assert brotli.decompress((tmp_path / 'squares.csv.br').read_bytes()) == contents
+    # incompressible files are left without variants, and no temporary files are left behind
+    assert sorted(os.listdir(tmp_path)) == ['random.csv', 'squares.csv', 'squares.csv.br', 'squares.csv.gz']
+
+
+@pytest.mark.parametrize('method, path, budget', [
+    ('GET', '/resource/{resource_id}', 1),
+    # a set-based delete, and the catalog change notification
+    ('DELETE', '/resource/{resource_id}', 2),
+])
+def test_resource_query_budget(api, catalog, query_budget, method, path, budget):
+    client = api([SOMISANAScope.RESOURCE_READ, SOMISANAScope.RESOURCE_ADMIN])
+
+    with query_budget(budget):
+        r = client.request(method, path.format(resource_id=catalog.product_resources[0].resource_id))
+
+    # files of deleted resources are removed by a worker after the response, outside the budget
+    client.portal.call(file_remover.drain)
+
+    assert r.status_code == 200
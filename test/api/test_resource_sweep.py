@@ -0,0 +1,163 @@
+import os
+import time
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import somisana.api.lib.resource_sweep
+import somisana.db
+from somisana.api.lib import local_resource_folder_path
+from somisana.api.lib.resource_sweep import candidate_references, sweep_next_directory
+from somisana.const import ResourceReferenceType, SOMISANAScope
+from somisana.db.models import Resource, ResourceSweep
+from test import TestSession
+from test.api import assert_forbidden
+from test.factories import DatasetFactory, DatasetResourceFactory, ProductFactory, ProductResourceFactory, \
+    ResourceFactory
+
+GRACE_PERIOD = somisana.api.lib.resource_sweep.RESOURCE_SWEEP_GRACE_PERIOD
+
+
+@pytest.mark.parametrize('path, references', [
+    ('product/1/a.csv', ['product/1/a.csv']),
+    ('product/1/a.csv.gz', ['product/1/a.csv.gz', 'product/1/a.csv']),
+    ('product/1/a.csv.br', ['product/1/a.csv.br', 'product/1/a.csv']),
+    ('product/1/a.png.renditions/320.webp', ['product/1/a.png.renditions/320.webp', 'product/1/a.png']),
+    ('product/1/.a.png.part', ['product/1/.a.png.part']),
+])
+def test_candidate_references(path, references):
+    assert candidate_references(path) == references
+
+
+def write_file(root, path, age=2 * GRACE_PERIOD, size=100):
+    file_path = root / path
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    file_path.write_bytes(b'x' * size)
+    mtime = time.time() - age
+    os.utime(file_path, (mtime, mtime))
+
+
+def sweep(client, root, quarantine):
+    async def sweep_next():
+        async with AsyncSession(somisana.db.async_engine, expire_on_commit=False) as session:
+            result = await sweep_next_directory(session, str(root), str(quarantine))
+            await session.commit()
+            return result
+
+    return client.portal.call(sweep_next)
+
+
+def file_resource(reference):
+    return ResourceFactory.create(reference=reference, reference_type=ResourceReferenceType.PATH.value)
+
+
+def test_sweep_quarantines_orphans(api, tmp_path):
+    client = api([])
+    root, quarantine = tmp_path / 'resources', tmp_path / 'quarantine'
+
+    product = ProductFactory.create()
+    dataset = DatasetFactory.create(product=product)
+    kept = f'product/{product.id}/kept.csv'
+    ProductResourceFactory.create(product=product, resource=file_resource(kept))
+    for path in kept, f'{kept}.gz', f'{kept}.renditions/320.webp':
+        write_file(root, path)
+    # an upload in progress
+    write_file(root, f'product/{product.id}/.upload.part', age=0)
+    write_file(root, f'product/{product.id}/orphan.csv', size=300)
+    write_file(root, f'dataset/{dataset.id}/orphan.png', size=200)
+
+    result = sweep(client, root, quarantine)
+    assert result.directory == f'dataset/{dataset.id}'
+    assert (result.files_quarantined, result.bytes_quarantined) == (1, 200)
+    assert (quarantine / f'dataset/{dataset.id}/orphan.png').exists()
+    assert TestSession.get(ResourceSweep, str(root)).cursor == f'dataset/{dataset.id}'
+
+    # the sweep continues from the persisted cursor
+    result = sweep(client, root, quarantine)
+    assert result.directory == f'product/{product.id}'
+    assert (result.files_quarantined, result.bytes_quarantined) == (1, 300)
+    assert sorted(os.listdir(root / f'product/{product.id}')) == [
+        '.upload.part', 'kept.csv', 'kept.csv.gz', 'kept.csv.renditions',
+    ]
+    assert os.listdir(root / f'dataset/{dataset.id}') == []
+
+    # the pass ends, keeping files quarantined for less than the grace period
+    result = sweep(client, root, quarantine)
+    assert result.directory is None
+    assert result.files_deleted == 0
+    assert (quarantine / f'product/{product.id}/orphan.csv').exists()
+
+    TestSession.expire_all()
+    sweep_state = TestSession.get(ResourceSweep, str(root))
+    assert sweep_state.cursor is None
+    assert sweep_state.passes == 1
+    assert (sweep_state.files_quarantined, sweep_state.bytes_quarantined) == (2, 500)
+
+
+def test_sweep_reclaims_quarantined_files(api, tmp_path, monkeypatch):
+    client = api([])
+    root, quarantine = tmp_path / 'resources', tmp_path / 'quarantine'
+    write_file(root, 'product/1/old.csv', size=300)
+    write_file(root, 'product/2/old.csv', size=200)
+
+    assert sweep(client, root, quarantine).files_quarantined == 1
+    assert sweep(client, root, quarantine).files_quarantined == 1
+
+    # the quarantined files are deleted when the pass ends after the grace period
+    monkeypatch.setattr(somisana.api.lib.resource_sweep, 'RESOURCE_SWEEP_GRACE_PERIOD', 0)
+    result = sweep(client, root, quarantine)
+
+    assert result.directory is None
+    assert (result.files_deleted, result.bytes_reclaimed) == (2, 500)
+    assert os.listdir(quarantine) == []
+
+    # entity directories left empty are removed by the next pass
+    assert sweep(client, root, quarantine).directory == 'product/1'
+    assert sweep(client, root, quarantine).directory == 'product/2'
+    assert os.listdir(root / 'product') == []
+
+    sweep_state = TestSession.get(ResourceSweep, str(root))
+    assert (sweep_state.files_deleted, sweep_state.bytes_reclaimed) == (2, 500)
+
+
+def test_sweep_deletes_unlinked_resources(api, tmp_path):
+    client = api([])
+    root, quarantine = tmp_path / 'resources', tmp_path / 'quarantine'
+
+    product_resource = ProductResourceFactory.create().resource_id
+    dataset_resource = DatasetResourceFactory.create().resource_id
+    ResourceFactory.create_batch(3)
+
+    result = sweep(client, root, quarantine)
+    assert result.directory is None
+    assert result.resources_deleted == 3
+    remaining = sorted(resource.id for resource in TestSession.query(Resource))
+    assert remaining == sorted([product_resource, dataset_resource])
+
+
+@pytest.mark.require_scope(SOMISANAScope.PRODUCT_ADMIN)
+def test_resource_sweep_status_authorization(api, scopes):
+    r = api(scopes).get('/instrumentation/resource_sweep')
+
+    if SOMISANAScope.PRODUCT_ADMIN not in scopes:
+        assert_forbidden(r)
+    else:
+        assert r.status_code == 200
+
+
+def test_resource_sweep_status(api):
+    client = api([SOMISANAScope.PRODUCT_ADMIN])
+    assert client.get('/instrumentation/resource_sweep').json() == dict(
+        cursor=None, passes=0, files_quarantined=0, bytes_quarantined=0,
+        files_deleted=0, bytes_reclaimed=0, resources_deleted=0,
+    )
+
+    TestSession.add(ResourceSweep(
+        folder=local_resource_folder_path, cursor='product/1', passes=2, files_quarantined=3, bytes_quarantined=300,
+        files_deleted=1, bytes_reclaimed=100, resources_deleted=4,
+    ))
+    TestSession.commit()
+
+    r = client.get('/instrumentation/resource_sweep')
+    assert r.json()['cursor'] == 'product/1'
+    assert r.json()['bytes_reclaimed'] == 100
@@ -0,0 +1,76 @@
+import enum
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import pytest
+from pydantic import parse_obj_as
+
+from somisana.api.lib.serialization import fast_json, standard_json
+from somisana.api.models import ProductOut, CatalogProductModel, ProductSearchModel, ProductLineageModel, \
+    ProductResourceModel, DatasetModel, ResourceModel
+from somisana.const import SOMISANAScope, ResourceType
+from test.factories import ProductFactory, ProductVersionFactory, DatasetFactory, ResourceFactory, \
+    DatasetResourceFactory, ProductResourceFactory
+
+
+class Colour(str, enum.Enum):
+    RED = 'red'
+
+
+@pytest.mark.parametrize('content', [
+    [0.1 + 0.2, -0.0, 1.0, 12.34, 123456789.123, 1e16, 1e22, -1.5e300],
+    [1e-4, 9.99e-5, 1e-5, -3.2e-7, 1e-9, 1.5e-10, 5e-324],
+    {'title': 'Température de surface — 海面水温 🌊', 'escapes': 'quote " backslash \\ tab \t nul \x00'},
+    {1: 'int key', 'nested': {'list': [None, True, False, 0, -1, 2 ** 63]}},
+    [Decimal('1.25'), Decimal('-35'), Decimal('1E+2'), Colour.RED, ResourceType.THUMBNAIL],
+    [datetime(2024, 1, 1), datetime(2024, 1, 1, 12, 30, 15, 123, tzinfo=timezone.utc),
+     datetime(2024, 1, 1, tzinfo=timezone(timedelta(hours=2))), datetime(2024, 1, 1).date()],
+    ('tuple', {'set'}),
+    ResourceModel(id=1, title='Thumbnail', reference='https://example.org/é', resource_type=ResourceType.THUMBNAIL),
+    [ProductLineageModel(product_id=1, latest_product_id=2, versions=[
+        dict(id=1, title='Old', doi=None, generation=0),
+        dict(id=2, title='New', doi='10.1234/new', generation=1),
+    ])],
+])
+def test_fast_json_matches_standard_json(content):
+    assert fast_json(content) == standard_json(content)
+
+
+def create_catalog():
+    """Create a product superseding another, with datasets and resources
+    of every kind that the read endpoints output."""
+    product = ProductFactory.create()
+    ProductVersionFactory.create(product=product, superseded_product=ProductFactory.create())
+    for resource_type in ResourceType:
+        ProductResourceFactory.create(product=product, resource=ResourceFactory.create(resource_type=resource_type))
+
+    dataset = DatasetFactory.create(product=product)
+    for resource_type in ResourceType.DATA_ACCESS_URL, ResourceType.COVER_IMAGE, ResourceType.COVER_CLIP:
+        DatasetResourceFactory.create(dataset=dataset, resource=ResourceFactory.create(resource_type=resource_type))
+
+    return product, dataset
+
+
+def test_responses_byte_compatible(api):
+    """Responses of the fast path must be exactly what FastAPI would send
+    after validating the content against the route's response model."""
+    client = api([SOMISANAScope.PRODUCT_READ, SOMISANAScope.DATASET_READ, SOMISANAScope.RESOURCE_READ])
+    product, dataset = create_catalog()
+
+    for path, response_model in [
+        ('/product/all_products', list[ProductOut]),
+        ('/product/catalog_products', list[CatalogProductModel]),
+        (f'/product/search?q={product.title.split()[0]}', list[ProductSearchModel]),
+        ('/product/search?bbox=-180,-90,180,90', list[ProductSearchModel]),
+        (f'/product/{product.id}', ProductOut),
+        (f'/product/{product.id}/latest', ProductOut),
+        (f'/product/{product.id}/lineage', ProductLineageModel),
+        (f'/product/{product.id}/resources/', list[ProductResourceModel]),
+        (f'/dataset/{dataset.id}', DatasetModel),
+        (f'/resource/{dataset.resources[0].id}', ResourceModel),
+    ]:
+        r = client.get(path)
+        assert r.status_code == 200
+        assert r.headers['Content-Type'] == 'application/json'
+        assert r.json()
+        assert r.content == standard_json(parse_obj_as(response_model, r.json())), path
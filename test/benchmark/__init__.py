@@ -0,0 +1,113 @@
+"""Benchmarks for the SOMISANA API.
+
+Benchmarks are not collected by pytest; run them as modules, e.g.::
+
+    python -m test.benchmark.catalog_products
+
+They use the database configured for the test suite, which is created
+before and dropped after each run.
+"""
+import random
+import time
+from contextlib import contextmanager
+from statistics import quantiles
+
+from sqlalchemy import text
+from sqlalchemy_utils import create_database, database_exists, drop_database
+
+import somisana.db
+import somisana_migrate.systemdata
+from somisana.config import somisana_config
+from somisana.const import ResourceType
+from somisana.db.models import ProductResource, ProductVersion, DatasetResource
+from test.factories import FactorySession, ProductFactory, DatasetFactory, ResourceFactory
+
+
+@contextmanager
+def benchmark_database():
+    """Provide a clean database with an up-to-date SOMISANA schema."""
+    url = somisana_config.SOMISANA.DB.URL
+    if database_exists(url):
+        drop_database(url)
+
+    create_database(url)
+    try:
+        somisana_migrate.systemdata.init_database_schema()
+        yield
+    finally:
+        FactorySession.remove()
+        somisana.db.engine.dispose()
+        drop_database(url)
+
+
+def seed_catalog(
+        products: int,
+        datasets_per_product: int = 2,
+        resources_per_product: int = 3,
+        resources_per_dataset: int = 2,
+        superseded_fraction: float = 0.1,
+        batch_size: int = 500,
+) -> None:
+    """Populate the database with a catalog of the given size. Every product
+    has a thumbnail among its resources, and a fraction of the products are
+    superseded by the next product."""
+    for start in range(0, products, batch_size):
+        product_batch = ProductFactory.build_batch(min(batch_size, products - start))
+        FactorySession.add_all(product_batch)
+
+        for product in product_batch:
+            resources = [ResourceFactory.build(resource_type=ResourceType.THUMBNAIL.value)] + \
+                ResourceFactory.build_batch(resources_per_product - 1)
+            FactorySession.add_all(resources)
+            FactorySession.add_all(
+                ProductResource(product_id=product.id, resource_id=resource.id)
+                for resource in resources
+            )
+
+            for dataset in DatasetFactory.build_batch(datasets_per_product, product=product):
+                FactorySession.add(dataset)
+                dataset_resources = ResourceFactory.build_batch(resources_per_dataset)
+                FactorySession.add_all(dataset_resources)
+                FactorySession.add_all(
+                    DatasetResource(dataset_id=dataset.id, resource_id=resource.id)
+                    for resource in dataset_resources
+                )
+
+        superseding = [
+            ProductVersion(product_id=newer.id, superseded_product_id=older.id)
+            for older, newer in zip(product_batch, product_batch[1:])
+            if random.random() < superseded_fraction
+        ]
+        FactorySession.add_all(superseding)
+        FactorySession.commit()
+
+    # collect planner statistics, as autovacuum would on a live database
+    FactorySession.execute(text('ANALYZE'))
+    FactorySession.commit()
+
+
+def summarize(durations: list[float]) -> dict[str, float]:
+    """Summarize a list of durations, in seconds, as latency percentiles
+    in milliseconds and throughput in operations per second."""
+    percentiles = quantiles(durations, n=100, method='inclusive')
+    return {
+        'p50_ms': round(percentiles[49] * 1000, 3),
+        'p95_ms': round(percentiles[94] * 1000, 3),
+        'p99_ms': round(percentiles[98] * 1000, 3),
+        'throughput': round(len(durations) / sum(durations), 2),
+    }
+
+
+class Timer:
+    """Collects the durations of timed blocks."""
+
+    def __init__(self):
+        self.durations = []
+
+    @contextmanager
+    def __call__(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations.append(time.perf_counter() - start)
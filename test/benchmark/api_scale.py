@@ -0,0 +1,430 @@
+"""Drive every route of the product, dataset and resource routers in-process
+at several catalog sizes, and report for each endpoint the latency
+percentiles, throughput, maximum number of queries per request and the peak
+memory allocated while handling a request. Authorization is stubbed out, so
+that the results reflect the work done by the routes themselves.
+
+Read endpoints are measured before any writes, and the rows that delete
+endpoints remove are created once the reads are done, so that reads see a
+catalog of exactly the requested size. Unless ``--cache`` is given, the
+response cache is cleared before each request.
+
+Results are written as JSON so that runs can be compared, e.g.::
+
+    python -m test.benchmark.api_scale --sizes 100 1000 10000 --output before.json
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+from unittest.mock import patch
+
+from sqlalchemy import func, select
+from starlette.requests import Request
+from starlette.testclient import TestClient
+
+import somisana.api
+import somisana.db
+from somisana.api.lib import local_resource_folder_path
+from somisana.api.lib.auth import Authorize, Authorized
+from somisana.api.lib.cache import response_cache
+from somisana.api.routers import dataset, product, resource
+from somisana.const import ResourceReferenceType, ResourceType
+from somisana.db.models import DatasetResource, Product, ProductResource
+from test.api import count_queries
+from test.benchmark import Timer, benchmark_database, seed_catalog, summarize
+from test.factories import DatasetFactory, FactorySession, ProductFactory, ResourceFactory
+
+ROUTERS = {
+    '/product': product.router,
+    '/dataset': dataset.router,
+    '/resource': resource.router,
+}
+
+UPLOAD_CONTENTS = ''.join(f'{i},{i * i}\n' for i in range(1000)).encode()
+
+
+@dataclass
+class Targets:
+    """Rows of the seeded catalog that requests operate on. Each request
+    to a delete endpoint removes a different victim row."""
+    product_id: int
+    dataset_id: int
+    resource_id: int
+    search_term: str
+    dataset_folder: str
+    victim_product_ids: list[int] = field(default_factory=list)
+    victim_dataset_ids: list[int] = field(default_factory=list)
+    victim_resource_ids: list[int] = field(default_factory=list)
+
+
+def target_ids(targets: Targets, i: int) -> dict:
+    return dict(product_id=targets.product_id, dataset_id=targets.dataset_id, resource_id=targets.resource_id)
+
+
+def no_options(targets: Targets, i: int) -> dict:
+    return {}
+
+
+@dataclass
+class Endpoint:
+    """A request to benchmark against a route. ``path_params`` and ``options``
+    return the path parameters and the remaining ``TestClient.request``
+    arguments of the i'th request."""
+    method: str
+    route: str
+    path_params: Callable[[Targets, int], dict] = target_ids
+    options: Callable[[Targets, int], dict] = no_options
+    variant: Optional[str] = None
+    writes: bool = False
+
+    @property
+    def name(self) -> str:
+        return f'{self.method} {self.route}' + (f' ({self.variant})' if self.variant else '')
+
+
+def product_document(**fields) -> dict:
+    product_ = ProductFactory.build()
+    return dict(
+        title=product_.title,
+        description=product_.description,
+        doi=product_.doi,
+        north_bound=str(product_.north_bound),
+        south_bound=str(product_.south_bound),
+        east_bound=str(product_.east_bound),
+        west_bound=str(product_.west_bound),
+        horizontal_resolution=product_.horizontal_resolution,
+        vertical_extent=product_.vertical_extent,
+        vertical_resolution=product_.vertical_resolution,
+        temporal_extent=product_.temporal_extent,
+        temporal_resolution=product_.temporal_resolution,
+        variables=product_.variables,
+        **fields,
+    )
+
+
+def dataset_document(product_id: int, i: int, **fields) -> dict:
+    return dict(
+        product_id=product_id,
+        identifier=f'benchmark-{i}',
+        type=DatasetFactory.build().type,
+        title=f'Benchmark dataset {i}',
+        visualize=True,
+        **fields,
+    )
+
+
+def link_resource_document(i: int) -> dict:
+    return dict(
+        title=f'Link {i}',
+        reference=f'https://example.org/benchmark/{i}',
+        resource_type=ResourceType.DATA_ACCESS_URL.value,
+    )
+
+
+def ingest_document(i: int) -> dict:
+    return product_document(
+        resources=[link_resource_document(i)],
+        datasets=[
+            dict(
+                **dataset_document(None, j, folder_path=f'/data/benchmark-{i}/{j}'),
+                resources=[link_resource_document(k) for k in range(2)],
+            )
+            for j in range(2)
+        ],
+    )
+
+
+def upload(i: int) -> dict:
+    return dict(
+        params=dict(resource_type=ResourceType.DOCUMENT.value, title=f'Upload {i}'),
+        files={'file': ('upload.csv', UPLOAD_CONTENTS, 'text/csv')},
+    )
+
+
+ENDPOINTS = [
+    # product
+    Endpoint('GET', '/product/all_products'),
+    Endpoint('GET', '/product/catalog_products'),
+    Endpoint('GET', '/product/search', variant='text',
+             options=lambda t, i: dict(params=dict(q=t.search_term))),
+    Endpoint('GET', '/product/search', variant='bbox',
+             options=lambda t, i: dict(params=dict(bbox='-180,-90,180,90'))),
+    Endpoint('GET', '/product/{product_id}'),
+    Endpoint('GET', '/product/{product_id}/lineage'),
+    Endpoint('GET', '/product/{product_id}/latest'),
+    Endpoint('GET', '/product/{product_id}/resources/'),
+    Endpoint('POST', '/product/', writes=True,
+             options=lambda t, i: dict(json=product_document())),
+    Endpoint('POST', '/product/ingest', writes=True,
+             options=lambda t, i: dict(json=ingest_document(i))),
+    Endpoint('PUT', '/product/{product_id}', writes=True,
+             options=lambda t, i: dict(json=product_document())),
+    Endpoint('POST', '/product/{product_id}/resource/', writes=True,
+             options=lambda t, i: dict(json=link_resource_document(i))),
+    Endpoint('PUT', '/product/{product_id}/resource/', writes=True,
+             options=lambda t, i: upload(i)),
+    Endpoint('DELETE', '/product/{product_id}', writes=True,
+             path_params=lambda t, i: dict(product_id=t.victim_product_ids[i])),
+
+    # dataset
+    Endpoint('GET', '/dataset/all'),
+    Endpoint('GET', '/dataset/product_datasets/{product_id}'),
+    Endpoint('GET', '/dataset/{dataset_id}'),
+    Endpoint('GET', '/dataset/{dataset_id}/files'),
+    Endpoint('GET', '/dataset/{dataset_id}/subset'),
+    Endpoint('POST', '/dataset/', writes=True,
+             options=lambda t, i: dict(json=dataset_document(t.product_id, i))),
+    Endpoint('PUT', '/dataset/{dataset_id}', writes=True,
+             options=lambda t, i: dict(json=dataset_document(t.product_id, i, folder_path=t.dataset_folder))),
+    Endpoint('POST', '/dataset/{dataset_id}/files/scan', writes=True),
+    Endpoint('POST', '/dataset/{dataset_id}/resource/', writes=True,
+             options=lambda t, i: dict(json=link_resource_document(i))),
+    Endpoint('PUT', '/dataset/{dataset_id}/resource/', writes=True,
+             options=lambda t, i: upload(i)),
+    Endpoint('DELETE', '/dataset/{dataset_id}', writes=True,
+             path_params=lambda t, i: dict(dataset_id=t.victim_dataset_ids[i])),
+
+    # resource
+    Endpoint('GET', '/resource/{resource_id}'),
+    Endpoint('POST', '/resource/{resource_id}/', writes=True,
+             options=lambda t, i: dict(json=link_resource_document(i))),
+    Endpoint('PUT', '/resource/{resource_id}/', writes=True,
+             options=lambda t, i: upload(i)),
+    Endpoint('DELETE', '/resource/{resource_id}', writes=True,
+             path_params=lambda t, i: dict(resource_id=t.victim_resource_ids[i])),
+]
+
+
+def check_route_coverage() -> None:
+    """Fail if a route of the benchmarked routers has no endpoint."""
+    routes = {
+        f'{method} {prefix}{route.path}'
+        for prefix, router in ROUTERS.items()
+        for route in router.routes
+        for method in route.methods
+    }
+    if missing := routes - {f'{endpoint.method} {endpoint.route}' for endpoint in ENDPOINTS}:
+        raise SystemExit(f'No benchmark requests for: {", ".join(sorted(missing))}')
+
+
+@contextmanager
+def stub_authorize():
+    """Grant every scope to every request, without token introspection."""
+
+    async def authorize(self, request: Request) -> Authorized:
+        return Authorized(client_id='somisana.benchmark', user_id=None)
+
+    with patch.object(Authorize, '__call__', authorize):
+        yield
+
+
+def write_dataset_folder(folder: str) -> None:
+    """Write a small NetCDF file for the subset endpoint to the folder, if
+    xarray is installed, and backdate it so that the scanner indexes it."""
+    try:
+        import numpy as np
+        import xarray as xr
+    except ImportError:
+        return
+
+    time_ = np.arange(np.datetime64('2024-01-01'), np.datetime64('2024-01-08'), dtype='datetime64[D]')
+    lat = np.linspace(-36, -30, 25)
+    lon = np.linspace(15, 21, 25)
+    shape = (len(time_), len(lat), len(lon))
+    xr.Dataset(
+        data_vars=dict(temp=(('time', 'lat', 'lon'), np.random.rand(*shape).astype('float32'))),
+        coords=dict(time=time_.astype('datetime64[ns]'), lat=lat, lon=lon),
+    ).to_netcdf(path := os.path.join(folder, 'model.nc'))
+
+    mtime_ns = time.time_ns() - 3600 * 1_000_000_000
+    for path in path, folder:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def select_targets(dataset_folder: str) -> Targets:
+    """Pick a current product of the seeded catalog, with its first dataset
+    and resource, and point the dataset at the given folder."""
+    product_ = FactorySession.execute(
+        select(Product)
+        .where(Product.superseded_by == None)
+        .where(Product.datasets.any())
+        .order_by(Product.id)
+        .limit(1)
+    ).scalar_one()
+    dataset_ = product_.datasets[0]
+    dataset_.folder_path = dataset_folder
+    FactorySession.commit()
+
+    return Targets(
+        product_id=product_.id,
+        dataset_id=dataset_.id,
+        resource_id=product_.product_resources[0].resource_id,
+        search_term=product_.title.split()[0],
+        dataset_folder=dataset_folder,
+    )
+
+
+def seed_victims(targets: Targets, count: int) -> None:
+    """Create the products, datasets and resources removed by the delete
+    endpoints. Victim products have datasets and resources of their own."""
+    products = ProductFactory.build_batch(count + 1)
+    holder, victim_products = products[0], products[1:]
+    FactorySession.add_all(products)
+
+    for victim in victim_products:
+        for dataset_ in DatasetFactory.build_batch(2, product=victim):
+            FactorySession.add(dataset_)
+            FactorySession.add(resource_ := ResourceFactory.build(reference_type=ResourceReferenceType.LINK.value))
+            FactorySession.add(DatasetResource(dataset_id=dataset_.id, resource_id=resource_.id))
+        FactorySession.add(resource_ := ResourceFactory.build(reference_type=ResourceReferenceType.LINK.value))
+        FactorySession.add(ProductResource(product_id=victim.id, resource_id=resource_.id))
+
+    victim_datasets = DatasetFactory.build_batch(count, product=holder)
+    victim_resources = ResourceFactory.build_batch(count, reference_type=ResourceReferenceType.LINK.value)
+    FactorySession.add_all(victim_datasets)
+    FactorySession.add_all(victim_resources)
+    FactorySession.add_all(
+        ProductResource(product_id=holder.id, resource_id=resource_.id)
+        for resource_ in victim_resources
+    )
+    FactorySession.commit()
+
+    targets.victim_product_ids = [victim.id for victim in victim_products]
+    targets.victim_dataset_ids = [dataset_.id for dataset_ in victim_datasets]
+    targets.victim_resource_ids = [resource_.id for resource_ in victim_resources]
+
+
+def advance_sequences() -> None:
+    """Move each id sequence past the ids assigned by the factories, so that
+    rows created through the API do not collide with seeded rows."""
+    for table in somisana.db.Base.metadata.sorted_tables:
+        if (column := table.autoincrement_column) is not None:
+            FactorySession.execute(select(func.setval(
+                func.pg_get_serial_sequence(table.name, column.name),
+                select(func.coalesce(func.max(column), 0) + 1).scalar_subquery(),
+                False,
+            )))
+    FactorySession.commit()
+    somisana.db.id_allocator.clear()
+
+
+def measure(client: TestClient, endpoint: Endpoint, targets: Targets, iterations: int, cache: bool) -> dict:
+    """Make one warm-up request, ``iterations`` timed requests and one
+    request traced for memory usage."""
+    timer = Timer()
+    statuses = Counter()
+    queries = []
+
+    def request(i: int):
+        if not cache:
+            response_cache.clear()
+        return client.request(
+            endpoint.method,
+            endpoint.route.format(**endpoint.path_params(targets, i)),
+            **endpoint.options(targets, i),
+        )
+
+    request(0)
+
+    for i in range(1, iterations + 1):
+        with count_queries() as statements:
+            with timer():
+                r = request(i)
+        statuses[r.status_code] += 1
+        queries.append(len(statements))
+
+    tracemalloc.start()
+    try:
+        baseline, _ = tracemalloc.get_traced_memory()
+        request(iterations + 1)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        **summarize(timer.durations),
+        'queries': max(queries),
+        'peak_memory_kib': round((peak - baseline) / 1024, 1),
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+    }
+
+
+def run(size: int, iterations: int, cache: bool) -> dict:
+    seed_start = time.perf_counter()
+    seed_catalog(size)
+    seed_seconds = time.perf_counter() - seed_start
+
+    dataset_folder = tempfile.mkdtemp(prefix='somisana-benchmark-')
+    write_dataset_folder(dataset_folder)
+    targets = select_targets(dataset_folder)
+    results = {}
+    try:
+        with stub_authorize(), TestClient(somisana.api.app, raise_server_exceptions=False) as client:
+            try:
+                client.post(f'/dataset/{targets.dataset_id}/files/scan')
+
+                for endpoint in ENDPOINTS:
+                    if not endpoint.writes:
+                        results[endpoint.name] = measure(client, endpoint, targets, iterations, cache)
+
+                seed_victims(targets, iterations + 2)
+                advance_sequences()
+
+                for endpoint in ENDPOINTS:
+                    if endpoint.writes:
+                        results[endpoint.name] = measure(client, endpoint, targets, iterations, cache)
+            finally:
+                # pooled connections are bound to the test client's event loop
+                client.portal.call(somisana.db.async_engine.dispose)
+    finally:
+        shutil.rmtree(dataset_folder, ignore_errors=True)
+        shutil.rmtree(f'{local_resource_folder_path}/product/{targets.product_id}', ignore_errors=True)
+        shutil.rmtree(f'{local_resource_folder_path}/dataset/{targets.dataset_id}', ignore_errors=True)
+
+    return {
+        'products': size,
+        'seed_seconds': round(seed_seconds, 1),
+        'endpoints': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='numbers of products to seed the catalog with')
+    parser.add_argument('--iterations', type=int, default=50,
+                        help='number of timed requests per endpoint')
+    parser.add_argument('--cache', action='store_true',
+                        help='keep the response cache between requests')
+    parser.add_argument('--output', help='file to write the JSON results to; defaults to standard output')
+    args = parser.parse_args()
+
+    check_route_coverage()
+
+    results = {
+        'iterations': args.iterations,
+        'cache': args.cache,
+        'sizes': {},
+    }
+    for size in args.sizes:
+        with benchmark_database():
+            results['sizes'][str(size)] = run(size, args.iterations, args.cache)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Compare the throughput of the projection query behind catalog_products
+with the previous implementation, which hydrated Product entities with
+their resources and picked the thumbnail in Python."""
+import argparse
+import asyncio
+import json
+
+from sqlalchemy import select
+
+from somisana.api.lib.derivatives import CATALOG_THUMBNAIL_WIDTH
+from somisana.api.routers.product import catalog_product_model
+from somisana.api.models import CatalogProductModel, ResourceModel
+from somisana.const import ResourceType
+from somisana.db import AsyncSessionLocal, async_engine
+from somisana.db.loaders import catalog_product_options, select_catalog_products
+from somisana.db.models import Product
+from test.benchmark import Timer, benchmark_database, seed_catalog, summarize
+
+
+async def entity_catalog_products(session) -> list[CatalogProductModel]:
+    products = (
+        await session.execute(
+            select(Product)
+            .options(*catalog_product_options())
+            .where(Product.superseded_by == None)
+            .order_by(Product.id)
+        )
+    ).scalars().all()
+
+    return [
+        CatalogProductModel(
+            id=product.id,
+            title=product.title,
+            description=product.description,
+            thumbnail=next(
+                (
+                    ResourceModel(
+                        id=resource.id,
+                        title=resource.title,
+                        reference=resource.reference,
+                        resource_type=ResourceType.THUMBNAIL,
+                        reference_type=resource.reference_type,
+                    )
+                    for resource in product.resources
+                    if resource.resource_type == ResourceType.THUMBNAIL
+                ),
+                None
+            )
+        )
+        for product in products
+    ]
+
+
+async def projection_catalog_products(session) -> list[CatalogProductModel]:
+    rows = (await session.execute(select_catalog_products(CATALOG_THUMBNAIL_WIDTH))).all()
+
+    return [catalog_product_model(row) for row in rows]
+
+
+async def run(iterations: int) -> dict:
+    results = {}
+    for name, build_catalog in (
+            ('entity', entity_catalog_products),
+            ('projection', projection_catalog_products),
+    ):
+        timer = Timer()
+        for _ in range(iterations):
+            async with AsyncSessionLocal() as session:
+                with timer():
+                    catalog = await build_catalog(session)
+
+        results[name] = summarize(timer.durations) | {'products': len(catalog)}
+
+    await async_engine.dispose()
+    results['speedup'] = round(results['projection']['throughput'] / results['entity']['throughput'], 2)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    with benchmark_database():
+        seed_catalog(args.products)
+        results = asyncio.run(run(args.iterations))
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Compare serializing the responses of /product/all_products with orjson,
+as the response cache now does, against the previous jsonable_encoder and
+json.dumps path, both for the page of ProductOut models alone and for the
+whole request, with the response cache cleared before each request."""
+import argparse
+import json
+from unittest.mock import patch
+
+from starlette.testclient import TestClient
+
+import somisana.api
+import somisana.db
+from somisana.api.lib.cache import response_cache
+from somisana.api.lib.pagination import MAX_PAGE_LIMIT, Page, paginate
+from somisana.api.lib.serialization import fast_json, standard_json
+from somisana.api.routers.product import output_product_model
+from somisana.db.loaders import select_products
+from somisana.db.models import Product
+from test.benchmark import Timer, benchmark_database, seed_catalog, summarize
+from test.benchmark.api_scale import stub_authorize
+
+SERIALIZERS = {
+    'standard': standard_json,
+    'fast': fast_json,
+}
+
+
+def run(iterations: int, limit: int) -> dict:
+    results = {}
+    with stub_authorize(), TestClient(somisana.api.app) as client:
+        async def build_page():
+            async with somisana.db.AsyncSessionLocal() as session:
+                products = (await session.execute(
+                    paginate(select_products(), Product.id, Page(limit=limit, cursor=None))
+                )).scalars().all()
+                return [output_product_model(product) for product in products]
+
+        models = client.portal.call(build_page)
+
+        for name, serialize in SERIALIZERS.items():
+            serialize_timer = Timer()
+            for _ in range(iterations):
+                with serialize_timer():
+                    body = serialize(models)
+
+            request_timer = Timer()
+            with patch('somisana.api.lib.cache.fast_json', serialize):
+                for _ in range(iterations):
+                    response_cache.clear()
+                    with request_timer():
+                        r = client.get('/product/all_products', params={'limit': limit})
+                    assert r.status_code == 200
+
+            results[name] = {
+                'serialize': summarize(serialize_timer.durations),
+                'request': summarize(request_timer.durations),
+                'body_bytes': len(body),
+            }
+
+        client.portal.call(somisana.db.async_engine.dispose)
+
+    results['identical'] = standard_json(models) == fast_json(models)
+    for stage in 'serialize', 'request':
+        results[f'{stage}_speedup'] = round(
+            results['fast'][stage]['throughput'] / results['standard'][stage]['throughput'], 2
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--limit', type=int, default=MAX_PAGE_LIMIT, help='number of products per page')
+    parser.add_argument('--iterations', type=int, default=50)
+    args = parser.parse_args()
+
+    with benchmark_database():
+        seed_catalog(args.products)
+        results = run(args.iterations, args.limit)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Measure the latency of full text product searches, which should stay
+under 10 ms at 10k products thanks to the GIN index on the search vector,
+and report whether the planner uses the index. Query latency covers
+executing the search and fetching a page of rows; response latency adds
+building the response models."""
+import argparse
+import asyncio
+import json
+import random
+
+from sqlalchemy import select, text
+
+from somisana.api.lib.derivatives import CATALOG_THUMBNAIL_WIDTH
+from somisana.api.lib.pagination import DEFAULT_PAGE_LIMIT
+from somisana.api.routers.product import product_search_model
+from somisana.db import AsyncSessionLocal, async_engine
+from somisana.db.loaders import select_product_matches, select_ranked_product_search, product_search_rank
+from somisana.db.models import Product
+from somisana.db.search import SEARCH_CONFIG, search_query
+from test.benchmark import Timer, benchmark_database, seed_catalog, summarize
+
+
+def search_statement(q: str):
+    """Build the statement behind the first page of /product/search?q=."""
+    text_query = search_query(q)
+    matches = (
+        select_product_matches(text_query)
+        .order_by(product_search_rank(text_query).desc(), Product.id)
+        .limit(DEFAULT_PAGE_LIMIT)
+        .subquery('matches')
+    )
+    return select_ranked_product_search(CATALOG_THUMBNAIL_WIDTH, text_query, matches)
+
+
+async def search_terms(count: int) -> list[str]:
+    """Pick search terms that occur in the seeded titles."""
+    async with AsyncSessionLocal() as session:
+        titles = (await session.execute(select(Product.title).limit(1000))).scalars().all()
+
+    words = sorted({word.lower() for title in titles for word in title.split() if len(word) > 3})
+    return random.sample(words, min(count, len(words)))
+
+
+async def run(iterations: int) -> dict:
+    terms = await search_terms(iterations)
+    query_timer = Timer()
+    response_timer = Timer()
+    matches = 0
+    for term in terms:
+        async with AsyncSessionLocal() as session:
+            with response_timer():
+                with query_timer():
+                    rows = (await session.execute(search_statement(term))).all()
+                results = [product_search_model(row) for row in rows]
+        matches += len(results)
+
+    async with AsyncSessionLocal() as session:
+        plan = '\n'.join((await session.execute(
+            text(f"EXPLAIN SELECT id FROM product "
+                 f"WHERE search_vector @@ websearch_to_tsquery('{SEARCH_CONFIG}', :q)"),
+            {'q': terms[0]},
+        )).scalars().all())
+
+    await async_engine.dispose()
+    query = summarize(query_timer.durations)
+    return {
+        'query': query,
+        'response': summarize(response_timer.durations),
+        'searches': len(terms),
+        'mean_matches': round(matches / len(terms), 1),
+        'uses_gin_index': 'ix_product_search_vector' in plan,
+        'query_p95_under_10_ms': query['p95_ms'] < 10,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    with benchmark_database():
+        seed_catalog(args.products)
+        results = asyncio.run(run(args.iterations))
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
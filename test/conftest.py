@@ -29,7 +29,6 @@ def session():
     try:
         yield
     finally:
-        somisana.db.Session.remove()
         FactorySession.remove()
         TestSession.remove()
 
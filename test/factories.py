@@ -6,7 +6,7 @@ from faker import Faker
 from sqlalchemy.orm import scoped_session, sessionmaker
 
 import somisana.db
-from somisana.const import ResourceType, ResourceReferenceType
+from somisana.const import ResourceType, ResourceReferenceType, DatasetType
 from somisana.db.models import Product, ProductVersion, ProductResource, Dataset, DatasetResource, Resource
 
 FactorySession = scoped_session(sessionmaker(
@@ -61,7 +61,7 @@ class DatasetFactory(SOMISANAModelFactory):
     product_id = factory.SelfAttribute('product.id')
     title = factory.Faker('sentence', nb_words=3)
     identifier = factory.Faker('word')
-    type = factory.Faker('word')
+    type = factory.LazyAttribute(lambda _: random.choice(list(DatasetType)).value)
     folder_path = factory.Faker('file_path', depth=2, extension='nc')
 
     product = factory.SubFactory(ProductFactory)